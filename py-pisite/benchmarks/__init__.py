@@ -0,0 +1 @@
+# microbenchmarks of the functions that take most of the cpu time of both apps, see benchmarks/run.py
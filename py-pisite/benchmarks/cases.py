@@ -0,0 +1,208 @@
+# the benchmarked functions, timed in a process of their own for each app (PISITE_MODE decides which app is imported)
+# run by benchmarks.run from a directory set up like a load test's (see loadtest.environment.build_tree)
+#   python -m benchmarks.cases PI results.json --rounds 5 --round-seconds 0.2 --filter hash
+# writes {"<mode>.<case name>": {"calls": calls per round, "rounds": [seconds per call, one per round]}}
+# to the results file, e.g. "pi.hash_password"
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+import loadtest.stubs as stubs
+from loadtest.environment import PASSWORD, username
+
+# mode: {case name: case}
+# a case is a context manager yielding the function to time, called without arguments
+CASES = {"PI": dict(), "MAIN": dict()}
+
+# function decorator to register a benchmark case of mode
+def case(mode, name):
+    def decorator(func):
+        CASES[mode][name] = contextlib.contextmanager(func)
+        return func
+    return decorator
+
+# what a browser sends with a dashboard request, forward_to_main copies these
+BROWSER_HEADERS = {
+    "Host": "pi.example.com",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/118.0",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Referer": "https://pi.example.com/dashboard",
+    "Cookie": "session=0123456789abcdef0123456789abcdef.fedcba9876543210",
+    "Connection": "keep-alive, x-forwarded-test",
+    "X-Forwarded-Test": "dropped",
+    "Keep-Alive": "timeout=5",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "DNT": "1",
+    "TE": "trailers"
+}
+
+LOGIN_JSON = {"username": username(0), "password": PASSWORD}
+
+## pi
+
+@case("PI", "hash_password")
+def hash_password():
+    import pisite_app.auth as auth
+    _, salt = auth._hash_password(PASSWORD)
+    yield lambda: auth._hash_password(PASSWORD, salt)
+
+# through hashing.run, like a login
+@case("PI", "validate_user")
+def validate_user():
+    import pisite_app.pisite as site
+    import pisite_app.auth as auth
+    with site.app.app_context():
+        yield lambda: auth.validate_user(username(0), PASSWORD)
+
+# the database lookup alone, nothing is hashed for an unknown user
+@case("PI", "validate_user_unknown")
+def validate_user_unknown():
+    import pisite_app.pisite as site
+    import pisite_app.auth as auth
+    with site.app.app_context():
+        yield lambda: auth.validate_user("nobody", PASSWORD)
+
+@case("PI", "verify_json_field_names")
+def verify_json_field_names():
+    import pisite_app.pisite as site
+    with site.app.test_request_context("/api/login", method="POST", json=LOGIN_JSON):
+        yield lambda: site.verify_json_field_names("username", "password")
+
+@case("PI", "require_json_fields")
+def require_json_fields():
+    import pisite_app.pisite as site
+    view = site.require_json_fields(post=["username", "password"])(lambda: None)
+    with site.app.test_request_context("/api/login", method="POST", json=LOGIN_JSON):
+        yield view
+
+@case("PI", "jsonify_response_data")
+def jsonify_response_data():
+    import pisite_app.pisite as site
+    from pisite_app.common import jsonify_if_dataclass, ResponseData
+    data = {"username": username(0), "groups": ["users", "minecraft"], "endpoints": ["api/mc", "api/power"]}
+    view = jsonify_if_dataclass(lambda: ResponseData(True, "logged in", data))
+    with site.app.test_request_context("/api/account"):
+        yield view
+
+@case("PI", "jsonify_status_response")
+def jsonify_status_response():
+    import pisite_app.pisite as site
+    from pisite_app.common import jsonify_if_dataclass, StatusResponse
+    statuses = {"tmux_window_running": True, "process_running": True, "mc_status_ping": True}
+    info = {"motd": "a minecraft server", "players": ["player{}".format(i) for i in range(8)]}
+    view = jsonify_if_dataclass(lambda: StatusResponse(True, statuses, info))
+    with site.app.test_request_context("/api/main/mc"):
+        yield view
+
+# the request side of forward_to_main
+@case("PI", "forward_request_headers")
+def forward_request_headers():
+    import pisite_app.pisite as site
+    with site.app.test_request_context("/api/main/mc", headers=BROWSER_HEADERS) as context:
+        headers = context.request.headers
+        yield lambda: site.filter_hop_by_hop_headers(headers.items(), ["host", "content-length"])
+
+## main, with the stand-ins answering right away so only main's own code is timed
+
+def main_site():
+    if "pisite_app.mainsite" not in sys.modules:
+        stubs.install(stubs.StubSettings(tmux_latency=0, process_latency=0, ping_latency=0, query_latency=0))
+    import pisite_app.mainsite as mainsite
+    return mainsite
+
+# the minecraft server of the load test's MC_* settings
+def minecraft():
+    return main_site().game_servers["minecraft"]
+
+@case("MAIN", "probe_tmux")
+def probe_tmux():
+    yield minecraft().probes["tmux"].run
+
+@case("MAIN", "probe_process")
+def probe_process():
+    yield minecraft().probes["process"].run
+
+# the full scan run by the process registry's reconciliation
+@case("MAIN", "process_scan")
+def process_scan():
+    yield main_site().process_registry.scan
+
+@case("MAIN", "probe_minecraft")
+def probe_minecraft():
+    yield minecraft().probes["minecraft"].run
+
+# every probe, in the request
+@case("MAIN", "status")
+def status():
+    yield minecraft().status
+
+# a status GET's check with the collector running, a round trip over its socket
+@case("MAIN", "collected_status")
+def collected_status():
+    mainsite = main_site()
+    server = minecraft()
+    mainsite.status_collector.start()
+    while len(mainsite.collector_client.snapshot() or dict()) < len(server.probes):
+        time.sleep(0.05)
+    yield lambda: server.collected_status(mainsite.collector_client.snapshot(), mainsite.app.config["COLLECTOR_MAX_AGE"])
+
+##
+
+# seconds per call of func, for each round
+# the calls per round are picked so a round takes about round_seconds, at least one call
+def measure(func, rounds, round_seconds) -> (int, list):
+    started = time.perf_counter()
+    func()
+    once = time.perf_counter() - started
+    calls = max(1, int(round_seconds / once)) if once > 0 else 1
+    # the first call may have paid for imports and caches, check with a few more
+    if calls > 1:
+        started = time.perf_counter()
+        for _ in range(min(calls, 10)):
+            func()
+        once = (time.perf_counter() - started) / min(calls, 10)
+        calls = max(1, int(round_seconds / once)) if once > 0 else calls
+
+    results = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(calls):
+            func()
+        results.append((time.perf_counter() - started) / calls)
+    return calls, results
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="time the benchmark cases of one app")
+    parser.add_argument("mode", choices=sorted(CASES))
+    parser.add_argument("output")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--round-seconds", type=float, default=0.2)
+    parser.add_argument("--filter", action="append", default=[], help="only cases whose name contains this")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    os.environ["PISITE_MODE"] = args.mode
+
+    results = dict()
+    for (name, benchmark_case) in CASES[args.mode].items():
+        name = "{}.{}".format(args.mode.lower(), name)
+        if args.filter and not any(text in name for text in args.filter):
+            continue
+        with benchmark_case() as func:
+            calls, rounds = measure(func, args.rounds, args.round_seconds)
+        results[name] = {"calls": calls, "rounds": rounds}
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
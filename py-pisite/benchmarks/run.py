@@ -0,0 +1,149 @@
+# microbenchmarks of the hot functions of both apps: password hashing and checking, json field checks,
+# dataclass responses, the header copying of forward_to_main and each probe of main's game server status
+# runs offline in a temporary directory set up like a load test's, then appends the results to a history file
+# (one json record per line) and compares them to the last record from this machine
+#   cd py-pisite && python -m benchmarks.run --filter pi.jsonify --filter main.probe
+# needs openssl for the certificate
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from loadtest.environment import SOURCE_DIR, build_tree, child_env, free_port
+
+DEFAULT_HISTORY = os.path.join(SOURCE_DIR, "benchmarks", "history.jsonl")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="run the microbenchmarks and record them")
+    parser.add_argument("--filter", action="append", default=[],
+        help="only cases whose name (e.g. pi.hash_password) contains this, can be repeated")
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per case")
+    parser.add_argument("--round-seconds", type=float, default=0.2, help="about how long each round takes")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="file the results are appended to")
+    parser.add_argument("--no-history", action="store_true", help="don't record the results")
+    parser.add_argument("--threshold", type=float, default=10, help="percent change of the median worth pointing out")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark's directory")
+    return parser.parse_args(argv)
+
+def git(*args) -> str:
+    try:
+        return subprocess.run(["git"] + list(args), cwd=SOURCE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# {case name: {"calls", "rounds", "min", "median", "mean", "stdev", "per_second"}}, times in seconds per call
+def run_cases(args) -> dict:
+    directory = tempfile.mkdtemp(prefix="pisite-benchmark-")
+    failed = True
+    try:
+        # main isn't started, it only has to exist in the instance config
+        build_tree(directory, free_port(), 0, 1)
+        results = dict()
+        for mode in ("PI", "MAIN"):
+            output_path = os.path.join(directory, mode.lower() + ".json")
+            command = [
+                sys.executable, "-m", "benchmarks.cases", mode, output_path,
+                "--rounds", str(args.rounds),
+                "--round-seconds", str(args.round_seconds)
+            ]
+            for text in args.filter:
+                command += ["--filter", text]
+            subprocess.run(command, cwd=directory, env=child_env(directory, mode), check=True)
+            with open(output_path) as output_file:
+                results.update(json.load(output_file))
+        failed = False
+    finally:
+        if args.keep or failed:
+            print("kept {}".format(directory))
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for result in results.values():
+        rounds = result["rounds"]
+        result["min"] = min(rounds)
+        result["median"] = statistics.median(rounds)
+        result["mean"] = statistics.mean(rounds)
+        result["stdev"] = statistics.stdev(rounds) if len(rounds) > 1 else 0
+        result["per_second"] = 1 / result["median"] if result["median"] > 0 else 0
+    return results
+
+def make_record(args, results) -> dict:
+    return {
+        "timestamp": time.time(),
+        "commit": git("rev-parse", "HEAD"),
+        # changes to tracked files, the numbers may not belong to the commit
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "host": socket.gethostname(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "rounds": args.rounds,
+        "round_seconds": args.round_seconds,
+        "results": results
+    }
+
+# the last record in the history file from the same host and python, or None
+def previous_record(history_path, record) -> dict:
+    previous = None
+    try:
+        with open(history_path) as history_file:
+            for line in history_file:
+                try:
+                    old_record = json.loads(line)
+                except ValueError:
+                    continue
+                if old_record.get("host") == record["host"] and old_record.get("python") == record["python"]:
+                    previous = old_record
+    except FileNotFoundError:
+        pass
+    return previous
+
+def format_seconds(seconds) -> str:
+    if seconds >= 1:
+        return "{:.2f} s".format(seconds)
+    if seconds >= 0.001:
+        return "{:.2f} ms".format(seconds * 1000)
+    return "{:.2f} us".format(seconds * 1000000)
+
+def print_results(results, previous, threshold):
+    print("{:<28} {:>8} {:>11} {:>11} {:>11} {:>11} {:>11} {:>9}".format(
+        "case", "calls", "min", "median", "mean", "stdev", "per second", "change"))
+    previous_results = previous["results"] if previous is not None else dict()
+    for (name, result) in sorted(results.items()):
+        change = ""
+        if name in previous_results and previous_results[name]["median"] > 0:
+            percent = (result["median"] / previous_results[name]["median"] - 1) * 100
+            change = "{:+.1f}%".format(percent)
+            if abs(percent) >= threshold:
+                change += " !"
+        print("{:<28} {:>8} {:>11} {:>11} {:>11} {:>11} {:>11.1f} {:>9}".format(
+            name, result["calls"], format_seconds(result["min"]), format_seconds(result["median"]),
+            format_seconds(result["mean"]), format_seconds(result["stdev"]), result["per_second"], change))
+    if previous is not None:
+        print("change is of the median, against {} from {}".format(
+            (previous.get("commit") or "unknown commit")[:10],
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(previous["timestamp"]))))
+
+def main(argv):
+    args = parse_args(argv)
+    results = run_cases(args)
+    if len(results) == 0:
+        print("no cases match {}".format(", ".join(args.filter)))
+        return
+
+    record = make_record(args, results)
+    print_results(results, previous_record(args.history, record), args.threshold)
+    if not args.no_history:
+        with open(args.history, "a") as history_file:
+            history_file.write(json.dumps(record) + "\n")
+        print("recorded in {}".format(args.history))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,9 +2,12 @@
 
 import datetime
 
-# use filesystem
-SESSION_TYPE = "filesystem"
-SESSION_FILE_DIR = "./instance/flask_session"
+# sessions in sqlite, see pisite_app/sessions.py
+# any other type is handled by flask-session
+SESSION_TYPE = "sqlite"
+SESSION_SQLITE_PATH = "./instance/sessions.sqlite"
+SESSION_SWEEP_INTERVAL = 3600 # seconds between deleting expired sessions, per worker
+SESSION_FILE_DIR = "./instance/flask_session" # for SESSION_TYPE = "filesystem"
 # security
 SESSION_COOKIE_SECURE = True
 SESSION_COOKIE_HTTPONLY = True
@@ -13,4 +16,193 @@ SESSION_COOKIE_SAMESITE = 'Lax'
 PERMANENT_SESSION_LIFETIME = datetime.timedelta(days=7)
 
 # https://stackoverflow.com/a/43263483
-JSON_SORT_KEYS = False
\ No newline at end of file
+JSON_SORT_KEYS = False
+
+# forwarding to main (pi only)
+FORWARD_CHUNK_SIZE = 16 * 1024 # bytes held in memory per chunk while streaming
+# endpoints on main that users can reach through /api/main/, each with everything under it
+# anything else (e.g. api/metrics, which main only guards by the pi's ip and key) is refused
+MAIN_FORWARD_ENDPOINTS = ["api/ack", "api/mc", "api/left", "api/servers", "api/jobs"]
+
+# main's game servers, listed by /api/endpoints and the status stream (pi only)
+GAME_SERVER_LIST_TTL = 60 # seconds main's list is reused by a worker
+
+# short-lived cache for forwarded GETs (pi only), shared by all workers
+# identical GETs within the ttl, from users with the same groups, share one request to main
+FORWARD_CACHE_DIR = "./instance/forward_cache"
+FORWARD_CACHE_TTLS = {"api/mc": 5, "api/servers/minecraft": 5} # seconds, by endpoint on main, others aren't cached
+FORWARD_CACHE_MAX_ENTRY_BYTES = 256 * 1024
+
+# dynmap cache (pi only)
+DYNMAP_CACHE_DIR = "./instance/dynmap_cache"
+DYNMAP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DYNMAP_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024 # bigger files are forwarded but not cached
+# seconds an entry is served without revalidating with main, by longest matching prefix of the path under /dynmap/
+# "" is the default, 0 revalidates every time (needed for the frequently updated json)
+DYNMAP_CACHE_FRESH_SECONDS = {
+    "": 0,
+    "web/tiles/": 300,
+    "web/css/": 3600,
+    "web/images/": 3600,
+    "web/js/": 3600,
+}
+
+# asyncio serving mode, pisite_app.asgi (pi only)
+ASYNC_WSGI_THREADS = 16 # threads running the flask app, forwards to main don't hold one
+ASYNC_MAX_UPSTREAM_CONNECTIONS = 64
+ASYNC_CACHE_THREADS = 4 # threads reading and writing the dynmap and forward caches for forwards done async
+
+# main server reachability and circuit breaker (pi only)
+REACHABILITY_STATE_FILE = "./instance/main_reachability.json" # shared by all workers
+REACHABILITY_INTERVAL = 30 # seconds between probes while main is up
+REACHABILITY_DOWN_INTERVAL = 5 # seconds between probes while main is off or booting, how fast forwards resume
+CIRCUIT_FAILURE_THRESHOLD = 3 # consecutive failed forwards before failing fast until the next successful probe
+
+# power probe for GET /api/power (pi only)
+POWER_PROBE_STATE_FILE = "./instance/power_probe.json" # shared by all workers
+POWER_PROBE_TTL = 2 # seconds a result is reused, by any number of pollers
+POWER_PROBE_TIMEOUT = 1 # seconds
+# ports tried when unprivileged ICMP isn't allowed, MAIN_PORT is always tried
+# a refused connection still means main is on
+POWER_PROBE_TCP_PORTS = [22]
+
+# booting main with POST /api/power (pi only)
+BOOT_STATE_FILE = "./instance/boot.json" # shared by all workers, keeps past boot durations for estimates
+BOOT_RESEND_INITIAL = 5 # seconds before the magic packet is sent again, if main doesn't answer pings
+BOOT_RESEND_MAX = 60 # the wait doubles after each packet, up to this
+BOOT_TIMEOUT = 600 # seconds before a boot that hasn't reached ready is given up
+BOOT_READY_ENDPOINTS = ["api/mc"] # endpoints on main that must answer before main counts as ready
+BOOT_HISTORY_SIZE = 20 # past boots the estimates are learned from
+
+# logged in user cache (pi only)
+AUTH_CACHE_TTL = 60 # seconds a user's name and groups are reused by a worker without a query
+AUTH_CACHE_GENERATION_FILE = "./instance/auth_generation" # touched on changes, invalidates every worker's cache
+
+# react build (pi only), indexed at startup, restart after deploying a new build
+ASSET_CACHE_DIR = "./instance/asset_cache" # gzip/brotli variants generated for files without pre-generated ones
+ASSET_COMPRESS_MIN_BYTES = 1024 # smaller files are always sent uncompressed
+
+# password hashing (pi only), bcrypt runs in a niced child process of each worker
+HASH_LOCK_DIR = "./instance/hash_slots"
+HASH_MAX_CONCURRENT = 2 # hashes running at once across all workers, leaves the other cores for requests
+HASH_MAX_QUEUED = 8 # hashes waiting for a slot, any more are rejected immediately
+HASH_QUEUE_TIMEOUT = 5 # seconds a hash waits for a slot before giving up
+HASH_NICE = 10 # added to the hashing processes' niceness
+
+# login throttling (pi only), token buckets shared by all workers
+LOGIN_THROTTLE_PATH = "./instance/throttle.sqlite"
+LOGIN_THROTTLE_IP_BURST = 10 # attempts allowed at once from one ip
+LOGIN_THROTTLE_IP_PER_MINUTE = 6 # attempts regained per minute
+LOGIN_THROTTLE_USERNAME_BURST = 5 # attempts allowed at once on one username
+LOGIN_THROTTLE_USERNAME_PER_MINUTE = 2
+LOGIN_THROTTLE_SWEEP_INTERVAL = 600 # seconds between deleting full buckets, per worker
+
+# admin listings (pi only)
+ADMIN_PAGE_SIZE = 50 # rows per page when no limit is given
+ADMIN_MAX_PAGE_SIZE = 200
+
+# mutual TLS channel between the pi and main, see pisite_app/channel.py
+# certificate paths go in the instance config:
+#   PATH_TO_MAIN_CHANNEL_CERTFILE (both), PATH_TO_PI_CHANNEL_CERTFILE (both),
+#   PATH_TO_MAIN_CHANNEL_KEYFILE (main), PATH_TO_PI_CHANNEL_KEYFILE (pi)
+MAIN_CHANNEL_PORT = None # (pi only) main's CHANNEL_PORT, None forwards over https only
+CHANNEL_CONNECT_TIMEOUT = 2 # (pi only) seconds
+CHANNEL_KEEPALIVE_INTERVAL = 10 # (pi only) seconds between pings on an idle connection
+CHANNEL_KEEPALIVE_TIMEOUT = 30 # seconds without hearing anything before a connection is dropped
+CHANNEL_RECONNECT_BACKOFF = 5 # (pi only) seconds after a failed connect before trying again, https is used meanwhile
+
+# game server processes (main only), see pisite_app/processregistry.py
+PROCESS_REGISTRY_STATE_FILE = "./instance/processes.json" # shared by all workers
+PROCESS_REGISTRY_RECONCILE_INTERVAL = 300 # seconds between full scans of the process table, by any one worker
+
+# game servers (main only), see pisite_app/gameservers.py
+# name: {"title", "tmux_session", "start_script", "start_dir",
+#        "stop_command": typed into the server's console to stop it (default ctrl-c),
+#        "stop_timeout": seconds it gets to exit before its tmux session is killed (default GAME_SERVER_STOP_TIMEOUT),
+#        "interval": seconds between the collector's probes (default COLLECTOR_INTERVAL),
+#        "probes": {probe type: its options, e.g. {"port": 27015, "timeout": 3}}}
+# None is a single minecraft server from the MC_TMUX_SESSION, MC_START_SCRIPT and MC_START_DIR settings, e.g.
+# GAME_SERVERS = {
+#     "minecraft": {
+#         "title": "minecraft",
+#         "tmux_session": "minecraft",
+#         "start_script": "/home/minecraft/start.sh",
+#         "start_dir": "/home/minecraft",
+#         "stop_command": "stop",
+#         "probes": {
+#             "tmux": {},
+#             "process": {"executable": "java", "arguments": ["forge", "minecraft"]},
+#             "minecraft": {"port": 25565}
+#         }
+#     },
+#     "left4dead2": {
+#         "title": "left 4 dead 2",
+#         "tmux_session": "l4d2",
+#         "start_script": "/home/steam/l4d2/start.sh",
+#         "start_dir": "/home/steam/l4d2",
+#         "stop_command": "quit",
+#         "interval": 10,
+#         "probes": {"tmux": {}, "process": {"executable": "srcds_linux"}, "a2s": {"port": 27015}}
+#     }
+# }
+GAME_SERVERS = None
+GAME_SERVER_STOP_TIMEOUT = 60 # seconds
+
+# game server start, stop and restart jobs (main only), see pisite_app/jobs.py
+JOBS_DIR = "./instance/jobs" # shared by all workers, also holds each server's lock file
+JOBS_KEEP_SECONDS = 86400 # finished jobs are deleted after this
+JOBS_LIST_LIMIT = 20 # newest jobs listed by GET /api/jobs
+JOBS_STREAM_POLL_INTERVAL = 0.25 # seconds between checks of a streamed job
+JOBS_STREAM_HEARTBEAT = 0.5 # seconds between keepalive comments, under the pi's 1 second read timeout
+# every stream holds a thread on main, and one on the pi relaying it, and needs threaded workers
+JOBS_STREAM_SLOT_DIR = "./instance/job_stream_slots"
+JOBS_STREAM_MAX_CLIENTS = 4 # across all workers
+JOBS_STREAM_MAX_SECONDS = 25 # then the browser reconnects, under gunicorn's worker timeout (30 seconds by default)
+
+# game server status collector (main only), see pisite_app/collector.py
+COLLECTOR_SOCKET = "./instance/collector.sock"
+COLLECTOR_INTERVAL = 5 # seconds between runs of each probe
+COLLECTOR_TIMEOUTS = {"tmux": 2, "process": 1, "tcp": 2, "minecraft": 3, "a2s": 3} # seconds, by probe type, then it counts as off
+COLLECTOR_MAX_AGE = 15 # seconds a result is used by the workers, older ones are probed in the request
+COLLECTOR_CLIENT_TIMEOUT = 0.5 # seconds a worker waits for the collector's answer
+
+# game server history, GET /api/servers/<name>/history (main only), sampled by the collector, see pisite_app/history.py
+HISTORY_TIERS = { # name: (seconds per bucket, buckets kept)
+    "minute": (60, 360), # 6 hours
+    "hour": (3600, 168), # a week
+    "day": (86400, 365) # a year, until main restarts
+}
+CHANNEL_BIND = "0.0.0.0" # (main only)
+CHANNEL_PORT = 5443 # (main only)
+CHANNEL_THREADS = 16 # (main only) requests handled at once
+
+# prometheus metrics, GET /api/metrics and /api/metrics/main (pi only)
+# admins can always read them, a scraper can use this as its bearer token
+METRICS_TOKEN = None
+
+# request profiling, see pisite_app/profiling.py
+# requests are profiled if picked at random, their route is listed, or they have an X-Pisite-Profile header holding the token
+PROFILE_SAMPLE_RATE = 0.0 # fraction of requests, e.g. 0.001 is fine to leave on
+PROFILE_ROUTES = [] # e.g. ["/api/login", "/api/main/<path:endpoint>"]
+PROFILE_TOKEN = None # None ignores the header
+PROFILE_DIR = "./instance/profiles"
+PROFILE_MAX_FILES = 200 # newest profiles kept
+PROFILE_INTERVAL = 0.005 # seconds between stack samples
+PROFILE_MAX_CONCURRENT = 2 # profiled requests at once, per worker, others run unprofiled
+PROFILE_MAX_SECONDS = 30 # sampling stops after this, for long streams
+
+# /api/batch
+BATCH_MAX_REQUESTS = 20
+BATCH_THREADS = 8 # sub-requests run at once, per worker
+
+# status stream, GET /api/status/stream (pi only)
+STATUS_STREAM_STATE_FILE = "./instance/status_feed.json" # shared by all workers
+STATUS_STREAM_INTERVAL = 2 # seconds between checks of main's power, only while someone is watching
+STATUS_STREAM_SERVERS_INTERVAL = 10 # seconds between checks of the game servers while main is up
+STATUS_STREAM_SERVERS = None # name: status endpoint on main, None is every server main declares
+STATUS_STREAM_HEARTBEAT = 15 # seconds between keepalive comments
+STATUS_STREAM_RETRY = 3 # seconds browsers wait before reconnecting
+# outside of asyncio mode every open stream holds a worker thread, and needs threaded workers (gthread)
+STATUS_STREAM_SLOT_DIR = "./instance/status_stream_slots"
+STATUS_STREAM_MAX_CLIENTS = 8 # across all workers, leave most of the threads for other requests
+STATUS_STREAM_MAX_SECONDS = 25 # then the browser reconnects, under gunicorn's worker timeout (30 seconds by default)
@@ -12,6 +12,10 @@ proc_name = ""
 daemon = False # do not daemonize, let the OS's service controller do it (systemd, rc.d, runit, etc)
 bind = ["0.0.0.0:5000"] # addresses to bind to
 workers = 9 # number of worker processes, should be about (2*cores)+1
+threads = 4 # per worker (gthread), a status stream holds a thread instead of a whole worker
+# asyncio mode (pi only), see RUNNING.md
+# worker_class = "uvicorn.workers.UvicornWorker" # run pisite_app.asgi:app
+# workers = 2
 
 # if you want gunicorn to write its own logs
 # errorlog = ""
@@ -20,3 +24,18 @@ workers = 9 # number of worker processes, should be about (2*cores)+1
 # if you want gunicorn to use syslog
 syslog = True
 syslog_addr = "unix://dev/log"
+
+# metrics of all workers are added up through files in this directory, see pisite_app/metrics.py
+# set here so it's set before the app (and prometheus_client) is imported
+import os
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/pisite-metrics")
+
+def on_starting(server):
+    # values left over from the last run
+    import shutil
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1 @@
+# end-to-end load tests of the pi app against a stand-in main, see loadtest/run.py
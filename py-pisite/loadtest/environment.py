@@ -0,0 +1,206 @@
+# everything a load test runs against, on this machine only:
+# a temporary directory standing in for py-pisite (code linked in, its own instance config, databases and caches),
+# a self-signed certificate, a react build and dynmap tiles to serve, the fake main and the pi app under gunicorn
+
+import os
+import sys
+import time
+import socket
+import shutil
+import secrets
+import tempfile
+import subprocess
+
+import requests
+
+# py-pisite
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every load test user has this password
+PASSWORD = "load test password, not a real one"
+
+# seconds to wait for a server to start answering
+STARTUP_TIMEOUT = 30
+
+TILE_BYTES = 6 * 1024
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def username(i) -> str:
+    return "loadtest{}".format(i)
+
+# environment variables for running mode ("PI" or "MAIN") in directory
+def child_env(directory, mode) -> dict:
+    env = dict(os.environ)
+    env["PISITE_MODE"] = mode
+    env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(directory, "metrics", mode.lower())
+    # would replace the pi's own PATH_TO_MAIN_CERTFILE
+    env.pop("REQUESTS_CA_BUNDLE", None)
+    env.pop("CURL_CA_BUNDLE", None)
+    return env
+
+# a copy of py-pisite in directory, with the code linked in and everything else its own
+# main is expected on main_port, returns the pi paths of the dynmap tiles
+def build_tree(directory, main_port, tile_count, users) -> list:
+    for name in ("pisite_app", "loadtest", "benchmarks", "config.py"):
+        os.symlink(os.path.join(SOURCE_DIR, name), os.path.join(directory, name))
+    for name in ("instance", "react", "dynmap/web/tiles", "metrics/pi", "metrics/main", "logs"):
+        os.makedirs(os.path.join(directory, name))
+
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+        "-keyout", os.path.join(directory, "key.pem"), "-out", os.path.join(directory, "cert.pem")
+    ], check=True, capture_output=True)
+
+    with open(os.path.join(directory, "react", "index.html"), "w") as index_file:
+        index_file.write("<!doctype html><html><body><div id=\"root\"></div></body></html>")
+    with open(os.path.join(directory, "dynmap", "web", "index.html"), "w") as index_file:
+        index_file.write("<!doctype html><html><body>dynmap</body></html>")
+    tile_paths = []
+    for i in range(tile_count):
+        path = "web/tiles/world/flat/0_0/zz_{}_{}.png".format(i % 16, i // 16)
+        os.makedirs(os.path.dirname(os.path.join(directory, "dynmap", path)), exist_ok=True)
+        with open(os.path.join(directory, "dynmap", path), "wb") as tile_file:
+            tile_file.write(os.urandom(TILE_BYTES))
+        tile_paths.append("/dynmap/" + path)
+
+    api_key = secrets.token_hex(16)
+    with open(os.path.join(directory, "instance", "config.py"), "w") as config_file:
+        config_file.write("\n".join([
+            "# written by loadtest.environment, read by both the pi app and the fake main",
+            "SECRET_KEY = {!r}".format(secrets.token_hex(32)),
+            "PATH_TO_MAIN_CERTFILE = {!r}".format(os.path.join(directory, "cert.pem")),
+            "MAIN_IP = \"127.0.0.1\"",
+            "MAIN_PORT = {}".format(main_port),
+            "PI_IP = \"127.0.0.1\"",
+            "PI_API_KEY = {!r}".format(api_key),
+            "MAIN_API_KEY = {!r}".format(api_key),
+            "MAIN_MAC = \"00:00:00:00:00:00\"",
+            "REACT_BASE_DIR = {!r}".format(os.path.join(directory, "react")),
+            "SQLALCHEMY_DATABASE_URI = {!r}".format("sqlite:///" + os.path.join(directory, "pisite.sqlite")),
+            "SQLALCHEMY_TRACK_MODIFICATIONS = False",
+            "DYNMAP_PATH = {!r}".format(os.path.join(directory, "dynmap")),
+            "MC_TMUX_SESSION = \"minecraft\"",
+            "MC_START_SCRIPT = \"/bin/true\"",
+            "MC_START_DIR = {!r}".format(directory),
+            "# every virtual user logs in from 127.0.0.1",
+            "LOGIN_THROTTLE_IP_BURST = 1000000",
+            "LOGIN_THROTTLE_IP_PER_MINUTE = 1000000",
+            "LOGIN_THROTTLE_USERNAME_BURST = 1000000",
+            "LOGIN_THROTTLE_USERNAME_PER_MINUTE = 1000000",
+            ""
+        ]))
+
+    subprocess.run(
+        [sys.executable, "-m", "loadtest.users", str(users)],
+        cwd=directory, env=child_env(directory, "PI"), check=True
+    )
+
+    return tile_paths
+
+class Environment():
+    # args are loadtest.run's arguments
+    def __init__(self, args):
+        self.args = args
+        self.directory = None
+        self.processes = []
+        self.main_port = free_port()
+        self.pi_port = free_port()
+        self.tile_paths = []
+
+    @property
+    def pi_url(self) -> str:
+        return "https://127.0.0.1:{}".format(self.pi_port)
+
+    @property
+    def cert_path(self) -> str:
+        return os.path.join(self.directory, "cert.pem")
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="pisite-loadtest-")
+        try:
+            self.set_up()
+            self.start()
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in reversed(self.processes):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        # kept after a failure too, for the logs
+        if self.args.keep or exc_info[0] is not None:
+            print("kept {}".format(self.directory))
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def set_up(self):
+        self.tile_paths = build_tree(self.directory, self.main_port, self.args.tiles, self.args.users)
+
+    def start(self):
+        main_command = [
+            sys.executable, "-m", "loadtest.fakemain",
+            "--port", str(self.main_port),
+            "--cert", self.cert_path,
+            "--key", os.path.join(self.directory, "key.pem"),
+            "--latency", str(self.args.main_latency),
+            "--jitter", str(self.args.main_jitter),
+            "--error-rate", str(self.args.main_error_rate),
+            "--hang-rate", str(self.args.main_hang_rate)
+        ]
+        if self.args.mc_off:
+            main_command.append("--mc-off")
+        if self.args.collector:
+            main_command.append("--collector")
+        self.spawn("main", main_command, "MAIN")
+
+        pi_command = [
+            sys.executable, "-m", "gunicorn",
+            "--chdir", self.directory,
+            "--bind", "127.0.0.1:{}".format(self.pi_port),
+            "--workers", str(self.args.workers),
+            "--certfile", self.cert_path,
+            "--keyfile", os.path.join(self.directory, "key.pem")
+        ]
+        if self.args.asgi:
+            pi_command += ["--worker-class", "uvicorn.workers.UvicornWorker", "pisite_app.asgi:app"]
+        else:
+            pi_command += ["--threads", str(self.args.threads), "pisite_app:app"]
+        self.spawn("pi", pi_command, "PI")
+
+        self.wait_until_up("main", "https://127.0.0.1:{}/api/ack".format(self.main_port))
+        self.wait_until_up("pi", self.pi_url + "/")
+
+    def spawn(self, name, command, mode):
+        log_file = open(os.path.join(self.directory, "logs", name + ".log"), "w")
+        with log_file:
+            process = subprocess.Popen(command, cwd=self.directory, env=child_env(self.directory, mode),
+                stdout=log_file, stderr=subprocess.STDOUT)
+        process.name = name
+        self.processes.append(process)
+
+    def wait_until_up(self, name, url):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            for process in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError("{} exited, see {}".format(process.name, self.log_path(process.name)))
+            try:
+                requests.get(url, verify=self.cert_path, timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+        raise RuntimeError("{} didn't start in time, see {}".format(name, self.log_path(name)))
+
+    def log_path(self, name) -> str:
+        return os.path.join(self.directory, "logs", name + ".log")
@@ -0,0 +1,64 @@
+# main for load tests: the real pisite_app.mainsite, with libtmux, psutil and mcstatus replaced by
+# loadtest.stubs, and extra latency and failures injected into its answers
+# run from a directory set up by loadtest.run (it needs an instance config, a certificate and a dynmap directory)
+#   python -m loadtest.fakemain --port 5901 --cert cert.pem --key key.pem --latency 0.02 --error-rate 0.01
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import loadtest.stubs as stubs
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="stand-in main server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many seconds more, at random")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with a 500")
+    parser.add_argument("--hang-rate", type=float, default=0, help="fraction of requests that don't answer for --hang seconds")
+    parser.add_argument("--hang", type=float, default=5, help="seconds, longer than the pi's request timeout")
+    parser.add_argument("--mc-off", action="store_true", help="the stand-in minecraft server is off")
+    parser.add_argument("--collector", action="store_true", help="run the status collector, in this process")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    stubs.install(stubs.StubSettings(mc_running=not args.mc_off))
+
+    os.environ["PISITE_MODE"] = "MAIN"
+    import flask
+    import werkzeug.serving
+    import pisite_app.mainsite as mainsite
+
+    app = mainsite.app
+    if args.collector:
+        mainsite.status_collector.start()
+
+    # after verify_connection, so rejected requests aren't slowed down
+    @app.before_request
+    def inject():
+        delay = args.latency + random.uniform(0, args.jitter)
+        roll = random.random()
+        if roll < args.hang_rate:
+            delay += args.hang
+        if delay > 0:
+            time.sleep(delay)
+        if args.hang_rate <= roll < args.hang_rate + args.error_rate:
+            return flask.Response("injected failure", status=500)
+
+    print("fake main on https://{}:{}".format(args.host, args.port), flush=True)
+    werkzeug.serving.run_simple(
+        args.host,
+        args.port,
+        app,
+        threaded=True,
+        ssl_context=(args.cert, args.key)
+    )
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,58 @@
+# end-to-end load test of the pi app, offline on one linux machine
+# starts the pi app under gunicorn against loadtest.fakemain, drives a mix of logins, dashboard refreshes,
+# power checks and dynmap tile bursts, then reports latency percentiles and throughput per request
+#   cd py-pisite && python -m loadtest.run --users 20 --duration 30 --mix dashboard=6,power=2,tiles=1,login=1
+# needs gunicorn (and uvicorn for --asgi), and openssl for the certificate
+
+import sys
+import json
+import argparse
+
+import loadtest.scenarios as scenarios
+from loadtest.environment import Environment
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="load test the pi app against a stand-in main")
+    parser.add_argument("--users", type=int, default=20, help="virtual users, each with its own login")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--mix", default="dashboard=6,power=2,tiles=1,login=1", help="actions and their weights")
+    parser.add_argument("--think", type=float, default=1, help="mean seconds a user waits between actions")
+    parser.add_argument("--tiles", type=int, default=256, help="dynmap tiles on the fake main")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers of the pi app")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker, not with --asgi")
+    parser.add_argument("--asgi", action="store_true", help="run pisite_app.asgi under uvicorn workers")
+    parser.add_argument("--main-latency", type=float, default=0.02, help="seconds main adds to every answer")
+    parser.add_argument("--main-jitter", type=float, default=0.01)
+    parser.add_argument("--main-error-rate", type=float, default=0, help="fraction of main's answers that are 500s")
+    parser.add_argument("--main-hang-rate", type=float, default=0, help="fraction of requests main doesn't answer in time")
+    parser.add_argument("--mc-off", action="store_true", help="the stand-in minecraft server is off")
+    parser.add_argument("--collector", action="store_true", help="main serves status from the status collector")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the test's directory (logs, databases)")
+    return parser.parse_args(argv)
+
+def print_summary(summary: dict):
+    print("{:<12} {:>8} {:>7} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        "request", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for (name, row) in summary.items():
+        print("{:<12} {:>8} {:>7} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, row["count"], row["errors"], row["per_second"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"]))
+
+def main(argv):
+    args = parse_args(argv)
+    mix = scenarios.parse_mix(args.mix)
+
+    with Environment(args) as environment:
+        print("pi at {}, measuring {} users for {} seconds".format(environment.pi_url, args.users, args.duration))
+        stats = scenarios.run(environment, args.users, mix, args.think, args.warmup, args.duration)
+
+    summary = stats.summary(args.duration)
+    print_summary(summary)
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump({"arguments": vars(args), "results": summary}, json_file, indent=1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
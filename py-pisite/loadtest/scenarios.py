@@ -0,0 +1,158 @@
+# what the virtual users of a load test do, and the latencies they see
+# each virtual user logs in, then keeps picking an action by weight (the mix) until the test ends,
+# pausing a random think time in between like a person would
+
+import math
+import time
+import random
+import threading
+
+import requests
+
+from loadtest.environment import PASSWORD, username
+
+# tiles fetched at once when a user opens or pans the map
+TILE_BURST = 24
+
+# seconds, longer than the pi waits for main
+REQUEST_TIMEOUT = 10
+
+class Stats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict() # request name: [seconds]
+        self.errors = dict() # request name: count
+        self.recording = False
+
+    def record(self, name, seconds, ok):
+        if not self.recording:
+            return
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    # {request name: {"count", "errors", "per_second", "p50_ms", "p95_ms", "p99_ms", "max_ms"}}, and "all"
+    def summary(self, seconds) -> dict:
+        with self.lock:
+            latencies = {name: sorted(values) for (name, values) in self.latencies.items()}
+            errors = dict(self.errors)
+        all_latencies = sorted(value for values in latencies.values() for value in values)
+        errors["all"] = sum(errors.values())
+
+        result = dict()
+        for (name, values) in sorted(latencies.items()) + [("all", all_latencies)]:
+            result[name] = {
+                "count": len(values),
+                "errors": errors.get(name, 0),
+                "per_second": len(values) / seconds,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": (values[-1] if values else 0) * 1000
+            }
+        return result
+
+# nearest rank, values must be sorted
+def percentile(values, percent) -> float:
+    if len(values) == 0:
+        return 0
+    rank = max(1, math.ceil(len(values) * percent / 100))
+    return values[rank - 1]
+
+# a browser session, timing every request
+class Client():
+    def __init__(self, base_url, cert_path, stats: Stats):
+        self.base_url = base_url
+        self.stats = stats
+        self.session = requests.Session()
+        self.session.verify = cert_path
+        # the proxy and CA bundle of the machine running the test don't apply
+        self.session.trust_env = False
+
+    def request(self, name, method, path, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=REQUEST_TIMEOUT, **kwargs)
+            ok = response.status_code == 200
+            if ok and response.headers.get("Content-Type", "").startswith("application/json"):
+                # the api answers errors with a 200 too
+                ok = response.json().get("success", False)
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        self.stats.record(name, time.perf_counter() - started, ok)
+        return ok
+
+    def close(self):
+        self.session.close()
+
+## actions, each takes (client, user number, environment)
+
+def login(client: Client, user, environment):
+    client.request("login", "POST", "/api/login", json={"username": username(user), "password": PASSWORD})
+
+# what the dashboard asks for each time it refreshes
+def dashboard(client: Client, user, environment):
+    client.request("account", "GET", "/api/account")
+    client.request("endpoints", "GET", "/api/endpoints")
+    client.request("main_mc", "GET", "/api/main/mc")
+    client.request("power", "GET", "/api/power")
+
+def power(client: Client, user, environment):
+    client.request("power", "GET", "/api/power")
+
+def tiles(client: Client, user, environment):
+    for path in random.sample(environment.tile_paths, min(TILE_BURST, len(environment.tile_paths))):
+        client.request("tile", "GET", path)
+
+ACTIONS = {
+    "login": login,
+    "dashboard": dashboard,
+    "power": power,
+    "tiles": tiles
+}
+
+# "dashboard=6,power=2" to {"dashboard": 6, "power": 2}
+def parse_mix(text) -> dict:
+    mix = dict()
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ACTIONS:
+            raise ValueError("unknown action {}, one of {}".format(name, ", ".join(ACTIONS)))
+        mix[name] = float(weight) if weight else 1
+    return mix
+
+def virtual_user(user, environment, mix: dict, think_seconds, stop: threading.Event, stats: Stats):
+    client = Client(environment.pi_url, environment.cert_path, stats)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    try:
+        login(client, user, environment)
+        while not stop.is_set():
+            action = ACTIONS[random.choices(names, weights)[0]]
+            action(client, user, environment)
+            if think_seconds > 0:
+                stop.wait(random.expovariate(1 / think_seconds))
+    finally:
+        client.close()
+
+# returns the Stats of the measured part, after warmup_seconds
+def run(environment, users, mix: dict, think_seconds, warmup_seconds, duration_seconds) -> Stats:
+    stats = Stats()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=virtual_user, args=(user, environment, mix, think_seconds, stop, stats), daemon=True)
+        for user in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    stop.wait(warmup_seconds)
+    stats.recording = True
+    stop.wait(duration_seconds)
+    stats.recording = False
+    stop.set()
+    for thread in threads:
+        thread.join(REQUEST_TIMEOUT * 2)
+    return stats
@@ -0,0 +1,147 @@
+# stand-ins for what main's minecraft probes look at: tmux, the process table and the minecraft server
+# install() puts them in sys.modules, so it has to run before pisite_app.mainsite is imported
+# each one takes about as long as configured, so the status check costs what it would on main
+
+import sys
+import time
+import types
+
+class StubSettings():
+    def __init__(self, mc_running=True, tmux_latency=0.01, process_count=300, process_latency=0.00005,
+            ping_latency=0.005, query_latency=0.01, players=3):
+        self.mc_running = mc_running
+        self.tmux_latency = tmux_latency # seconds per session list
+        self.process_count = process_count # processes in the process table
+        self.process_latency = process_latency # seconds per process read
+        self.ping_latency = ping_latency # seconds
+        self.query_latency = query_latency # seconds
+        self.players = players
+
+# pid of the stand-in minecraft server, also its tmux pane's
+MC_PID = 4242
+MC_CREATE_TIME = 1000000.0
+
+# any keys typed into the stand-in server's console stop it, like its stop command would
+class StubPane():
+    def __init__(self, settings: StubSettings, pane_pid):
+        self.settings = settings
+        self.pane_pid = str(pane_pid)
+
+    def send_keys(self, cmd, enter=True, suppress_history=False):
+        self.settings.mc_running = False
+
+class StubSession():
+    def __init__(self, settings: StubSettings, name, pane_pid=None):
+        self.name = name
+        self.windows = [types.SimpleNamespace(panes=[StubPane(settings, pane_pid)])]
+
+class StubTmuxServer():
+    def __init__(self, settings: StubSettings, session_name):
+        self.settings = settings
+        self.session_name = session_name
+
+    def list_sessions(self):
+        time.sleep(self.settings.tmux_latency)
+        sessions = [StubSession(self.settings, "0")]
+        if self.settings.mc_running:
+            sessions.append(StubSession(self.settings, self.session_name, MC_PID))
+        return sessions
+
+    def new_session(self, session_name, start_directory, window_command):
+        self.settings.mc_running = True
+        return StubSession(self.settings, session_name, MC_PID)
+
+    def kill_session(self, target_session):
+        if target_session == self.session_name:
+            self.settings.mc_running = False
+
+class StubNoSuchProcess(Exception):
+    pass
+
+class StubProcess():
+    def __init__(self, settings: StubSettings, pid, cmdline):
+        self.settings = settings
+        self.pid = pid
+        self._cmdline = cmdline
+        self.info = dict()
+
+    def cmdline(self):
+        time.sleep(self.settings.process_latency)
+        return self._cmdline
+
+    def create_time(self):
+        return MC_CREATE_TIME if self.pid == MC_PID else 1.0
+
+    def is_running(self):
+        return self.pid != MC_PID or self.settings.mc_running
+
+    def status(self):
+        return "running"
+
+    def terminate(self):
+        if self.pid == MC_PID:
+            self.settings.mc_running = False
+
+def stub_process_table(settings: StubSettings):
+    processes = [StubProcess(settings, 100 + i, ["/usr/lib/systemd/systemd-worker", "--id", str(i)]) for i in range(settings.process_count)]
+    if settings.mc_running:
+        processes.append(StubProcess(settings, MC_PID, ["java", "-Xmx4G", "-jar", "forge-server.jar", "nogui"]))
+    return processes
+
+# like psutil.process_iter, filling in info with attrs
+def stub_process_iter(settings: StubSettings, attrs=None):
+    for process in stub_process_table(settings):
+        for attr in attrs or []:
+            process.info[attr] = getattr(process, attr)()
+        yield process
+
+# like psutil.Process, from a pid
+def stub_process(settings: StubSettings, pid):
+    for process in stub_process_table(settings):
+        if process.pid == pid:
+            return process
+    raise StubNoSuchProcess(pid)
+
+class StubQuery():
+    def __init__(self, settings: StubSettings):
+        self.motd = "a stand-in minecraft server"
+        self.players = types.SimpleNamespace(names=["player{}".format(i) for i in range(settings.players)])
+
+class StubMinecraftServer():
+    def __init__(self, settings: StubSettings, host):
+        self.settings = settings
+        self.host = host
+
+    def ping(self):
+        time.sleep(self.settings.ping_latency)
+        if not self.settings.mc_running:
+            raise ConnectionRefusedError("stand-in server is off")
+        return 1.5
+
+    def query(self):
+        time.sleep(self.settings.query_latency)
+        if not self.settings.mc_running:
+            raise ConnectionRefusedError("stand-in server is off")
+        return StubQuery(self.settings)
+
+# replace libtmux, psutil and mcstatus with the stand-ins, returns the settings they use
+# session_name should be main's MC_TMUX_SESSION
+def install(settings: StubSettings=None, session_name="minecraft") -> StubSettings:
+    if settings is None:
+        settings = StubSettings()
+
+    libtmux = types.ModuleType("libtmux")
+    libtmux.Server = lambda: StubTmuxServer(settings, session_name)
+    psutil = types.ModuleType("psutil")
+    psutil.process_iter = lambda attrs=None: stub_process_iter(settings, attrs)
+    psutil.Process = lambda pid: stub_process(settings, pid)
+    psutil.Error = Exception
+    psutil.NoSuchProcess = StubNoSuchProcess
+    psutil.STATUS_ZOMBIE = "zombie"
+    mcstatus = types.ModuleType("mcstatus")
+    mcstatus.MinecraftServer = lambda host, port=25565: StubMinecraftServer(settings, host)
+
+    sys.modules["libtmux"] = libtmux
+    sys.modules["psutil"] = psutil
+    sys.modules["mcstatus"] = mcstatus
+    return settings
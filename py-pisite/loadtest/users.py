@@ -0,0 +1,24 @@
+# creates the load test's users in the pi's database, run by loadtest.environment from the load test's directory
+#   python -m loadtest.users <count>
+
+import os
+import sys
+
+from loadtest.environment import PASSWORD, username
+
+def main(argv):
+    count = int(argv[0])
+    os.environ["PISITE_MODE"] = "PI"
+    import pisite_app.pisite as site
+    import pisite_app.auth as auth
+
+    # every user has the same password, hashed once
+    hashed_password, salt = auth._hash_password(PASSWORD)
+    with site.app.app_context():
+        auth.db.create_all()
+        for i in range(count):
+            auth.db.session.add(auth.User(username(i), hashed_password, salt, None))
+        auth.db.session.commit()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,518 @@
+# asyncio serving mode for the pi
+# run with an ASGI server, e.g. `uvicorn pisite_app.asgi:app` (PISITE_MODE must be PI)
+#
+# the flask app is still used for every request, run in a bounded thread pool
+# views decorated with pisite.async_forward hand their forward to main back to this module,
+# which does it with an async http client, so a request waiting on main only costs a coroutine
+# instead of a worker thread
+
+import sys
+import ssl
+import json
+import time
+import asyncio
+import secrets
+import tempfile
+import concurrent.futures
+from dataclasses import asdict
+
+import httpx
+
+import pisite_app.pisite as site
+import pisite_app.statusfeed as statusfeed
+import pisite_app.responsecache as responsecache
+import pisite_app.metrics as metrics
+from pisite_app.common import ResponseData
+
+flask_app = site.app
+
+# lets the flask app recognize requests coming through here
+flask_app.config["ASYNC_HANDOFF_TOKEN"] = secrets.token_hex(32)
+
+# bodies bigger than this are spooled to disk before being given to flask
+MAX_BODY_IN_MEMORY = 64 * 1024 # bytes
+
+# how often a request waiting for another one to fetch the same forward cache entry checks on it
+FORWARD_CACHE_POLL_INTERVAL = 0.05 # seconds
+
+class App():
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=flask_app.config["ASYNC_WSGI_THREADS"],
+            thread_name_prefix="pisite-wsgi"
+        )
+        # the tile and forward cache's file operations, so a slow SD card doesn't stall the event loop
+        self.cache_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=flask_app.config["ASYNC_CACHE_THREADS"],
+            thread_name_prefix="pisite-cache"
+        )
+        # created on first use, it has to belong to the running event loop
+        self.client: httpx.AsyncClient = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                self.pool.shutdown(wait=False)
+                self.cache_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+
+        if self.is_async_forward(scope):
+            # the body stays unread, it is streamed straight to main after the handoff
+            body = tempfile.SpooledTemporaryFile()
+            content_length = "0"
+        else:
+            body = await read_body(receive)
+            content_length = None
+
+        with body:
+            environ = build_environ(scope, body, content_length)
+            result = await loop.run_in_executor(self.pool, run_wsgi_app, self.wsgi_app, environ)
+            (_status, headers, _first_chunk, _iterator, closeable) = result
+
+            main_endpoint = get_header(headers, site.ASYNC_FORWARD_HEADER)
+            if main_endpoint is not None:
+                await loop.run_in_executor(self.pool, close_wsgi_result, closeable)
+                cache = get_header(headers, site.ASYNC_CACHE_HEADER)
+                if cache is None:
+                    await self.forward(scope, receive, send, main_endpoint, headers)
+                elif json.loads(cache)["cache"] == "tile":
+                    await self.forward_tile_cached(scope, send, environ, main_endpoint, json.loads(cache), headers)
+                else:
+                    await self.forward_short_cached(scope, send, environ, main_endpoint, json.loads(cache), headers)
+                return
+
+            stream_name = get_header(headers, site.ASYNC_STREAM_HEADER)
+            if stream_name is not None:
+                await loop.run_in_executor(self.pool, close_wsgi_result, closeable)
+                await self.stream_status(scope, receive, send, headers)
+                return
+
+            await self.send_wsgi_result(send, result)
+
+    # send what run_wsgi_app returned, reading the rest of the body in the thread pool
+    async def send_wsgi_result(self, send, result):
+        loop = asyncio.get_running_loop()
+        (status, headers, first_chunk, iterator, closeable) = result
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": encode_headers(headers)
+        })
+        try:
+            chunk = first_chunk
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(self.pool, next, iterator, None)
+            await send({"type": "http.response.body"})
+        finally:
+            await loop.run_in_executor(self.pool, close_wsgi_result, closeable)
+
+    # is the request routed to a view decorated with pisite.async_forward
+    def is_async_forward(self, scope) -> bool:
+        adapter = flask_app.url_map.bind(
+            "localhost",
+            path_info=scope["path"],
+            url_scheme=scope.get("scheme", "http")
+        )
+        try:
+            endpoint, _args = adapter.match(method=scope["method"])
+        except Exception:
+            # 404, 405, redirects, all handled by flask
+            return False
+        view = flask_app.view_functions.get(endpoint)
+        return getattr(view, "async_forward", False)
+
+    # async version of pisite.forward_to_main
+    async def forward(self, scope, receive, send, main_endpoint, handoff_headers):
+        main_response, error = await self.send_to_main(scope, receive, main_endpoint)
+        if error is not None:
+            await send_response_data(send, ResponseData(False, error), handoff_headers)
+            return
+        await self.relay(send, main_response, handoff_headers)
+
+    # async version of pisite.forward_to_main_cached, from where it has to ask main
+    async def forward_tile_cached(self, scope, send, environ, main_endpoint, cache, handoff_headers):
+        loop = asyncio.get_running_loop()
+        main_response, error = await self.send_to_main(scope, None, main_endpoint, cache["conditional_headers"])
+        if error is not None:
+            if cache["cached"] and await self.send_tile_entry(send, environ, cache["key"], "STALE", handoff_headers):
+                return
+            await send_response_data(send, ResponseData(False, error), handoff_headers)
+            return
+
+        if cache["cached"] and main_response.status_code == 304:
+            await main_response.aclose()
+            if await self.send_tile_entry(send, environ, cache["key"], "REVALIDATED", handoff_headers, revalidated_query=cache["query"]):
+                return
+            # evicted since flask looked, ask main for the whole thing
+            await self.forward_tile_cached(scope, send, environ, main_endpoint, dict(cache, cached=False, conditional_headers={
+                "If-None-Match": None,
+                "If-Modified-Since": None
+            }), handoff_headers)
+            return
+
+        if main_response.status_code != 200 or "no-store" in main_response.headers.get("Cache-Control", ""):
+            await self.relay(send, main_response, handoff_headers)
+            return
+
+        headers = site.filter_hop_by_hop_headers(main_response.headers.multi_items())
+        try:
+            writer = await loop.run_in_executor(self.cache_pool, site.tile_cache.put, cache["key"], main_response.status_code, headers, cache["query"])
+        except BaseException:
+            await main_response.aclose()
+            raise
+        await self.relay(send, main_response, handoff_headers, writer)
+
+    # serve the tile cache's entry for key like pisite.cached_response
+    # returns False without sending anything if there's no entry
+    async def send_tile_entry(self, send, environ, key, cache_state, handoff_headers, revalidated_query=None) -> bool:
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(self.cache_pool, site.tile_cache.get, key)
+        if entry is None:
+            return False
+        if revalidated_query is not None:
+            await loop.run_in_executor(self.cache_pool, site.tile_cache.revalidated, entry, revalidated_query)
+        # the entry's file is read by the wsgi response, in the thread pool
+        result = await loop.run_in_executor(self.pool, run_response, environ, handoff_headers,
+            site.cached_response, entry, cache_state, environ)
+        await self.send_wsgi_result(send, result)
+        return True
+
+    # async version of pisite.forward_to_main_short_cached, for a miss
+    # waits for whoever is fetching the same key, in any worker, by polling the lock instead of blocking on it
+    async def forward_short_cached(self, scope, send, environ, main_endpoint, cache, handoff_headers):
+        loop = asyncio.get_running_loop()
+        (key, ttl) = (cache["key"], cache["ttl"])
+        cache_state = "MISS"
+        while True:
+            cached = await loop.run_in_executor(self.cache_pool, site.forward_cache.lookup, key, ttl)
+            if cached is not None:
+                break
+            lock_file = await loop.run_in_executor(self.cache_pool, site.forward_cache.try_lock, key)
+            if lock_file is None:
+                cache_state = "COALESCED"
+                await asyncio.sleep(FORWARD_CACHE_POLL_INTERVAL)
+                continue
+            try:
+                # whoever held the lock before may have just fetched it
+                cached = await loop.run_in_executor(self.cache_pool, site.forward_cache.lookup, key, ttl)
+                if cached is not None:
+                    cache_state = "COALESCED"
+                    break
+                cache_state = "MISS"
+                cached, error = await self.fetch_short(scope, main_endpoint)
+                if error is not None:
+                    await send_response_data(send, ResponseData(False, error), handoff_headers)
+                    return
+                await loop.run_in_executor(self.cache_pool, site.forward_cache.store, key, cached)
+            finally:
+                lock_file.close()
+            await loop.run_in_executor(self.cache_pool, site.forward_cache.sweep)
+            break
+
+        result = await loop.run_in_executor(self.pool, run_response, environ, handoff_headers,
+            site.short_cached_response, cached, cache_state, environ)
+        await self.send_wsgi_result(send, result)
+
+    # main's whole answer for a forward cache entry
+    # returns (responsecache.CachedResponse, None) or (None, error message)
+    async def fetch_short(self, scope, main_endpoint):
+        # the client's validators are for its own cache
+        main_response, error = await self.send_to_main(scope, None, main_endpoint, {"If-None-Match": None, "If-Modified-Since": None})
+        if error is not None:
+            return None, error
+        try:
+            # undecoded, so Content-Encoding and Content-Length stay valid
+            body = b"".join([chunk async for chunk in main_response.aiter_raw(flask_app.config["FORWARD_CHUNK_SIZE"])])
+        except httpx.TimeoutException:
+            return None, "connection to main timed out"
+        except httpx.HTTPError:
+            return None, "unable to connect to main"
+        finally:
+            await main_response.aclose()
+        headers = site.filter_hop_by_hop_headers(main_response.headers.multi_items())
+        return responsecache.CachedResponse(main_response.status_code, list(headers.items()), body, time.time()), None
+
+    # async version of pisite.request_main, streaming the request's body to main if receive is given
+    # extra_headers replace the client's, None removes one
+    # returns (the response with its body unread, None) or (None, error message)
+    async def send_to_main(self, scope, receive, main_endpoint, extra_headers: dict=None):
+        main_url = "https://{}:{}/{}".format(
+            flask_app.config["MAIN_IP"],
+            flask_app.config["MAIN_PORT"],
+            main_endpoint
+        )
+        if scope["query_string"]:
+            main_url = "{}?{}".format(main_url, scope["query_string"].decode("latin-1"))
+
+        request_headers = [(key.decode("latin-1"), val.decode("latin-1")) for (key, val) in scope["headers"]]
+        new_headers = site.filter_hop_by_hop_headers(request_headers, ["host", site.ASYNC_HANDOFF_HEADER.lower()])
+        if extra_headers is not None:
+            for (key, val) in extra_headers.items():
+                # header names from the asgi server are lowercase
+                for name in [name for name in new_headers if name.lower() == key.lower()]:
+                    del new_headers[name]
+                if val is not None:
+                    new_headers[key] = val
+        new_headers["Api-key"] = flask_app.config["PI_API_KEY"]
+
+        content = None
+        if receive is not None and (get_header(request_headers, "Content-Length") not in (None, "0")
+                or get_header(request_headers, "Transfer-Encoding") is not None):
+            content = stream_body(receive)
+
+        started = time.perf_counter()
+        if not site.main_circuit.allow():
+            metrics.record_forward(metrics.CIRCUIT_OPEN, started)
+            return None, site.main_circuit.message()
+
+        client = self.get_client()
+        try:
+            main_request = client.build_request(scope["method"], main_url, headers=new_headers, content=content)
+            main_response = await client.send(main_request, stream=True)
+        except httpx.TimeoutException:
+            site.main_circuit.record_failure()
+            metrics.record_forward(metrics.TIMEOUT, started)
+            return None, "connection to main timed out"
+        except httpx.TransportError:
+            site.main_circuit.record_failure()
+            metrics.record_forward(metrics.CONNECTION_ERROR, started)
+            return None, "unable to connect to main"
+        site.main_circuit.record_success()
+        metrics.record_forward(metrics.SUCCESS, started)
+        return main_response, None
+
+    # relay main's response chunk by chunk, writing it to the tile cache too if writer is given
+    # only a complete body is committed to the cache
+    async def relay(self, send, main_response, handoff_headers, writer=None):
+        loop = asyncio.get_running_loop()
+        try:
+            # keep what flask added to the handoff response (session cookie, talisman)
+            headers = list(site.filter_hop_by_hop_headers(main_response.headers.multi_items()).items())
+            headers += handoff_extra_headers(handoff_headers)
+            if writer is not None:
+                headers.append(("X-Pisite-Cache", "MISS"))
+
+            await send({
+                "type": "http.response.start",
+                "status": main_response.status_code,
+                "headers": encode_headers(headers)
+            })
+            try:
+                # undecoded, like the sync forward
+                async for chunk in main_response.aiter_raw(flask_app.config["FORWARD_CHUNK_SIZE"]):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    if writer is not None:
+                        await loop.run_in_executor(self.cache_pool, writer.write, chunk)
+                if writer is not None:
+                    await loop.run_in_executor(self.cache_pool, writer.commit)
+            except httpx.HTTPError as e:
+                # headers are already sent, all that can be done is cutting the body short
+                print("main response interrupted: {}".format(e))
+            await send({"type": "http.response.body"})
+        finally:
+            if writer is not None:
+                # not in the executor, it has to run even if this task is cancelled, and it's only a close and an unlink
+                writer.discard()
+            await main_response.aclose()
+
+    # async version of pisite.status_events, without a time limit since it doesn't hold a thread
+    async def stream_status(self, scope, receive, send, handoff_headers):
+        feed = site.status_feed
+        heartbeat = flask_app.config["STATUS_STREAM_HEARTBEAT"]
+        request_headers = [(key.decode("latin-1"), val.decode("latin-1")) for (key, val) in scope["headers"]]
+        version = statusfeed.parse_last_event_id(get_header(request_headers, "Last-Event-ID"))
+
+        headers = [(key, val) for (key, val) in handoff_headers if key.lower() not in (
+            site.ASYNC_STREAM_HEADER.lower(), "content-length", "content-type")]
+        headers.append(("Content-Type", "text/event-stream; charset=utf-8"))
+        headers.append(("Cache-Control", "no-cache"))
+
+        # the client going away is only noticed by receiving http.disconnect
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        feed.watch()
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": encode_headers(headers)})
+            await send_event(send, statusfeed.format_retry(flask_app.config["STATUS_STREAM_RETRY"]))
+            last_sent = time.monotonic()
+            while not disconnected.done():
+                state = feed.current
+                if state is not None and state["version"] != version:
+                    version = state["version"]
+                    await send_event(send, statusfeed.format_event(state))
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= heartbeat:
+                    await send_event(send, statusfeed.KEEPALIVE_EVENT)
+                    last_sent = time.monotonic()
+                # same pace as the feed's own watching thread
+                await asyncio.wait([disconnected], timeout=statusfeed.WATCH_INTERVAL)
+        except OSError:
+            # gone while sending
+            pass
+        finally:
+            feed.unwatch()
+            disconnected.cancel()
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            certfile = flask_app.config["PATH_TO_MAIN_CERTFILE"]
+            self.client = httpx.AsyncClient(
+                verify=ssl.create_default_context(cafile=certfile) if isinstance(certfile, str) else certfile,
+                timeout=site.request_timeout,
+                limits=httpx.Limits(
+                    max_connections=flask_app.config["ASYNC_MAX_UPSTREAM_CONNECTIONS"],
+                    max_keepalive_connections=flask_app.config["ASYNC_MAX_UPSTREAM_CONNECTIONS"]
+                ),
+                trust_env=False
+            )
+        return self.client
+
+## helper code
+
+async def read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.write(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body.seek(0)
+    return body
+
+async def stream_body(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        yield message.get("body", b"")
+        if not message.get("more_body"):
+            return
+
+async def send_response_data(send, response_data: ResponseData, handoff_headers):
+    body = json.dumps(asdict(response_data)).encode("utf-8")
+    headers = handoff_extra_headers(handoff_headers)
+    headers.append(("Content-Type", "application/json"))
+    headers.append(("Content-Length", str(len(body))))
+    await send({"type": "http.response.start", "status": 200, "headers": encode_headers(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def send_event(send, event):
+    await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+
+# https://peps.python.org/pep-3333/#environ-variables
+def build_environ(scope, body, content_length=None) -> dict:
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1]) if server[1] is not None else "80"
+
+    client = scope.get("client")
+    if client is not None:
+        environ["REMOTE_ADDR"] = client[0]
+        environ["REMOTE_PORT"] = str(client[1])
+
+    for (key, val) in scope["headers"]:
+        key = key.decode("latin-1")
+        val = val.decode("latin-1")
+        if key == site.ASYNC_HANDOFF_HEADER.lower():
+            # only trust the one set below
+            continue
+        if key == "content-type":
+            environ["CONTENT_TYPE"] = val
+        elif key == "content-length":
+            environ["CONTENT_LENGTH"] = val
+        else:
+            name = "HTTP_" + key.upper().replace("-", "_")
+            if name in environ:
+                val = environ[name] + "," + val
+            environ[name] = val
+
+    if content_length is not None:
+        environ["CONTENT_LENGTH"] = content_length
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+
+    environ["HTTP_" + site.ASYNC_HANDOFF_HEADER.upper().replace("-", "_")] = flask_app.config["ASYNC_HANDOFF_TOKEN"]
+
+    return environ
+
+# runs in the thread pool
+# returns status, headers, the first chunk of the body, an iterator for the rest, and the result to close
+def run_wsgi_app(wsgi_app, environ):
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = wsgi_app(environ, start_response)
+    iterator = iter(result)
+    # start_response may be delayed until the first chunk
+    first_chunk = next(iterator, None)
+
+    return started["status"], started["headers"], first_chunk, iterator, result
+
+def close_wsgi_result(result):
+    if hasattr(result, "close"):
+        result.close()
+
+# the headers of a forward handoff response that go on the final response (session cookie, talisman)
+def handoff_extra_headers(handoff_headers) -> list:
+    excluded = (site.ASYNC_FORWARD_HEADER.lower(), site.ASYNC_CACHE_HEADER.lower(), "content-length", "content-type")
+    return [(key, val) for (key, val) in handoff_headers if key.lower() not in excluded]
+
+# runs in the thread pool
+# runs the flask response make_response(*args) returns as a wsgi app, returns like run_wsgi_app
+def run_response(environ, handoff_headers, make_response, *args):
+    response = make_response(*args)
+    for (key, val) in handoff_extra_headers(handoff_headers):
+        response.headers.add(key, val)
+    return run_wsgi_app(response, environ)
+
+def get_header(headers, name):
+    for (key, val) in headers:
+        if key.lower() == name.lower():
+            return val
+    return None
+
+def encode_headers(headers) -> list:
+    return [(key.lower().encode("latin-1"), val.encode("latin-1")) for (key, val) in headers]
+
+app = App(flask_app)
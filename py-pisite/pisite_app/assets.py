@@ -0,0 +1,159 @@
+# serves the react build directory from an index made at startup
+# every file gets a strong ETag from its contents, and gzip/brotli variants picked by Accept-Encoding,
+# either pre-generated next to it (main.js.gz, main.js.br) or generated once into a cache directory
+# files with a content hash in their name are cached by browsers forever, others are revalidated
+# index.html is kept in memory
+# the build is only indexed once, restart after deploying a new one
+
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+
+import flask
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# e.g. main.3f2a9c1b.js, 787.5ab3c9e0.chunk.css
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+
+# worth compressing, images and fonts are already compressed
+COMPRESSIBLE_TYPES = re.compile(r"^(text/.*|application/(javascript|json|xml|manifest\+json)|image/svg\+xml)$")
+
+# preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+class Asset():
+    def __init__(self, path, relative_path, digest, mimetype):
+        self.path = path
+        self.relative_path = relative_path
+        self.etag = digest[:32]
+        self.mimetype = mimetype
+        self.variants = dict() # encoding: path
+        self.in_memory = dict() # encoding (or None for identity): bytes
+        immutable = HASHED_NAME.search(os.path.basename(relative_path)) is not None
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+
+class AssetIndex():
+    def __init__(self, base_dir, cache_dir, compress_min_bytes, in_memory=("index.html",)):
+        self.base_dir = os.path.abspath(base_dir)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.compress_min_bytes = compress_min_bytes
+        self.assets = dict() # relative path: Asset
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        for (dir_path, _dir_names, file_names) in os.walk(self.base_dir):
+            for file_name in file_names:
+                if file_name.endswith(".gz") or file_name.endswith(".br"):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                relative_path = os.path.relpath(path, self.base_dir).replace(os.sep, "/")
+                self.assets[relative_path] = self._index(path, relative_path, relative_path in in_memory)
+
+        self._prune()
+
+    # response for a file in the build directory, 404 if it isn't in the index
+    def serve(self, relative_path) -> flask.Response:
+        asset = self.assets.get(relative_path)
+        if asset is None:
+            flask.abort(404)
+
+        encoding = self._pick_encoding(asset)
+        # each encoding is a different representation, so it needs its own strong ETag
+        etag = asset.etag if encoding is None else "{}-{}".format(asset.etag, encoding)
+
+        if encoding in asset.in_memory:
+            response: flask.Response = flask.Response(asset.in_memory[encoding], mimetype=asset.mimetype)
+        else:
+            path = asset.path if encoding is None else asset.variants[encoding]
+            file = open(path, "rb")
+            # lets the server use sendfile when it can
+            response: flask.Response = flask.Response(
+                wrap_file(flask.request.environ, file),
+                mimetype=asset.mimetype,
+                direct_passthrough=True
+            )
+            response.content_length = os.fstat(file.fileno()).st_size
+
+        if encoding is not None:
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = asset.cache_control
+
+        return response.make_conditional(flask.request)
+
+    def _pick_encoding(self, asset: Asset):
+        accepted = flask.request.accept_encodings
+        for (encoding, _suffix) in ENCODINGS:
+            if encoding in asset.variants and accepted.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def _index(self, path, relative_path, in_memory) -> Asset:
+        with open(path, "rb") as file:
+            data = file.read()
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        asset = Asset(path, relative_path, hashlib.sha256(data).hexdigest(), mimetype)
+
+        compressible = len(data) >= self.compress_min_bytes and COMPRESSIBLE_TYPES.match(mimetype) is not None
+        for (encoding, suffix) in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                # pre-generated by the build
+                asset.variants[encoding] = path + suffix
+            elif compressible:
+                variant_path = self._generate(data, asset.etag, encoding, suffix)
+                if variant_path is not None:
+                    asset.variants[encoding] = variant_path
+
+        if in_memory:
+            asset.in_memory[None] = data
+            for (encoding, variant_path) in asset.variants.items():
+                with open(variant_path, "rb") as file:
+                    asset.in_memory[encoding] = file.read()
+
+        return asset
+
+    # remove variants generated for previous builds
+    def _prune(self):
+        in_use = set()
+        for asset in self.assets.values():
+            in_use.update(asset.variants.values())
+        for entry in os.scandir(self.cache_dir):
+            # temporary files may belong to another worker starting up
+            if entry.name.endswith(".tmp") or entry.path in in_use:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # compressed copy in the cache directory, named by content hash so it's only made once per build
+    # returns None if it can't be made or isn't smaller
+    def _generate(self, data, etag, encoding, suffix):
+        variant_path = os.path.join(self.cache_dir, etag + suffix)
+        if os.path.isfile(variant_path):
+            return variant_path
+
+        if encoding == "gzip":
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        elif encoding == "br" and brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+        else:
+            return None
+        if len(compressed) >= len(data):
+            return None
+
+        temp_path = "{}.{}.tmp".format(variant_path, os.getpid())
+        with open(temp_path, "wb") as file:
+            file.write(compressed)
+        os.replace(temp_path, variant_path)
+        return variant_path
@@ -8,11 +8,13 @@ import sqlalchemy
 from sqlalchemy import create_engine, ForeignKey, select
 from sqlalchemy import Column, Date, Integer, String, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, object_session
+from sqlalchemy.orm import sessionmaker, relationship, object_session, selectinload, joinedload
 import datetime
 
 from flask_sqlalchemy import SQLAlchemy
 
+import pisite_app.hashing as hashing
+
 # https://stackoverflow.com/a/9695045
 db = SQLAlchemy()
 
@@ -165,7 +167,7 @@ class RegKey(db.Model):
         details = dict()
         details["text"] = self.text
         details["note"] = self.note
-        details["user"] = self.user
+        details["user"] = None if self.user is None else self.user.username
         details["expiry"] = self.expiry
         details["groups"] = list()
         for group in self.groups:
@@ -197,6 +199,7 @@ def attempt_add_user(username, plain_password, reg_key_text) -> (bool, str):
         
     return _add_user(username, plain_password, reg_key_text, force=False)
 
+# raises hashing.HashingBusyError if too many logins are being checked
 def validate_user(username, plain_password) -> (bool, str):
     user = User.query.filter(User.username == username).first() # only one should exist anyways
             
@@ -207,10 +210,10 @@ def validate_user(username, plain_password) -> (bool, str):
     salt = user.salt
     hashed_password_real = user.password
 
-    hashed_password_input, _ = _hash_password(plain_password, salt)
+    hashed_password_input, _ = hashing.run(_hash_password, plain_password, salt)
 
     # compare the hashed passwords
-    valid = hashed_password_input == hashed_password_real
+    valid = secrets.compare_digest(hashed_password_input, hashed_password_real)
 
     if valid:
         return True, user
@@ -244,15 +247,58 @@ def remove_user(username):
 def get_user(user_id):
     return User.query.filter(User.id == user_id).first()
 
+# username and group names of a user, in a single query
+# returns None if the user doesn't exist
+def get_user_auth_details(user_id) -> (str, list):
+    rows = db.session.query(User.username, Group.name) \
+        .outerjoin(User.groups) \
+        .filter(User.id == user_id) \
+        .all()
+    if len(rows) == 0:
+        return None
+
+    username = rows[0][0]
+    group_names = [group_name for (_username, group_name) in rows if group_name is not None]
+    return username, group_names
+
+# relationships are loaded with the rows, so to_detail_dict doesn't query per row
 def get_users():
-    return User.query.all()
+    return User.query.options(selectinload(User.groups)).order_by(User.id).all()
 
 def get_groups():
-    return Group.query.all()
+    return Group.query.options(selectinload(Group.users)).order_by(Group.id).all()
 
 def get_reg_keys():
-    return RegKey.query.all()
-
+    return RegKey.query.options(selectinload(RegKey.groups), joinedload(RegKey.user)).order_by(RegKey.id).all()
+
+# pages for the admin listing, ordered by id
+# after_id is the id of the last row of the previous page (None for the first page)
+# returns the rows, and whether there are more after them
+
+def list_users(after_id, limit, username_contains=None, group=None) -> (list, bool):
+    query = User.query.options(selectinload(User.groups))
+    if username_contains:
+        query = query.filter(User.username.contains(username_contains, autoescape=True))
+    if group:
+        query = query.filter(User.groups.any(Group.name == group))
+    return _page(query, User.id, after_id, limit)
+
+def list_groups(after_id, limit, name_contains=None) -> (list, bool):
+    query = Group.query.options(selectinload(Group.users))
+    if name_contains:
+        query = query.filter(Group.name.contains(name_contains, autoescape=True))
+    return _page(query, Group.id, after_id, limit)
+
+# used: True for keys someone registered with, False for unused ones
+def list_reg_keys(after_id, limit, group=None, used=None) -> (list, bool):
+    query = RegKey.query.options(selectinload(RegKey.groups), joinedload(RegKey.user))
+    if group:
+        query = query.filter(RegKey.groups.any(Group.name == group))
+    if used is not None:
+        query = query.filter(RegKey.user_id.isnot(None) if used else RegKey.user_id.is_(None))
+    return _page(query, RegKey.id, after_id, limit)
+
+# raises hashing.HashingBusyError if too many passwords are being hashed
 def change_password(user: User, new_password) -> (bool, str):
     
     if user is None:
@@ -261,7 +307,7 @@ def change_password(user: User, new_password) -> (bool, str):
         return False, "password not strong enough" 
 
     # make new salt too
-    hashed_password, salt = _hash_password(new_password, None)
+    hashed_password, salt = hashing.run(_hash_password, new_password, None)
 
     user.password = hashed_password
     user.salt = salt
@@ -271,6 +317,7 @@ def change_password(user: User, new_password) -> (bool, str):
 
     return True, user.username
 
+# cpu heavy, run it through hashing.run
 def _hash_password(plain_password, salt=None) -> (str, str):
     # split on '$' and pick last element to ignore $2b$12
     hash_combo = passlib.hash.bcrypt.using(salt=salt).hash(plain_password).split('$')[-1]
@@ -293,7 +340,7 @@ def _add_user(username, plain_password, reg_key_text, force=False) -> (bool, str
     if reg_key is None and not force:
         return False, "bad reg_key"
 
-    hashed_password, salt = _hash_password(plain_password)
+    hashed_password, salt = hashing.run(_hash_password, plain_password)
     user = User(username, hashed_password, salt, reg_key)
 
     db.session.add(user)
@@ -301,6 +348,13 @@ def _add_user(username, plain_password, reg_key_text, force=False) -> (bool, str
 
     return True, username
 
+def _page(query, id_column, after_id, limit) -> (list, bool):
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    # one extra row tells whether there is another page
+    rows = query.order_by(id_column).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
 def _is_password_strong_enough(plain_password, context: list) -> bool:
     results = zxcvbn.zxcvbn(plain_password, user_inputs=context)
 
@@ -0,0 +1,102 @@
+# who is making the request, without a database query on every request
+# the user's name and groups are resolved once per request (kept in flask.g),
+# and reused across requests by each worker for AUTH_CACHE_TTL seconds
+# any committed change to users or group membership invalidates the cache in every worker,
+# by touching a shared generation file
+
+import os
+import time
+import threading
+from dataclasses import dataclass
+from typing import FrozenSet
+
+import flask
+import sqlalchemy
+import sqlalchemy.orm
+
+import pisite_app.auth as auth
+
+@dataclass(frozen=True)
+class AuthContext():
+    user_id: int
+    username: str
+    groups: FrozenSet[str]
+
+_lock = threading.Lock()
+_cache = dict() # user_id: (AuthContext, loaded_at, generation)
+
+# returns None if not logged in
+def current() -> AuthContext:
+    if "auth_context" in flask.g:
+        return flask.g.auth_context
+
+    context = None
+    user_id = flask.session.get("user_id")
+    if user_id is not None:
+        context = get(user_id)
+
+    flask.g.auth_context = context
+    return context
+
+# returns None if the user doesn't exist
+def get(user_id) -> AuthContext:
+    generation = _generation()
+    now = time.time()
+    with _lock:
+        cached = _cache.get(user_id)
+    if cached is not None:
+        (context, loaded_at, cached_generation) = cached
+        if cached_generation == generation and now - loaded_at < flask.current_app.config["AUTH_CACHE_TTL"]:
+            return context
+
+    details = auth.get_user_auth_details(user_id)
+    if details is None:
+        with _lock:
+            _cache.pop(user_id, None)
+        return None
+
+    (username, group_names) = details
+    context = AuthContext(user_id, username, frozenset(group_names))
+    with _lock:
+        _cache[user_id] = (context, now, generation)
+    return context
+
+# drop every cached context, in every worker
+def invalidate():
+    with _lock:
+        _cache.clear()
+    path = _generation_path()
+    with open(path, "a"):
+        os.utime(path, None)
+
+def _generation_path():
+    return os.path.abspath(flask.current_app.config["AUTH_CACHE_GENERATION_FILE"])
+
+# changes whenever invalidate() is called by any process
+def _generation():
+    try:
+        return os.stat(_generation_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+# models whose changes affect an AuthContext
+_AUTH_MODELS = (auth.User, auth.Group, auth.GroupUser)
+
+def init_app(app: flask.Flask):
+    # remember flushes touching users or groups, invalidate once they are committed
+    @sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_flush")
+    def after_flush(session, _flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, _AUTH_MODELS):
+                session.info["auth_changed"] = True
+                return
+
+    @sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+    def after_commit(session):
+        if session.info.pop("auth_changed", False):
+            with app.app_context():
+                invalidate()
+
+    @sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("auth_changed", None)
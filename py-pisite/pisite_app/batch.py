@@ -0,0 +1,91 @@
+# batched GETs, used by /api/batch on both the pi and main
+# the batch request is authenticated once, then each sub-request is matched against the app's
+# routes and its view function called directly in a thread, sharing the batch's session
+# sub-requests are GETs only, so they can't change the session or each other's state
+#
+# request body: {"requests": [{"id": "anything", "path": "/api/..."}, ...]}
+# response data: {"responses": [{"id": ..., "status": 200, "body": json or null}, ...]} in the same order
+
+import concurrent.futures
+
+import flask
+import flask.ctx
+import flask.testing
+
+class SubRequest():
+    def __init__(self, id, path):
+        self.id = id
+        self.path = path
+
+# returns (list of SubRequest, None), or (None, error message)
+def parse(data, max_requests) -> (list, str):
+    if not isinstance(data, dict) or not isinstance(data.get("requests"), list):
+        return None, "must include a requests list"
+    if len(data["requests"]) > max_requests:
+        return None, "at most {} requests per batch".format(max_requests)
+
+    sub_requests = []
+    for item in data["requests"]:
+        if not isinstance(item, dict) or not isinstance(item.get("path"), str) or not item["path"].startswith("/api/"):
+            return None, "each request needs a path starting with /api/"
+        if str(item.get("method", "GET")).upper() != "GET":
+            return None, "only GET requests can be batched"
+        sub_requests.append(SubRequest(item.get("id"), item["path"]))
+    return sub_requests, None
+
+def response(sub_request: SubRequest, status, body) -> dict:
+    return {"id": sub_request.id, "status": status, "body": body}
+
+def error_response(sub_request: SubRequest, message, status=200) -> dict:
+    return response(sub_request, status, {"success": False, "message": message, "data": {}})
+
+# run sub-requests at the same time, returns their responses in order
+# must be called inside the batch's request
+def run(pool: concurrent.futures.ThreadPoolExecutor, sub_requests: list) -> list:
+    return [future.result() for future in submit(pool, sub_requests)]
+
+# like run, returns a future for each response instead of waiting
+def submit(pool: concurrent.futures.ThreadPoolExecutor, sub_requests: list) -> list:
+    app = flask.current_app._get_current_object()
+    session = flask.session._get_current_object()
+    # anything the batch's before_request worked out, e.g. the logged in user
+    g_values = dict(flask.g.__dict__)
+    # the batch's own body
+    g_values.pop("request_data", None)
+    base_url = flask.request.host_url
+    return [pool.submit(dispatch, app, session, g_values, base_url, sub_request) for sub_request in sub_requests]
+
+# one sub-request, in its own request context
+def dispatch(app: flask.Flask, session, g_values, base_url, sub_request: SubRequest) -> dict:
+    path, _, query_string = sub_request.path.partition("?")
+    builder = flask.testing.EnvironBuilder(app, path, base_url=base_url, method="GET", query_string=query_string)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    # reuse the batch's session instead of loading it again
+    context = flask.ctx.RequestContext(app, environ, session=session)
+    with context:
+        flask.g.__dict__.update(g_values)
+        request = flask.request
+        if request.routing_exception is not None:
+            return error_response(sub_request, "no such endpoint", getattr(request.routing_exception, "code", 404))
+
+        view = app.view_functions[request.url_rule.endpoint]
+        if getattr(view, "batch_excluded", False):
+            return error_response(sub_request, "can't be batched", 400)
+        try:
+            result = app.make_response(view(**request.view_args))
+        except Exception as e:
+            print("batched request {} failed: {}".format(sub_request.path, e))
+            return error_response(sub_request, "internal error", 500)
+
+        try:
+            return response(sub_request, result.status_code, result.get_json(silent=True))
+        finally:
+            result.close()
+
+# function decorator for views that can't run inside a batch
+def exclude(func):
+    func.batch_excluded = True
+    return func
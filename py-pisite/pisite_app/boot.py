@@ -0,0 +1,212 @@
+# powers main on with Wake-on-LAN and follows the boot until main's services answer
+# power-on requests from any worker while a boot is underway join that boot instead of starting another,
+# the magic packet is re-sent with backoff until main answers pings, and the time each phase was
+# reached is kept so finished boots teach the estimate for the next one
+# the boot is shared by all worker processes through a small state file, and driven by one of them at a time
+
+import os
+import json
+import time
+import fcntl
+import threading
+import contextlib
+import statistics
+
+# phases of a boot, in order
+SENT = "sent" # magic packet sent, nothing answers yet
+PINGABLE = "pingable" # the host is on
+ACK = "ack" # main's app answers /api/ack
+READY = "ready" # main's services answer too
+PHASES = [SENT, PINGABLE, ACK, READY]
+# a boot that didn't reach READY in time
+FAILED = "failed"
+
+# how often the driving worker checks on a boot
+POLL_INTERVAL = 1 # seconds
+
+class BootOrchestrator():
+    # send_packet sends the magic packet, raises ValueError for an invalid MAC address
+    # probe returns a powerprobe.PowerProbe result, services_ready returns whether main's services answer
+    # on_ack is called once main's app answers
+    def __init__(self, state_path, send_packet, probe, services_ready, on_ack,
+            resend_initial, resend_max, timeout, history_size):
+        self.state_path = os.path.abspath(state_path)
+        self.send_packet = send_packet
+        self.probe = probe
+        self.services_ready = services_ready
+        self.on_ack = on_ack
+        self.resend_initial = resend_initial
+        self.resend_max = resend_max
+        self.timeout = timeout
+        self.history_size = history_size
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread_pid = None # threads don't survive a fork, so this is checked against os.getpid()
+
+    # start a boot, or join the one already underway
+    # returns (status, whether a boot was already underway), see status()
+    def power_on(self) -> (dict, bool):
+        self.ensure_started()
+        with self._state_lock():
+            state = self._read()
+            boot = state["boot"]
+            if boot is not None and boot["phase"] not in (READY, FAILED):
+                return self._status(state), True
+
+            now = time.time()
+            self.send_packet()
+            state["boot"] = {
+                "phase": SENT,
+                "requested_at": now,
+                "phases": {SENT: now},
+                "packets_sent": 1,
+                "next_send_at": now + self.resend_initial,
+                "resend_interval": self.resend_initial
+            }
+            self._write(state)
+        self.wake.set()
+        return self._status(state), False
+
+    # {"phase": ... or None if main was never booted, "requested_at": unix time,
+    #  "phases": {phase: unix time reached}, "packets_sent": int,
+    #  "eta": {phase: unix time expected} for phases not reached yet, from past boots}
+    def status(self) -> dict:
+        self.ensure_started()
+        return self._status(self._read())
+
+    # start the driving thread in this process, if it isn't already running
+    def ensure_started(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="pisite-boot", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                if self._in_progress():
+                    self._maybe_drive()
+            except Exception as e:
+                print("boot orchestrator failed: {}".format(e))
+            self.wake.wait(POLL_INTERVAL)
+            self.wake.clear()
+
+    def _in_progress(self) -> bool:
+        boot = self._read()["boot"]
+        return boot is not None and boot["phase"] not in (READY, FAILED)
+
+    # drive the boot until it's done, unless another process already is
+    # the driver lock is released if this process dies, and another worker takes over
+    def _maybe_drive(self):
+        with open(self.state_path + ".driver", "w") as driver_file:
+            try:
+                fcntl.flock(driver_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            while self._step():
+                time.sleep(POLL_INTERVAL)
+
+    # one check of the boot, returns whether it's still underway
+    def _step(self) -> bool:
+        boot = self._read()["boot"]
+        if boot is None or boot["phase"] in (READY, FAILED):
+            return False
+
+        # outside the state lock, probes take a while
+        now = time.time()
+        reached = set(boot["phases"])
+        result = self.probe()
+        if result["pingable"] or result["connectable"]:
+            reached.add(PINGABLE)
+        if result["connectable"]:
+            reached.add(ACK)
+        if ACK in reached and self.services_ready():
+            reached.add(READY)
+        resend = PINGABLE not in reached and now >= boot["next_send_at"]
+        if resend:
+            try:
+                self.send_packet()
+            except Exception as e:
+                print("failed to resend magic packet: {}".format(e))
+
+        with self._state_lock():
+            state = self._read()
+            boot = state["boot"]
+            if boot is None or boot["phase"] in (READY, FAILED):
+                return False
+
+            if resend:
+                boot["packets_sent"] += 1
+                boot["resend_interval"] = min(boot["resend_interval"] * 2, self.resend_max)
+                boot["next_send_at"] = now + boot["resend_interval"]
+            # later phases imply the earlier ones, even if a probe missed them
+            newly_reached = []
+            latest = max(PHASES.index(phase) for phase in reached)
+            for phase in PHASES[:latest + 1]:
+                if phase not in boot["phases"]:
+                    boot["phases"][phase] = now
+                    newly_reached.append(phase)
+            boot["phase"] = PHASES[latest]
+
+            if boot["phase"] == READY:
+                # learn from this boot for the next estimate
+                state["history"].append({
+                    phase: reached_at - boot["requested_at"] for (phase, reached_at) in boot["phases"].items()
+                })
+                state["history"] = state["history"][-self.history_size:]
+            elif now - boot["requested_at"] > self.timeout:
+                boot["phase"] = FAILED
+                boot["phases"][FAILED] = now
+                newly_reached.append(FAILED)
+            self._write(state)
+
+        for phase in newly_reached:
+            print("boot of main: {} after {:.0f} seconds".format(phase, now - boot["requested_at"]))
+        if ACK in newly_reached:
+            self.on_ack()
+        return boot["phase"] not in (READY, FAILED)
+
+    def _status(self, state) -> dict:
+        boot = state["boot"]
+        if boot is None:
+            return {"phase": None, "requested_at": None, "phases": {}, "packets_sent": 0, "eta": {}}
+
+        eta = {}
+        if boot["phase"] not in (READY, FAILED):
+            for phase in PHASES:
+                durations = [past[phase] for past in state["history"] if phase in past]
+                if phase not in boot["phases"] and len(durations) > 0:
+                    eta[phase] = boot["requested_at"] + statistics.median(durations)
+        return {
+            "phase": boot["phase"],
+            "requested_at": boot["requested_at"],
+            "phases": boot["phases"],
+            "packets_sent": boot["packets_sent"],
+            "eta": eta
+        }
+
+    # exclusive across all threads and processes for the duration of a with block
+    @contextlib.contextmanager
+    def _state_lock(self):
+        with open(self.state_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield lock_file
+
+    # {"boot": the latest boot or None, "history": [{phase: seconds after the request}] of finished boots}
+    def _read(self) -> dict:
+        try:
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return {"boot": None, "history": []}
+
+    # write then rename, readers never see a partial file
+    def _write(self, state):
+        temp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,712 @@
+# persistent, multiplexed connection between the pi and main over mutual TLS
+# each pi worker keeps one connection open to main's channel server and sends every forwarded
+# request over it as a stream of frames, so requests don't pay for a TCP connection and TLS handshake,
+# and any number of them can be in flight at once
+# both sides present certificates, main only accepts the pi's
+#
+# frame: 4 byte payload length, 1 byte type, 4 byte stream id, payload
+# a request is REQUEST (json: method, path, query, headers), any number of DATA, then END
+# a response is RESPONSE (json: status, headers), any number of DATA, then END
+# either side can abort a stream with RESET, PING/PONG on stream 0 keep the connection alive
+# DATA is flow controlled per stream, a side sends at most STREAM_WINDOW bytes of it beyond what the other side's
+# consumer has taken, which gives them back with WINDOW (4 byte size) as it takes them,
+# so a slow consumer stops the sender instead of its frames piling up in memory
+#
+# on main, run the server next to the https one: `PISITE_MODE=MAIN python -m pisite_app.channel`
+
+import io
+import os
+import ssl
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import selectors
+import threading
+import concurrent.futures
+
+from werkzeug.datastructures import Headers
+
+FRAME_HEADER = struct.Struct("!IBI")
+WINDOW_PAYLOAD = struct.Struct("!I")
+
+# frame types
+REQUEST = 1
+RESPONSE = 2
+DATA = 3
+END = 4
+RESET = 5
+PING = 6
+PONG = 7
+WINDOW = 8
+# never sent, queued for a stream when its connection closes
+CLOSED = 0
+
+MAX_PAYLOAD = 1024 * 1024 # bytes, bigger frames are a protocol error
+MAX_DATA_FRAME = 64 * 1024 # bytes, bodies are split into frames of at most this size
+MAX_BUFFERED = 1024 * 1024 # bytes waiting to be sent before senders block
+STREAM_WINDOW = 256 * 1024 # bytes of DATA in flight per stream, at least MAX_DATA_FRAME
+READ_SIZE = 64 * 1024
+HANDSHAKE_TIMEOUT = 10 # seconds
+
+# the connection closed, or the stream was reset by the other side
+class ChannelError(ConnectionError):
+    pass
+
+# no connection could be made, nothing was sent
+class ChannelUnavailable(ChannelError):
+    pass
+
+class ChannelTimeout(ChannelError):
+    pass
+
+# pi side, verifies main's certificate and presents the pi's
+def client_context(main_certfile, pi_certfile, pi_keyfile) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=main_certfile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(pi_certfile, pi_keyfile)
+    return context
+
+# main side, only accepts connections presenting the pi's certificate
+def server_context(main_certfile, main_keyfile, pi_certfile) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(pi_certfile)
+    context.load_cert_chain(main_certfile, main_keyfile)
+    return context
+
+# one TLS connection, framed
+# a single thread does all reading and writing (an ssl socket can't be read and written from
+# different threads at once), other threads queue frames with send()
+class Connection():
+    # on_frame(frame_type, stream_id, payload) and on_close(reason) run on the connection's thread and must not block
+    # ping_interval is None on the side that only answers pings
+    def __init__(self, sock: ssl.SSLSocket, on_frame, on_close, name, ping_interval, idle_timeout):
+        self.sock = sock
+        self.on_frame = on_frame
+        self.on_close = on_close
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.out = bytearray()
+        self.closed = False
+        self.close_reason = None
+        self.last_received = time.monotonic()
+        self.last_ping = time.monotonic()
+
+        # wakes the connection's thread up when there is something to send
+        self.wake_read, self.wake_write = socket.socketpair()
+        self.wake_read.setblocking(False)
+        self.wake_write.setblocking(False)
+
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self.sock.setblocking(False)
+        self.thread.start()
+
+    # queue a frame, blocks while too much is already waiting to be sent
+    # raises ChannelError if the connection is closed
+    def send(self, frame_type, stream_id, payload=b""):
+        with self.lock:
+            while len(self.out) > MAX_BUFFERED and not self.closed:
+                self.drained.wait()
+            self._enqueue(frame_type, stream_id, payload)
+        self._wake()
+
+    def close(self, reason="channel closed"):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.close_reason = reason
+            self.drained.notify_all()
+        self._wake()
+
+    # lock must be held
+    def _enqueue(self, frame_type, stream_id, payload):
+        if self.closed:
+            raise ChannelError(self.close_reason)
+        self.out += FRAME_HEADER.pack(len(payload), frame_type, stream_id)
+        self.out += payload
+
+    def _wake(self):
+        try:
+            self.wake_write.send(b"\0")
+        except OSError:
+            # already awake
+            pass
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.wake_read, selectors.EVENT_READ)
+        selector.register(self.sock, selectors.EVENT_READ)
+        in_buffer = bytearray()
+        try:
+            while True:
+                with self.lock:
+                    if self.closed:
+                        break
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.out else 0)
+                selector.modify(self.sock, events)
+
+                for (key, _events) in selector.select(timeout=self._next_timer()):
+                    if key.fileobj is self.wake_read:
+                        try:
+                            while self.wake_read.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+
+                self._read(in_buffer)
+                self._write()
+                self._timers()
+        except (OSError, ValueError) as e:
+            self.close(str(e) or type(e).__name__)
+        finally:
+            selector.close()
+            for sock in (self.sock, self.wake_read, self.wake_write):
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            self.on_close(self.close_reason)
+
+    def _read(self, in_buffer: bytearray):
+        while True:
+            try:
+                data = self.sock.recv(READ_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return
+            if not data:
+                raise ChannelError("closed by the other side")
+            self.last_received = time.monotonic()
+            in_buffer += data
+
+            while len(in_buffer) >= FRAME_HEADER.size:
+                (length, frame_type, stream_id) = FRAME_HEADER.unpack_from(in_buffer)
+                if length > MAX_PAYLOAD:
+                    raise ChannelError("frame too big")
+                end = FRAME_HEADER.size + length
+                if len(in_buffer) < end:
+                    break
+                payload = bytes(in_buffer[FRAME_HEADER.size:end])
+                del in_buffer[:end]
+
+                if frame_type == PING:
+                    with self.lock:
+                        self._enqueue(PONG, 0, payload)
+                elif frame_type != PONG:
+                    self.on_frame(frame_type, stream_id, payload)
+
+    def _write(self):
+        while True:
+            with self.lock:
+                if not self.out:
+                    return
+                data = bytes(self.out[:READ_SIZE])
+            try:
+                sent = self.sock.send(data)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return
+            with self.lock:
+                del self.out[:sent]
+                if len(self.out) <= MAX_BUFFERED:
+                    self.drained.notify_all()
+
+    def _next_timer(self) -> float:
+        timeout = self.idle_timeout
+        if self.ping_interval is not None:
+            timeout = min(timeout, self.ping_interval)
+        return max(timeout / 2, 0.1)
+
+    def _timers(self):
+        now = time.monotonic()
+        if now - self.last_received > self.idle_timeout:
+            raise ChannelError("nothing received for {} seconds".format(self.idle_timeout))
+        if self.ping_interval is not None and now - self.last_ping >= self.ping_interval:
+            self.last_ping = now
+            with self.lock:
+                self._enqueue(PING, 0, b"")
+
+# frames received for one stream, until its consumer takes them
+# gives DATA back to the other side with WINDOW frames once half the window has been taken
+class StreamInbox():
+    def __init__(self, connection: Connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.frames = queue.Queue()
+        self.lock = threading.Lock()
+        self.buffered = 0 # bytes of DATA waiting in frames
+        self.taken = 0 # bytes of DATA taken but not given back yet
+
+    # runs on the connection's thread
+    # raises ChannelError if the other side sent more than the window, which closes the connection
+    def put(self, frame_type, payload=b""):
+        if frame_type == DATA:
+            with self.lock:
+                if self.buffered + len(payload) > STREAM_WINDOW:
+                    raise ChannelError("stream {} sent more than its window".format(self.stream_id))
+                self.buffered += len(payload)
+        self.frames.put((frame_type, payload))
+
+    # returns (frame type, payload), raises queue.Empty after timeout seconds
+    def get(self, timeout):
+        (frame_type, payload) = self.frames.get(timeout=timeout)
+        if frame_type == DATA:
+            with self.lock:
+                self.buffered -= len(payload)
+                self.taken += len(payload)
+                credit = self.taken if self.taken >= STREAM_WINDOW // 2 else 0
+                if credit:
+                    self.taken = 0
+            if credit:
+                try:
+                    self.connection.send(WINDOW, self.stream_id, WINDOW_PAYLOAD.pack(credit))
+                except ChannelError:
+                    # the consumer finds out from the frames that follow
+                    pass
+        return frame_type, payload
+
+# how much DATA one stream may still send, grown by the other side's WINDOW frames
+class SendWindow():
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.available = STREAM_WINDOW
+        self.close_reason = None
+
+    # runs on the connection's thread
+    def grow(self, size):
+        with self.condition:
+            self.available += size
+            self.condition.notify_all()
+
+    # the stream was reset or its connection closed, senders stop waiting
+    def close(self, reason):
+        with self.condition:
+            if self.close_reason is None:
+                self.close_reason = reason
+            self.condition.notify_all()
+
+    # blocks until size bytes (at most MAX_DATA_FRAME) may be sent
+    # raises ChannelError once closed, ChannelTimeout if the other side takes nothing for timeout seconds
+    def take(self, size, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.available < size and self.close_reason is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ChannelTimeout("the other side stopped reading for {} seconds".format(timeout))
+                self.condition.wait(remaining)
+            if self.close_reason is not None:
+                raise ChannelError(self.close_reason)
+            self.available -= size
+
+# send body (an iterable of bytes) as DATA frames of one stream, waiting for window as needed
+def send_data(connection: Connection, stream_id, window: SendWindow, body, timeout):
+    for chunk in body:
+        for start in range(0, len(chunk), MAX_DATA_FRAME):
+            frame = bytes(chunk[start:start + MAX_DATA_FRAME])
+            window.take(len(frame), timeout)
+            connection.send(DATA, stream_id, frame)
+
+## pi side
+
+# main's response to a request sent over the channel
+# mirrors the parts of a streamed requests.Response that pisite uses
+class ChannelResponse():
+    def __init__(self, stream, status, headers, timeout):
+        self._stream: ClientStream = stream
+        self.status_code = status
+        self.headers = Headers(headers)
+        self.raw = self # headers and stream() are where requests has them on the raw response
+        self.timeout = timeout
+        self.finished = False
+
+    # the body, frame by frame, as sent by main (not decoded)
+    # raises ChannelError if the stream is reset or the connection lost, ChannelTimeout if main stops sending
+    def stream(self, chunk_size=None, decode_content=False):
+        while not self.finished:
+            (frame_type, payload) = self._stream.next_frame(self.timeout)
+            if frame_type == DATA:
+                if payload:
+                    yield payload
+            elif frame_type == END:
+                self.finished = True
+                self._stream.forget()
+            else:
+                self.finished = True
+                self._stream.forget()
+                raise ChannelError(payload.decode("utf-8", "replace") or "stream reset by main")
+
+    # stops main sending the rest of the body
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self._stream.reset()
+
+class ClientStream():
+    def __init__(self, client_connection, stream_id):
+        self.client_connection: ClientConnection = client_connection
+        self.stream_id = stream_id
+        self.inbox = StreamInbox(client_connection.connection, stream_id)
+        self.send_window = SendWindow()
+
+    def next_frame(self, timeout):
+        try:
+            return self.inbox.get(timeout)
+        except queue.Empty:
+            raise ChannelTimeout("main didn't answer within {} seconds".format(timeout))
+
+    def forget(self):
+        self.client_connection.forget(self.stream_id)
+        self.send_window.close("stream closed")
+
+    def reset(self):
+        self.forget()
+        try:
+            self.client_connection.connection.send(RESET, self.stream_id)
+        except ChannelError:
+            pass
+
+class ClientConnection():
+    def __init__(self, sock, name, ping_interval, idle_timeout):
+        self.lock = threading.Lock()
+        self.streams = dict() # stream id: ClientStream
+        self.next_stream_id = 1
+        self.connection = Connection(sock, self._on_frame, self._on_close, name, ping_interval, idle_timeout)
+        self.connection.start()
+
+    def open_stream(self) -> ClientStream:
+        with self.lock:
+            stream = ClientStream(self, self.next_stream_id)
+            self.next_stream_id += 1
+            self.streams[stream.stream_id] = stream
+        return stream
+
+    def forget(self, stream_id):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+
+    def _on_frame(self, frame_type, stream_id, payload):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+        # frames for streams that were already closed here are dropped
+        if stream is None:
+            return
+        if frame_type == WINDOW:
+            stream.send_window.grow(WINDOW_PAYLOAD.unpack(payload)[0])
+            return
+        if frame_type == RESET:
+            stream.send_window.close(payload.decode("utf-8", "replace") or "stream reset by main")
+        stream.inbox.put(frame_type, payload)
+
+    def _on_close(self, reason):
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.send_window.close(reason or "channel closed")
+            stream.inbox.put(CLOSED, (reason or "channel closed").encode("utf-8"))
+
+class ChannelClient():
+    def __init__(self, host, port, ssl_context, connect_timeout, keepalive_interval, keepalive_timeout, reconnect_backoff):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timeout = keepalive_timeout
+        self.reconnect_backoff = reconnect_backoff
+
+        self.lock = threading.Lock()
+        self.client_connection: ClientConnection = None
+        self.connection_pid = None # connections don't survive a fork, so this is checked against os.getpid()
+        self.failed_at = None
+
+    # send a request and wait for the start of main's response
+    # path starts with /, headers is a list of (key, value), body an iterable of bytes or None
+    # raises ChannelUnavailable if there is no connection (nothing was sent or read from body),
+    # ChannelTimeout if main doesn't answer in time, and ChannelError if the connection is lost
+    def request(self, method, path, query, headers, body, timeout) -> ChannelResponse:
+        client_connection = self._get_connection()
+        connection = client_connection.connection
+        stream = client_connection.open_stream()
+        try:
+            connection.send(REQUEST, stream.stream_id, json.dumps({
+                "method": method,
+                "path": path,
+                "query": query,
+                "headers": headers
+            }).encode("utf-8"))
+            if body is not None:
+                send_data(connection, stream.stream_id, stream.send_window, body, timeout)
+            connection.send(END, stream.stream_id)
+
+            (frame_type, payload) = stream.next_frame(timeout)
+            if frame_type != RESPONSE:
+                raise ChannelError(payload.decode("utf-8", "replace") or "stream reset by main")
+            meta = json.loads(payload)
+            return ChannelResponse(stream, meta["status"], meta["headers"], timeout)
+        except BaseException:
+            stream.reset()
+            raise
+
+    def _get_connection(self) -> ClientConnection:
+        with self.lock:
+            if self.client_connection is not None and self.connection_pid == os.getpid() \
+                    and not self.client_connection.connection.closed:
+                return self.client_connection
+
+            if self.failed_at is not None and time.monotonic() - self.failed_at < self.reconnect_backoff:
+                raise ChannelUnavailable("channel to main is down, retrying in a few seconds")
+
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                tls_sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+            except OSError as e:
+                self.failed_at = time.monotonic()
+                raise ChannelUnavailable("unable to open channel to main: {}".format(e))
+
+            self.failed_at = None
+            self.client_connection = ClientConnection(
+                tls_sock,
+                "pisite-channel",
+                self.keepalive_interval,
+                self.keepalive_timeout
+            )
+            self.connection_pid = os.getpid()
+            return self.client_connection
+
+## main side
+
+# request body as it arrives, for wsgi.input
+class RequestBody(io.RawIOBase):
+    def __init__(self, inbox: StreamInbox, timeout):
+        self.inbox = inbox
+        self.timeout = timeout
+        self.current = b""
+        self.ended = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.current and not self.ended:
+            try:
+                (frame_type, payload) = self.inbox.get(self.timeout)
+            except queue.Empty:
+                raise ChannelTimeout("request body stopped arriving")
+            if frame_type == DATA:
+                self.current = payload
+            else:
+                self.ended = True
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    # read and drop whatever the app left of the body, so the pi gets its window back and can finish sending it
+    def drain(self):
+        buffer = bytearray(MAX_DATA_FRAME)
+        try:
+            while self.readinto(buffer):
+                pass
+        except ChannelTimeout:
+            pass
+
+class ServerStream():
+    def __init__(self, connection: Connection, stream_id, timeout):
+        # only DATA and END (or CLOSED, once reset) go in the inbox
+        self.inbox = StreamInbox(connection, stream_id)
+        self.body = RequestBody(self.inbox, timeout)
+        self.send_window = SendWindow()
+        self.cancelled = False
+
+    # the stream was reset by the pi or the connection closed
+    def cancel(self, reason):
+        self.cancelled = True
+        self.send_window.close(reason)
+        self.inbox.put(CLOSED)
+
+class ServerConnection():
+    def __init__(self, server, sock, address):
+        self.server: ChannelServer = server
+        self.address = address
+        self.lock = threading.Lock()
+        self.streams = dict() # stream id: ServerStream
+        self.connection = Connection(
+            sock,
+            self._on_frame,
+            self._on_close,
+            "pisite-channel-{}".format(address[0]),
+            None,
+            server.idle_timeout
+        )
+        self.connection.start()
+
+    def _on_frame(self, frame_type, stream_id, payload):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if frame_type == REQUEST and stream is None:
+                stream = self.streams[stream_id] = ServerStream(self.connection, stream_id, self.server.idle_timeout)
+                self.server.pool.submit(self._handle, stream_id, stream, json.loads(payload))
+                return
+        if stream is None:
+            return
+        if frame_type in (DATA, END):
+            stream.inbox.put(frame_type, payload)
+        elif frame_type == WINDOW:
+            stream.send_window.grow(WINDOW_PAYLOAD.unpack(payload)[0])
+        elif frame_type == RESET:
+            stream.cancel("stream reset by the pi")
+
+    def _on_close(self, reason):
+        with self.lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.cancel(reason or "channel closed")
+
+    def _forget(self, stream_id):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+
+    # runs in the server's thread pool
+    def _handle(self, stream_id, stream: ServerStream, request):
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        def send_response_start():
+            self.connection.send(RESPONSE, stream_id, json.dumps({
+                "status": started["status"],
+                "headers": started["headers"]
+            }).encode("utf-8"))
+
+        result = None
+        try:
+            result = self.server.wsgi_app(self.build_environ(request, stream.body), start_response)
+            response_started = False
+            for chunk in result:
+                if stream.cancelled:
+                    return
+                if not response_started:
+                    send_response_start()
+                    response_started = True
+                # waits while the pi is behind on reading
+                send_data(self.connection, stream_id, stream.send_window, [chunk], self.server.idle_timeout)
+            if stream.cancelled:
+                return
+            if not response_started:
+                send_response_start()
+            self.connection.send(END, stream_id)
+        except ChannelTimeout as e:
+            # the pi stopped reading the response (or sending the body), give up on it
+            print("channel request abandoned: {}".format(e), file=sys.stderr)
+            stream.cancel(str(e))
+            try:
+                self.connection.send(RESET, stream_id, str(e).encode("utf-8"))
+            except ChannelError:
+                pass
+        except ChannelError:
+            # connection is gone, or the stream was reset
+            pass
+        except Exception as e:
+            print("channel request failed: {}".format(e), file=sys.stderr)
+            try:
+                self.connection.send(RESET, stream_id, str(e).encode("utf-8"))
+            except ChannelError:
+                pass
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+            stream.body.drain()
+            self._forget(stream_id)
+
+    # https://peps.python.org/pep-3333/#environ-variables
+    def build_environ(self, request, body: RequestBody) -> dict:
+        environ = {
+            "REQUEST_METHOD": request["method"],
+            "SCRIPT_NAME": "",
+            "PATH_INFO": request["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": request["query"],
+            "SERVER_NAME": self.server.host,
+            "SERVER_PORT": str(self.server.port),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            # the peer's address, checked like any other request
+            "REMOTE_ADDR": self.address[0],
+            "REMOTE_PORT": str(self.address[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "https",
+            "wsgi.input": io.BufferedReader(body),
+            # the body ends with the stream's END frame, with or without a Content-Length
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for (key, val) in request["headers"]:
+            if key.lower() == "content-type":
+                environ["CONTENT_TYPE"] = val
+            elif key.lower() == "content-length":
+                environ["CONTENT_LENGTH"] = val
+            else:
+                name = "HTTP_" + key.upper().replace("-", "_")
+                if name in environ:
+                    val = environ[name] + "," + val
+                environ[name] = val
+        return environ
+
+class ChannelServer():
+    def __init__(self, wsgi_app, ssl_context, threads, idle_timeout):
+        self.wsgi_app = wsgi_app
+        self.ssl_context = ssl_context
+        self.idle_timeout = idle_timeout
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pisite-channel")
+        self.host = None
+        self.port = None
+
+    def serve_forever(self, host, port):
+        self.host = host
+        self.port = port
+        with socket.create_server((host, port)) as listener:
+            print("channel listening on {}:{}".format(host, port))
+            while True:
+                sock, address = listener.accept()
+                threading.Thread(target=self._accept, args=(sock, address), daemon=True).start()
+
+    def _accept(self, sock, address):
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            tls_sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        except (OSError, ssl.SSLError) as e:
+            print("channel handshake with {} failed: {}".format(address[0], e))
+            sock.close()
+            return
+        print("channel connected from {}".format(address[0]))
+        ServerConnection(self, tls_sock, address)
+
+if __name__ == "__main__":
+    import pisite_app
+    app = pisite_app.app
+    server = ChannelServer(
+        app,
+        server_context(
+            app.config["PATH_TO_MAIN_CHANNEL_CERTFILE"],
+            app.config["PATH_TO_MAIN_CHANNEL_KEYFILE"],
+            app.config["PATH_TO_PI_CHANNEL_CERTFILE"]
+        ),
+        app.config["CHANNEL_THREADS"],
+        app.config["CHANNEL_KEEPALIVE_TIMEOUT"]
+    )
+    server.serve_forever(app.config["CHANNEL_BIND"], app.config["CHANNEL_PORT"])
@@ -0,0 +1,206 @@
+# status collector on main: one long-lived process runs the game server probes on a schedule, all at once and
+# each with its own timeout, and keeps the latest results in memory
+# request workers read them over a unix socket (multiprocessing.connection, authenticated with a key), keeping
+# one connection per thread, so a status GET is a round trip to the collector instead of running the probes
+# if the collector isn't running or its results are too old, workers run the probes themselves like before
+#
+# on main, run it next to the https server: `PISITE_MODE=MAIN python -m pisite_app.collector`
+
+import os
+import sys
+import time
+import threading
+import concurrent.futures
+import multiprocessing.connection
+
+# requests over the socket
+SNAPSHOT = "snapshot"
+REFRESH = "refresh"
+
+# seconds a worker waits after failing to reach the collector before trying again
+RECONNECT_BACKOFF = 5
+
+# how often the scheduler looks for due and timed out probes, at most
+TICK = 0.1 # seconds
+
+class Probe():
+    # func returns the probe's values (anything picklable), timeout_values are published instead when it takes too long
+    # on_result is called with the values of every run, once (the timeout_values if it timed out)
+    def __init__(self, name, func, interval, timeout, timeout_values, on_result):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.timeout_values = timeout_values
+        self.on_result = on_result
+        self.started = None # time.monotonic() of the run in flight
+        self.timed_out = False # the run in flight has already been published as timed out
+        self.next_run = 0
+
+class Collector():
+    def __init__(self, socket_path, authkey: bytes):
+        self.socket_path = os.path.abspath(socket_path)
+        self.authkey = authkey
+        self.probes = dict() # name: Probe
+        self.handlers = dict() # request name: function answering it
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pool = None
+        # replaced as a whole on every change, so it can be sent while probes finish
+        # {probe name: {"values", "checked_at": unix time, "seconds", "timed_out": bool}}
+        self.snapshot = dict()
+
+    def add(self, name, func, interval, timeout, timeout_values=None, on_result=None):
+        self.probes[name] = Probe(name, func, interval, timeout, timeout_values, on_result)
+
+    # answer (name, *args) requests with func(*args), see CollectorClient.query
+    def handle(self, name, func):
+        self.handlers[name] = func
+
+    # runs the probes and serves their results until the process is stopped
+    def serve_forever(self):
+        self.start()
+        while True:
+            time.sleep(3600)
+
+    # in background threads, for running the collector inside another process
+    def start(self):
+        # at least one thread, main may declare no game servers (GAME_SERVERS = []) and so have no probes
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.probes)), thread_name_prefix="pisite-collector")
+        threading.Thread(target=self._schedule, name="pisite-collector-schedule", daemon=True).start()
+
+        if os.path.exists(self.socket_path):
+            # left over from a collector that didn't exit cleanly
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        listener = multiprocessing.connection.Listener(address=self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        os.chmod(self.socket_path, 0o600)
+        print("collector listening on {}".format(self.socket_path))
+        threading.Thread(target=self._accept, args=(listener,), name="pisite-collector-accept", daemon=True).start()
+
+    def _schedule(self):
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                for probe in self.probes.values():
+                    if probe.started is None:
+                        if now >= probe.next_run:
+                            probe.started = now
+                            probe.timed_out = False
+                            self.pool.submit(self._run, probe)
+                    elif not probe.timed_out and now - probe.started > probe.timeout:
+                        # the run keeps going, its result replaces this one when it's done
+                        probe.timed_out = True
+                        print("collector probe {} timed out after {} seconds".format(probe.name, probe.timeout))
+                        self._publish(probe, probe.timeout_values, now - probe.started, True)
+                        self._report(probe, probe.timeout_values)
+            self.wake.wait(TICK)
+            if self.wake.is_set():
+                self.wake.clear()
+                with self.lock:
+                    for probe in self.probes.values():
+                        probe.next_run = 0
+
+    def _run(self, probe: Probe):
+        try:
+            values = probe.func()
+        except Exception as e:
+            print("collector probe {} failed: {}".format(probe.name, e))
+            values = probe.timeout_values
+        with self.lock:
+            self._publish(probe, values, time.monotonic() - probe.started, False)
+            if not probe.timed_out:
+                self._report(probe, values)
+            probe.next_run = probe.started + probe.interval
+            probe.started = None
+
+    # lock is held
+    def _publish(self, probe: Probe, values, seconds, timed_out):
+        snapshot = dict(self.snapshot)
+        snapshot[probe.name] = {"values": values, "checked_at": time.time(), "seconds": seconds, "timed_out": timed_out}
+        self.snapshot = snapshot
+
+    def _report(self, probe: Probe, values):
+        if probe.on_result is None:
+            return
+        try:
+            probe.on_result(values)
+        except Exception as e:
+            print("collector probe {} result not recorded: {}".format(probe.name, e))
+
+    def _accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, multiprocessing.AuthenticationError) as e:
+                print("collector refused a connection: {}".format(e))
+                continue
+            threading.Thread(target=self._serve, args=(connection,), name="pisite-collector-connection", daemon=True).start()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if request == SNAPSHOT:
+                    connection.send(self.snapshot)
+                elif request == REFRESH:
+                    self.wake.set()
+                    connection.send(True)
+                elif isinstance(request, tuple) and len(request) > 0 and request[0] in self.handlers:
+                    try:
+                        result = self.handlers[request[0]](*request[1:])
+                    except Exception as e:
+                        print("collector couldn't answer {}: {}".format(request[0], e))
+                        result = None
+                    connection.send(result)
+                else:
+                    connection.send(None)
+
+# in the request workers, one connection per thread
+class CollectorClient():
+    def __init__(self, socket_path, authkey: bytes, timeout):
+        self.socket_path = os.path.abspath(socket_path)
+        self.authkey = authkey
+        self.timeout = timeout
+        self.local = threading.local()
+        self.unavailable_until = 0
+
+    # {probe name: {"values", "checked_at", "seconds", "timed_out"}}, or None if the collector can't be reached
+    def snapshot(self) -> dict:
+        return self._request(SNAPSHOT)
+
+    # ask the collector to run every probe now, e.g. after starting a server
+    def request_refresh(self):
+        self._request(REFRESH)
+
+    # the answer of the collector's handler for name (see Collector.handle), or None
+    def query(self, name, *args):
+        return self._request((name,) + args)
+
+    def _request(self, request):
+        if time.monotonic() < self.unavailable_until:
+            return None
+        connection = getattr(self.local, "connection", None)
+        try:
+            if connection is None:
+                connection = multiprocessing.connection.Client(address=self.socket_path, family="AF_UNIX", authkey=self.authkey)
+                self.local.connection = connection
+            connection.send(request)
+            if not connection.poll(self.timeout):
+                raise TimeoutError("collector didn't answer in {} seconds".format(self.timeout))
+            return connection.recv()
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            if connection is not None:
+                connection.close()
+            self.local.connection = None
+            self.unavailable_until = time.monotonic() + RECONNECT_BACKOFF
+            return None
+
+if __name__ == "__main__":
+    import pisite_app
+    if not hasattr(getattr(pisite_app, "site", None), "status_collector"):
+        sys.exit("the collector runs on main, set PISITE_MODE=MAIN")
+    pisite_app.site.status_collector.serve_forever()
@@ -0,0 +1,400 @@
+# game servers on main, declared in GAME_SERVERS, each with its own tmux session, start and stop and probes
+# probes are plugins, classes registered under a type name with @probe_type, configured by the declaration:
+#   "tmux": the server's tmux session exists
+#   "process": its process is alive, through the process registry (see pisite_app/processregistry.py)
+#     {"executable": basename of the program, "arguments": [any of these in the command line]}
+#   "tcp": something accepts connections, {"host", "port"}
+#   "minecraft": server list ping and query (mcstatus), with the motd, players and latency, {"host", "port"}
+#   "a2s": source engine A2S_INFO query over udp, with the server name, map, players and latency, {"host", "port"}
+# every probe can have a "timeout" in seconds, used by the collector (see pisite_app/collector.py)
+# each server is probed on its own schedule by the collector, and started, stopped and restarted by jobs
+# (see pisite_app/jobs.py), so operations on different servers never wait on each other
+
+import os
+import abc
+import time
+import socket
+import struct
+
+import libtmux
+import mcstatus
+
+import pisite_app.metrics as metrics
+import pisite_app.history as history
+from pisite_app.jobs import JobError
+from pisite_app.common import ResponseData, StatusResponse
+
+# seconds between status checks while waiting for a server to stop
+STOP_POLL_INTERVAL = 1
+# seconds a server gets to exit after its tmux session is killed, before the stop fails
+STOP_KILL_WAIT = 10
+
+# type name: probe class
+PROBE_TYPES = dict()
+
+# class decorator to register a probe type
+def probe_type(name):
+    def decorator(cls):
+        cls.type_name = name
+        PROBE_TYPES[name] = cls
+        return cls
+    return decorator
+
+class Probe(abc.ABC):
+    type_name = None
+    status_name = None # its key in the statuses of a status response
+    samples_history = False # whether its results go in the server's history
+
+    # timeouts are by type name, for probes without their own
+    def __init__(self, server, options: dict, timeouts: dict):
+        self.server = server
+        self.options = options
+        self.timeout = options.get("timeout", timeouts.get(self.type_name, 2))
+
+    # {status_name: bool, "info": dict, "latency_ms": float or None}, never raises
+    @abc.abstractmethod
+    def run(self) -> dict:
+        pass
+
+    def timed_run(self) -> dict:
+        with metrics.GAME_SERVER_PROBE_DURATION.labels(self.server.name, self.type_name).time():
+            return self.run()
+
+    # what the collector publishes when a run takes longer than the timeout
+    @property
+    def timeout_values(self) -> dict:
+        return {self.status_name: False, "info": dict(), "latency_ms": None}
+
+    # (up, players, latency_ms) for the history, players may be None
+    def history_sample(self, values) -> tuple:
+        return (values[self.status_name], None, values["latency_ms"])
+
+@probe_type("tmux")
+class TmuxProbe(Probe):
+    status_name = "tmux_window_running"
+
+    def run(self) -> dict:
+        running = False
+        try:
+            sessions = libtmux.Server().list_sessions()
+            running = self.server.tmux_session in [session.name for session in sessions]
+        except:
+            pass
+        return {self.status_name: running, "info": dict(), "latency_ms": None}
+
+@probe_type("process")
+class ProcessProbe(Probe):
+    status_name = "process_running"
+
+    def __init__(self, server, options, timeouts):
+        super().__init__(server, options, timeouts)
+        self.executable = options["executable"]
+        self.arguments = options.get("arguments", [])
+        server.registry.track(server.name, self.matches)
+
+    # the executable, with any of the arguments if there are any
+    def matches(self, cmdline) -> bool:
+        if not any(os.path.basename(token) == self.executable for token in cmdline):
+            return False
+        return len(self.arguments) == 0 or any(argument in token for token in cmdline for argument in self.arguments)
+
+    def run(self) -> dict:
+        return {self.status_name: self.server.registry.is_running(self.server.name), "info": dict(), "latency_ms": None}
+
+@probe_type("tcp")
+class TcpProbe(Probe):
+    status_name = "tcp_open"
+    samples_history = True
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        try:
+            with socket.create_connection((self.options.get("host", "localhost"), self.options["port"]), timeout=self.timeout):
+                latency_ms = (time.perf_counter() - started) * 1000
+            return {self.status_name: True, "info": dict(), "latency_ms": latency_ms}
+        except OSError:
+            return {self.status_name: False, "info": dict(), "latency_ms": None}
+
+@probe_type("minecraft")
+class MinecraftProbe(Probe):
+    status_name = "mc_status_ping"
+    samples_history = True
+
+    def run(self) -> dict:
+        values = {self.status_name: False, "info": dict(), "latency_ms": None}
+        try:
+            mc_server = mcstatus.MinecraftServer(self.options.get("host", "localhost"), self.options.get("port", 25565))
+            ping = mc_server.ping()
+            values[self.status_name] = (ping > 0)
+            values["latency_ms"] = ping
+
+            query = mc_server.query()
+            values["info"]["motd"] = query.motd
+            values["info"]["players"] = query.players.names
+        except:
+            pass
+        return values
+
+    def history_sample(self, values) -> tuple:
+        players = values["info"].get("players")
+        return (values[self.status_name], None if players is None else len(players), values["latency_ms"])
+
+# https://developer.valvesoftware.com/wiki/Server_queries#A2S_INFO
+A2S_INFO_REQUEST = b"\xff\xff\xff\xffTSource Engine Query\x00"
+A2S_HEADER = b"\xff\xff\xff\xff"
+A2S_CHALLENGE = b"A"
+A2S_INFO = b"I"
+
+# {"name", "map", "game", "players", "max_players"} of a source engine server
+# raises OSError if it doesn't answer, ValueError if the answer isn't an A2S_INFO one
+def a2s_info(host, port, timeout) -> dict:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((host, port))
+        sock.send(A2S_INFO_REQUEST)
+        reply = sock.recv(1400)
+        if reply[4:5] == A2S_CHALLENGE:
+            # newer servers want the request again with the challenge they sent
+            sock.send(A2S_INFO_REQUEST + reply[5:9])
+            reply = sock.recv(1400)
+    if reply[:4] != A2S_HEADER or reply[4:5] != A2S_INFO:
+        raise ValueError("not an A2S_INFO reply")
+
+    # header, type, protocol version, then null terminated strings
+    position = 6
+    strings = []
+    for _ in range(4):
+        end = reply.index(b"\x00", position)
+        strings.append(reply[position:end].decode("utf-8", errors="replace"))
+        position = end + 1
+    (_app_id, players, max_players) = struct.unpack_from("<hBB", reply, position)
+    (name, map_name, _folder, game) = strings
+    return {"name": name, "map": map_name, "game": game, "players": players, "max_players": max_players}
+
+@probe_type("a2s")
+class A2SProbe(Probe):
+    status_name = "a2s_query"
+    samples_history = True
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        try:
+            info = a2s_info(self.options.get("host", "localhost"), self.options["port"], self.timeout)
+        except (OSError, ValueError, struct.error):
+            return {self.status_name: False, "info": dict(), "latency_ms": None}
+        return {self.status_name: True, "info": info, "latency_ms": (time.perf_counter() - started) * 1000}
+
+    def history_sample(self, values) -> tuple:
+        return (values[self.status_name], values["info"].get("players"), values["latency_ms"])
+
+class GameServer():
+    def __init__(self, name, declaration: dict, registry, default_interval, timeouts: dict, history_tiers: dict, default_stop_timeout):
+        self.name = name
+        self.title = declaration.get("title", name)
+        self.tmux_session = declaration.get("tmux_session", name)
+        self.start_script = declaration.get("start_script")
+        self.start_dir = declaration.get("start_dir")
+        self.stop_command = declaration.get("stop_command")
+        self.stop_timeout = declaration.get("stop_timeout", default_stop_timeout)
+        self.interval = declaration.get("interval", default_interval)
+        self.registry = registry
+
+        self.probes = dict() # type name: Probe, in the declared order
+        for (type_name, options) in declaration["probes"].items():
+            if type_name not in PROBE_TYPES:
+                raise ValueError("game server {} has an unknown probe type {}".format(name, type_name))
+            self.probes[type_name] = PROBE_TYPES[type_name](self, options or dict(), timeouts)
+
+        # only the first probe that samples the history, so each run adds one sample
+        self.history_probe = next((probe for probe in self.probes.values() if probe.samples_history), None)
+        self.history = history.History(history_tiers) if self.history_probe is not None else None
+
+    # endpoint on main, relative like the pi's main endpoints
+    @property
+    def endpoint(self) -> str:
+        return "api/servers/{}".format(self.name)
+
+    # key of a probe's results in the collector
+    def collector_key(self, probe: Probe) -> str:
+        return "{}.{}".format(self.name, probe.type_name)
+
+    # runs every probe in this thread
+    def status(self):
+        with metrics.GAME_SERVER_PROBE_DURATION.labels(self.name, "total").time():
+            return ServerStatus(self, {type_name: probe.timed_run() for (type_name, probe) in self.probes.items()})
+
+    # from the collector's latest results, running only the probes it has no results newer than max_age for
+    def collected_status(self, snapshot: dict, max_age):
+        oldest = time.time() - max_age
+        results = dict()
+        for (type_name, probe) in self.probes.items():
+            result = snapshot.get(self.collector_key(probe))
+            if result is not None and result["checked_at"] >= oldest:
+                results[type_name] = result["values"]
+            else:
+                results[type_name] = probe.timed_run()
+        return ServerStatus(self, results)
+
+    # a result of the history probe, in the collector's process
+    def record_history(self, values):
+        (up, players, latency_ms) = self.history_probe.history_sample(values)
+        self.history.add(time.time(), up, players, latency_ms)
+
+    # operations of jobs (see pisite_app/jobs.py), run while the job holds the server's lock
+    # progress(message) records a step, each returns the job's result message and raises JobError if it fails
+
+    def run_start(self, progress) -> str:
+        progress("checking whether {} is running".format(self.title))
+        if self.status().any_true:
+            raise JobError("server is already on or starting up")
+        self._start_session(progress)
+        return "{} started".format(self.title)
+
+    def run_stop(self, progress) -> str:
+        progress("checking whether {} is running".format(self.title))
+        if not self.status().any_true:
+            raise JobError("server is already off")
+        self.stop(progress)
+        return "{} stopped".format(self.title)
+
+    def run_restart(self, progress) -> str:
+        progress("checking whether {} is running".format(self.title))
+        if self.status().any_true:
+            self.stop(progress)
+        else:
+            progress("{} isn't running".format(self.title))
+        self._start_session(progress)
+        return "{} restarted".format(self.title)
+
+    def _start_session(self, progress):
+        progress("starting tmux session {}".format(self.tmux_session))
+        try:
+            started = self.start()
+        except FileNotFoundError as e:
+            raise JobError(e.args[0])
+        if not started:
+            raise JobError("tmux error")
+
+    # preconditions:
+    #   the server is not already running
+    #   the server's job lock is held
+    # throws FileNotFoundError
+    def start(self) -> bool:
+        if self.start_script is None or not os.path.exists(self.start_script):
+            raise FileNotFoundError("{} start script not found".format(self.name))
+        if self.start_dir is None or not os.path.isdir(self.start_dir):
+            raise FileNotFoundError("{} start dir not found".format(self.name))
+
+        try:
+            tmux_server = libtmux.Server()
+            # start the session
+            session = tmux_server.new_session(
+                session_name=self.tmux_session,
+                start_directory=self.start_dir,
+                window_command=self.start_script,
+            )
+        except:
+            return False
+
+        # the start script's process, until a reconciliation finds the server's own
+        try:
+            self.registry.register(self.name, int(session.windows[0].panes[0].pane_pid))
+        except Exception as e:
+            print("couldn't register {}'s process: {}".format(self.name, e))
+
+        return True
+
+    # types stop_command into the server's console (ctrl-c without one) and waits stop_timeout for it to exit,
+    # then kills its tmux session and process
+    # preconditions:
+    #   the server's job lock is held
+    # throws JobError if it's still running after all that
+    def stop(self, progress):
+        session = None
+        try:
+            tmux_server = libtmux.Server()
+            session = next((session for session in tmux_server.list_sessions() if session.name == self.tmux_session), None)
+        except Exception as e:
+            progress("tmux error: {}".format(e))
+
+        if session is not None:
+            try:
+                pane = session.windows[0].panes[0]
+                if self.stop_command is None:
+                    progress("sending ctrl-c to {}".format(self.tmux_session))
+                    pane.send_keys("C-c", enter=False, suppress_history=False)
+                else:
+                    progress("sending {} to {}".format(self.stop_command, self.tmux_session))
+                    pane.send_keys(self.stop_command, enter=True, suppress_history=False)
+            except Exception as e:
+                progress("couldn't send the stop command: {}".format(e))
+            stopped = self._wait_stopped(self.stop_timeout)
+        else:
+            progress("no tmux session {}".format(self.tmux_session))
+            stopped = False
+
+        if not stopped:
+            progress("{} is still running, killing it".format(self.title))
+            if session is not None:
+                try:
+                    tmux_server.kill_session(self.tmux_session)
+                except Exception as e:
+                    progress("tmux error: {}".format(e))
+            if self.registry.terminate(self.name):
+                progress("sent SIGTERM to its process")
+            if not self._wait_stopped(STOP_KILL_WAIT):
+                raise JobError("{} is still running".format(self.title))
+
+        self.registry.unregister(self.name)
+
+    # whether every probe says the server is off within timeout seconds
+    def _wait_stopped(self, timeout) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            if not self.status().any_true:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(STOP_POLL_INTERVAL)
+
+class ServerStatus():
+    # results: {probe type name: values}
+    def __init__(self, server: GameServer, results: dict):
+        self.statuses = dict()
+        self.info = dict()
+        for (type_name, values) in results.items():
+            probe = server.probes[type_name]
+            self.statuses[probe.status_name] = bool(values[probe.status_name])
+            self.info.update(values["info"])
+        self.any_true = any(self.statuses.values())
+
+    def to_response(self):
+        return ResponseData(True, None, StatusResponse(any_power=self.any_true, statuses=self.statuses, info=self.info))
+
+# the single minecraft server of the MC_* settings, for configs without GAME_SERVERS
+def minecraft_declaration(config) -> dict:
+    return {
+        "minecraft": {
+            "title": "minecraft",
+            "tmux_session": config["MC_TMUX_SESSION"],
+            "start_script": config["MC_START_SCRIPT"],
+            "start_dir": config["MC_START_DIR"],
+            "stop_command": "stop",
+            "probes": {
+                "tmux": {},
+                "process": {"executable": "java", "arguments": ["forge", "minecraft"]},
+                "minecraft": {"host": "localhost"}
+            }
+        }
+    }
+
+# {name: GameServer} from an app's config
+def load(config, registry) -> dict:
+    declarations = config["GAME_SERVERS"]
+    if declarations is None:
+        declarations = minecraft_declaration(config)
+    return {
+        name: GameServer(name, declaration, registry, config["COLLECTOR_INTERVAL"], config["COLLECTOR_TIMEOUTS"],
+            config["HISTORY_TIERS"], config["GAME_SERVER_STOP_TIMEOUT"])
+        for (name, declaration) in declarations.items()
+    }
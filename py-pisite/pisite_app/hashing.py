@@ -0,0 +1,138 @@
+# runs password hashing (bcrypt) away from the request workers
+# each worker process hands hashes to its own single, niced child process, and
+# the number of hashes running or waiting at once is limited across all workers with slot lock files,
+# so a burst of logins can't take every core from the rest of the site
+# when the queue is full, HashingBusyError is raised right away instead of waiting
+# the child is started by init_app, while the worker is importing the app and has no other threads yet
+
+import os
+import time
+import fcntl
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+import flask
+
+import pisite_app.metrics as metrics
+
+# how often a queued hash checks for a free slot
+SLOT_POLL_INTERVAL = 0.05 # seconds
+
+class HashingBusyError(Exception):
+    pass
+
+_pool: concurrent.futures.ProcessPoolExecutor = None
+_pool_pid = None # a pool doesn't survive a fork, so this is checked against os.getpid()
+_pool_lock = threading.Lock()
+
+# func(*args) in the hashing process, func must be a module-level function
+# raises HashingBusyError if too many hashes are queued, or a slot didn't free up in time
+def run(func, *args):
+    config = flask.current_app.config
+    lock_dir = config["HASH_LOCK_DIR"]
+    max_concurrent = config["HASH_MAX_CONCURRENT"]
+
+    # a queue ticket first, the queue includes the running hashes
+    with _try_slot(lock_dir, "queue", max_concurrent + config["HASH_MAX_QUEUED"]) as ticket:
+        if ticket is None:
+            metrics.PASSWORD_HASH_REJECTED.inc()
+            raise HashingBusyError("too many logins right now, try again shortly")
+
+        queued_at = time.monotonic()
+        deadline = queued_at + config["HASH_QUEUE_TIMEOUT"]
+        while True:
+            with _try_slot(lock_dir, "run", max_concurrent) as slot:
+                if slot is not None:
+                    metrics.PASSWORD_HASH_DURATION.labels("queue").observe(time.monotonic() - queued_at)
+                    with metrics.PASSWORD_HASH_DURATION.labels("hash").time():
+                        return _submit(func, args, config["HASH_NICE"])
+            if time.monotonic() >= deadline:
+                metrics.PASSWORD_HASH_REJECTED.inc()
+                raise HashingBusyError("timed out waiting to check password, try again shortly")
+            time.sleep(SLOT_POLL_INTERVAL)
+
+# start this worker's hashing child now
+# under gunicorn the app is imported in each worker before the worker starts any threads, a fork from a
+# threaded process could leave the child with a lock (logging, imports, ...) that another thread held
+# a child started here in a process that forks afterwards (e.g. gunicorn's preload_app) isn't reused,
+# each worker then starts its own on its first hash
+def init_app(app: flask.Flask):
+    _get_pool(app.config["HASH_NICE"]).submit(os.getpid).result()
+
+def _submit(func, args, nice):
+    try:
+        return _get_pool(nice).submit(func, *args).result()
+    except BrokenProcessPool:
+        # the child died (e.g. killed by the oom killer), start a new one and try once more
+        _discard_pool()
+        return _get_pool(nice).submit(func, *args).result()
+
+def _get_pool(nice) -> concurrent.futures.ProcessPoolExecutor:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # everything open now is the worker's (listening sockets, connections, database and lock files),
+            # the pool's own pipes are opened after this
+            inherited_fds = _open_fds()
+            # fork, spawning would re-import pisite_app and build the whole app in the child
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_child,
+                initargs=(nice, inherited_fds)
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+def _open_fds() -> list:
+    fds = []
+    for fd_name in os.listdir("/proc/self/fd"):
+        # skips the one listdir used, closed by now
+        try:
+            os.fstat(int(fd_name))
+            fds.append(int(fd_name))
+        except OSError:
+            pass
+    return fds
+
+# runs in the child after the fork
+def _init_child(nice, inherited_fds):
+    os.nice(nice)
+    # the child only needs the pool's pipes, a copy of any other fd would keep a socket open or a flock held
+    # (these slots, status stream slots) after the worker is done with it
+    # pointed at /dev/null rather than closed, so an inherited object closing its fd later can't hit one opened since
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in inherited_fds:
+        if fd > 2 and fd != devnull:
+            try:
+                os.dup2(devnull, fd)
+            except OSError:
+                pass
+    os.close(devnull)
+
+def _discard_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False)
+        _pool = None
+
+# yields the open lock file of the first free slot, or None if all are taken
+# the slot is released when the file is closed
+@contextlib.contextmanager
+def _try_slot(lock_dir, kind, count):
+    os.makedirs(lock_dir, exist_ok=True)
+    for i in range(count):
+        lock_file = open(os.path.join(lock_dir, "{}-{}.lock".format(kind, i)), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        with lock_file:
+            yield lock_file
+        return
+    yield None
@@ -0,0 +1,96 @@
+# history of a game server's player count, ping latency and health, kept in memory by the collector on main
+# each sample is added to one fixed-size ring of buckets per tier (e.g. minutes, hours, days), so memory stays
+# the same however long main runs, and longer tiers cover more time at a coarser resolution
+# a bucket holds sums and counts in parallel arrays, the averages are worked out when the history is read
+# health is the fraction of samples in which the server answered, the query protocol has no tick rate
+
+import array
+import threading
+
+class Tier():
+    # resolution is seconds per bucket, length is buckets kept
+    def __init__(self, name, resolution, length):
+        self.name = name
+        self.resolution = resolution
+        self.length = length
+        self.buckets = array.array("q", [-1]) * length # bucket number (unix time // resolution) of each slot, -1 is unused
+        self.samples = array.array("I", [0]) * length
+        self.up = array.array("I", [0]) * length
+        self.players_sum = array.array("d", [0]) * length
+        self.players_max = array.array("I", [0]) * length
+        self.players_count = array.array("I", [0]) * length
+        self.latency_sum = array.array("d", [0]) * length
+        self.latency_count = array.array("I", [0]) * length
+
+    # players and latency_ms are None when the server didn't answer
+    def add(self, timestamp, up, players, latency_ms):
+        bucket = int(timestamp // self.resolution)
+        slot = bucket % self.length
+        if self.buckets[slot] != bucket:
+            if self.buckets[slot] > bucket:
+                # older than anything this tier still holds for the slot
+                return
+            self.buckets[slot] = bucket
+            self.samples[slot] = 0
+            self.up[slot] = 0
+            self.players_sum[slot] = 0
+            self.players_max[slot] = 0
+            self.players_count[slot] = 0
+            self.latency_sum[slot] = 0
+            self.latency_count[slot] = 0
+
+        self.samples[slot] += 1
+        if up:
+            self.up[slot] += 1
+        if players is not None:
+            self.players_sum[slot] += players
+            self.players_max[slot] = max(self.players_max[slot], players)
+            self.players_count[slot] += 1
+        if latency_ms is not None:
+            self.latency_sum[slot] += latency_ms
+            self.latency_count[slot] += 1
+
+    # {"tier", "resolution", "start", "health", "players_avg", "players_max", "latency_ms"}
+    # each list has one value per bucket, from start (unix time) up to the one holding now,
+    # None where there were no samples (or, for the averages, no answers)
+    def series(self, now, since=None) -> dict:
+        last = int(now // self.resolution)
+        first = last - self.length + 1
+        if since is not None:
+            first = min(max(first, int(since // self.resolution)), last)
+
+        result = {
+            "tier": self.name,
+            "resolution": self.resolution,
+            "start": first * self.resolution,
+            "health": [],
+            "players_avg": [],
+            "players_max": [],
+            "latency_ms": []
+        }
+        for bucket in range(first, last + 1):
+            slot = bucket % self.length
+            samples = self.samples[slot] if self.buckets[slot] == bucket else 0
+            players_count = self.players_count[slot] if samples > 0 else 0
+            latency_count = self.latency_count[slot] if samples > 0 else 0
+            result["health"].append(round(self.up[slot] / samples, 3) if samples > 0 else None)
+            result["players_avg"].append(round(self.players_sum[slot] / players_count, 2) if players_count > 0 else None)
+            result["players_max"].append(self.players_max[slot] if players_count > 0 else None)
+            result["latency_ms"].append(round(self.latency_sum[slot] / latency_count, 1) if latency_count > 0 else None)
+        return result
+
+class History():
+    # tiers: {name: (seconds per bucket, buckets kept)}
+    def __init__(self, tiers: dict):
+        self.tiers = {name: Tier(name, resolution, length) for (name, (resolution, length)) in tiers.items()}
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, up, players, latency_ms):
+        with self.lock:
+            for tier in self.tiers.values():
+                tier.add(timestamp, up, players, latency_ms)
+
+    # raises KeyError for an unknown tier
+    def series(self, tier_name, now, since=None) -> dict:
+        with self.lock:
+            return self.tiers[tier_name].series(now, since)
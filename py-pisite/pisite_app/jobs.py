@@ -0,0 +1,231 @@
+# game server operations on main (start, stop, restart) as background jobs
+# POST /api/servers/<name> enqueues one and answers with it right away, so the http request never waits on tmux
+# or the server's process, and the job's progress and result are polled (GET /api/jobs/<id>) or streamed
+# (GET /api/jobs/<id>/stream, server-sent events)
+# each job is a small json file in the jobs directory shared by all workers, rewritten whole on every change
+# a job runs in the worker that took the request, on that worker's executor thread for the server, and jobs of
+# one server run one at a time across every worker by holding an flock on the server's lock file for the whole job
+# jobs of different servers never wait on each other
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import threading
+import contextlib
+import concurrent.futures
+
+import pisite_app.statusfeed as statusfeed
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+# raised by an operation to fail its job, with a message for the user
+class JobError(Exception):
+    pass
+
+# https://html.spec.whatwg.org/multipage/server-sent-events.html
+def format_event(job) -> str:
+    return "id: {}\nevent: job\ndata: {}\n\n".format(job["version"], json.dumps(job))
+
+class JobQueue():
+    # operations: {name: function(server name, progress) -> result message}, progress(message) records a step
+    # on_finished(job) runs after every job, in the executor's thread
+    def __init__(self, jobs_dir, operations: dict, keep_seconds, on_finished=None):
+        self.jobs_dir = os.path.abspath(jobs_dir)
+        self.operations = operations
+        self.keep_seconds = keep_seconds
+        self.on_finished = on_finished
+
+        self.lock = threading.Lock()
+        self.executors = dict() # server name: single thread executor
+        self.executors_pid = None # threads don't survive a fork, so this is checked against os.getpid()
+
+    # {"id", "server", "operation", "state", "message", "progress": [{"at", "message"}],
+    #  "created_at", "started_at", "finished_at", "pid", "version"}, times are unix times
+    # an unfinished job of the same operation on the server is returned instead of queueing another
+    # raises ValueError for an unknown operation
+    def enqueue(self, server, operation) -> dict:
+        if operation not in self.operations:
+            raise ValueError("unknown operation {}".format(operation))
+        self.sweep()
+
+        with self._flock(os.path.join(self.jobs_dir, "queue.lock")):
+            for job in self.list(server):
+                if job["operation"] == operation and job["state"] not in FINISHED:
+                    return job
+
+            now = time.time()
+            job = {
+                "id": uuid.uuid4().hex,
+                "server": server,
+                "operation": operation,
+                "state": QUEUED,
+                "message": None,
+                "progress": [],
+                "created_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "pid": os.getpid(),
+                "version": 0
+            }
+            self._write(job)
+            # the executor changes job from here on, the caller gets its own copy
+            answer = dict(job, progress=list(job["progress"]))
+
+        self._executor(server).submit(self._run, job)
+        return answer
+
+    # the job, or None if there is no such job (or it was swept)
+    def get(self, job_id) -> dict:
+        path = self._path(job_id)
+        if path is None:
+            return None
+        return self._read(path)
+
+    # newest first, of one server or all of them
+    def list(self, server=None, limit=None) -> list:
+        try:
+            names = os.listdir(self.jobs_dir)
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            job = self._read(os.path.join(self.jobs_dir, name))
+            if job is not None and (server is None or job["server"] == server):
+                found.append(job)
+        found.sort(key=lambda job: job["created_at"], reverse=True)
+        return found if limit is None else found[:limit]
+
+    # delete jobs that finished (or were lost) more than keep_seconds ago
+    def sweep(self):
+        oldest = time.time() - self.keep_seconds
+        for job in self.list():
+            if (job["finished_at"] or job["created_at"]) < oldest and job["state"] in FINISHED:
+                try:
+                    os.remove(self._path(job["id"]))
+                except FileNotFoundError:
+                    pass
+
+    # server-sent events of a job, the whole job each time it changes, ending once it's finished
+    # or after max_seconds (keep it under the worker timeout), the browser reconnects with the last version it saw
+    # heartbeat is seconds between keepalive comments, which also notice clients that went away
+    def events(self, job_id, version, poll_interval, heartbeat, max_seconds):
+        yield statusfeed.format_retry(poll_interval * 4)
+        deadline = time.monotonic() + max_seconds
+        last_sent = time.monotonic()
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            if job["version"] != version:
+                version = job["version"]
+                last_sent = time.monotonic()
+                yield format_event(job)
+            if job["state"] in FINISHED or time.monotonic() >= deadline:
+                return
+            if time.monotonic() - last_sent >= heartbeat:
+                last_sent = time.monotonic()
+                yield statusfeed.KEEPALIVE_EVENT
+            time.sleep(poll_interval)
+
+    def _executor(self, server) -> concurrent.futures.ThreadPoolExecutor:
+        with self.lock:
+            if self.executors_pid != os.getpid():
+                self.executors = dict()
+                self.executors_pid = os.getpid()
+            if server not in self.executors:
+                self.executors[server] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="pisite-jobs-{}".format(server))
+            return self.executors[server]
+
+    def _run(self, job):
+        lock_path = os.path.join(self.jobs_dir, "{}.lock".format(job["server"]))
+        with self._flock(lock_path, wait=False) as locked:
+            if not locked:
+                self._progress(job, "waiting for another job on {} to finish".format(job["server"]))
+        with self._flock(lock_path):
+            job["state"] = RUNNING
+            job["started_at"] = time.time()
+            self._write(job)
+
+            try:
+                job["message"] = self.operations[job["operation"]](job["server"], lambda message: self._progress(job, message))
+                job["state"] = SUCCEEDED
+            except JobError as e:
+                job["message"] = e.args[0]
+                job["state"] = FAILED
+            except Exception as e:
+                print("job {} ({} {}) failed: {}".format(job["id"], job["operation"], job["server"], e))
+                job["message"] = "unexpected error: {}".format(e)
+                job["state"] = FAILED
+            job["finished_at"] = time.time()
+            self._write(job)
+
+        if self.on_finished is not None:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                print("job {} finished, but on_finished failed: {}".format(job["id"], e))
+
+    def _progress(self, job, message):
+        job["progress"].append({"at": time.time(), "message": message})
+        self._write(job)
+
+    # None for anything that isn't a job id, so ids can't point outside the jobs directory
+    def _path(self, job_id) -> str:
+        if not isinstance(job_id, str) or len(job_id) != 32 or any(c not in "0123456789abcdef" for c in job_id):
+            return None
+        return os.path.join(self.jobs_dir, job_id + ".json")
+
+    def _read(self, path) -> dict:
+        try:
+            with open(path, "r") as job_file:
+                job = json.load(job_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if job["state"] not in FINISHED and not _alive(job["pid"]):
+            # its worker exited (or was killed) before finishing, the server's lock went with it
+            job["state"] = FAILED
+            job["message"] = "the worker running the job exited before it finished"
+            job["finished_at"] = job["finished_at"] or job["started_at"] or job["created_at"]
+        return job
+
+    # only the job's own executor thread writes it after it's queued
+    def _write(self, job):
+        job["version"] += 1
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        # write then rename, readers never see a partial file
+        path = self._path(job["id"])
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as job_file:
+            json.dump(job, job_file)
+        os.replace(temp_path, path)
+
+    # yields whether the lock was taken, only ever False without wait
+    @contextlib.contextmanager
+    def _flock(self, lock_path, wait=True):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with open(lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+def _alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process has the pid now
+        return False
+    return True
@@ -0,0 +1,28 @@
+# connections to small sqlite databases shared by all worker processes on the pi
+# (sessions, login throttling), kept separate from the sqlalchemy user database
+
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+# one connection per thread and process, created on first use
+# connections are in autocommit mode, use BEGIN explicitly for transactions
+def connect(path) -> sqlite3.Connection:
+    path = os.path.abspath(path)
+    key = (os.getpid(), path) # connections must not be shared with a forked child
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    connection = connections.get(key)
+    if connection is None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        # readers don't block the writer and the other way around, fewer fsyncs on the SD card
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connections[key] = connection
+
+    return connection
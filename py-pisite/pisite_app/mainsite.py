@@ -1,24 +1,27 @@
-import os
 import flask
 
-from pisite_app.common import ResponseData, jsonify_if_dataclass, StatusResponse, DataLine
+from pisite_app.common import ResponseData, jsonify_if_dataclass
+import pisite_app.batch as batch
+import pisite_app.metrics as metrics
+import pisite_app.profiling as profiling
+import pisite_app.processregistry as processregistry
+import pisite_app.collector as collector
+import pisite_app.gameservers as gameservers
+import pisite_app.jobs as jobs
+import pisite_app.statusfeed as statusfeed
 
-import functools
-import subprocess
-import datetime
+import time
 import json
-import psutil
-import libtmux
-import mcstatus
-import subprocess
-import shlex
-import threading
+import concurrent.futures
 
 from flask_talisman import Talisman
 
 # create and configure flaskapp
 app = flask.Flask(__name__, instance_relative_config=True)
 
+# request latency and counts, before talisman and verify_connection so all of it is timed and rejected requests count too
+metrics.init_app(app, "main")
+
 # load talisman defaults
 Talisman(app)
 
@@ -31,8 +34,55 @@ app.config.from_pyfile("config.py")
 if app.debug:
     print("debug mode, secret key: " + app.secret_key)
 
-# server startup lock
-lock = threading.Lock()
+# profiles some requests, off unless configured
+profiling.init_app(app, "main")
+
+# game server processes, checked without scanning the process table, see pisite_app/processregistry.py
+# each server with a process probe adds itself
+process_registry = processregistry.ProcessRegistry(
+    app.config["PROCESS_REGISTRY_STATE_FILE"],
+    dict(),
+    app.config["PROCESS_REGISTRY_RECONCILE_INTERVAL"]
+)
+
+# the declared game servers, see pisite_app/gameservers.py
+game_servers = gameservers.load(app.config, process_registry)
+
+# game server status, probed in its own process by `python -m pisite_app.collector` and read by the workers
+status_collector = collector.Collector(app.config["COLLECTOR_SOCKET"], app.config["MAIN_API_KEY"].encode("utf-8"))
+collector_client = collector.CollectorClient(
+    app.config["COLLECTOR_SOCKET"],
+    app.config["MAIN_API_KEY"].encode("utf-8"),
+    app.config["COLLECTOR_CLIENT_TIMEOUT"]
+)
+# every server on its own schedule, its history (if it has one) sampled by its history probe
+for server in game_servers.values():
+    for probe in server.probes.values():
+        status_collector.add(
+            server.collector_key(probe),
+            probe.timed_run,
+            server.interval,
+            probe.timeout,
+            probe.timeout_values,
+            server.record_history if probe is server.history_probe else None
+        )
+status_collector.handle("history", lambda name, tier, since: game_servers[name].history.series(tier, time.time(), since))
+
+# start, stop and restart, run in the background, see pisite_app/jobs.py
+job_queue = jobs.JobQueue(
+    app.config["JOBS_DIR"],
+    {
+        "on": lambda name, progress: game_servers[name].run_start(progress),
+        "off": lambda name, progress: game_servers[name].run_stop(progress),
+        "restart": lambda name, progress: game_servers[name].run_restart(progress)
+    },
+    app.config["JOBS_KEEP_SECONDS"],
+    # the status changed, don't wait for the collector's schedule
+    lambda job: collector_client.request_refresh()
+)
+
+# runs the requests of /api/batch
+batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=app.config["BATCH_THREADS"], thread_name_prefix="pisite-batch")
 
 # run before each request
 @app.before_request
@@ -58,13 +108,49 @@ def verify_connection():
 def ack():
     return ResponseData(True, "pong! :)")
 
-@app.route("/api/mc", methods=("GET","POST"))
+# prometheus metrics of every main worker, scraped through the pi's /api/metrics/main
+@app.route("/api/metrics", methods=("GET", ))
+@batch.exclude
+def api_metrics():
+    return metrics.response()
+
+# several GETs in one request from the pi, see pisite_app/batch.py
+@app.route("/api/batch", methods=("POST",))
 @jsonify_if_dataclass
-def minecraft():
+@batch.exclude
+def api_batch():
+    try:
+        data = json.loads(flask.request.data)
+    except json.decoder.JSONDecodeError:
+        return ResponseData(False, "invalid JSON")
+
+    sub_requests, error = batch.parse(data, app.config["BATCH_MAX_REQUESTS"])
+    if error is not None:
+        return ResponseData(False, error)
+
+    return ResponseData(True, None, {
+        "responses": batch.run(batch_pool, sub_requests)
+    })
+
+# the declared game servers, the pi's /api/endpoints lists them
+@app.route("/api/servers", methods=("GET",))
+@jsonify_if_dataclass
+def servers():
+    return ResponseData(True, None, [
+        {"name": server.name, "title": server.title, "endpoint": server.endpoint}
+        for server in game_servers.values()
+    ])
+
+@app.route("/api/servers/<name>", methods=("GET", "POST"))
+@jsonify_if_dataclass
+def server_api(name):
+    server = game_servers.get(name)
+    if server is None:
+        return ResponseData(False, "unknown server {}".format(name))
 
     if flask.request.method == "GET":
-        mc_status: MinecraftStatus = MinecraftStatus()
-        return mc_status.to_response()
+        status = server.collected_status(collector_client.snapshot() or dict(), app.config["COLLECTOR_MAX_AGE"])
+        return status.to_response()
     if flask.request.method == "POST":
         try:
             data = json.loads(flask.request.data)
@@ -73,46 +159,112 @@ def minecraft():
         
         try:
             operation = data["operation"]
-        except json.decoder.JSONDecodeError:
+        except (KeyError, TypeError):
             return ResponseData(False, "must include operation field")
     
-        result: dict = None
-        if operation == "on":
-            bad_response = None
-            return_bad_response = False
-            lock.acquire() # acquire lock
-            try:
-                mc_status: MinecraftStatus = MinecraftStatus()
-                if mc_status.any_true:
-                    return_bad_response = True
-                    bad_response = ResponseData(False, "server is already on or starting up")
-                else:
-                    try:
-                        result = start_minecraft()
-                        return ResponseData(True)
-                    except FileNotFoundError as e:
-                        return_bad_response = True
-                        bad_response = ResponseData(False, e.args[0])
-            finally:
-                lock.release() # release lock
-            if return_bad_response:
-                return bad_response
-            if result == False:
-                return ResponseData(False, "tmux error")
-        elif operation == "off":
-            # turn off minecraft server
-            # TODO:
-            return ResponseData(False, "unimplemented")
-        else:
+        # "on", "off" or "restart", answered with the queued job, see /api/jobs/<job_id>
+        try:
+            job = job_queue.enqueue(name, operation)
+        except ValueError:
             return ResponseData(False, "invalid operation")
+        return ResponseData(True, None, job)
+
+# recent jobs, newest first, ?server= only those of one server
+@app.route("/api/jobs", methods=("GET",))
+@jsonify_if_dataclass
+def jobs_api():
+    server = flask.request.args.get("server")
+    if server is not None and server not in game_servers:
+        return ResponseData(False, "unknown server {}".format(server))
+    return ResponseData(True, None, job_queue.list(server, app.config["JOBS_LIST_LIMIT"]))
+
+@app.route("/api/jobs/<job_id>", methods=("GET",))
+@jsonify_if_dataclass
+def job_api(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return ResponseData(False, "unknown job {}".format(job_id))
+    return ResponseData(True, None, job)
+
+# server-sent events with the job whenever it changes, until it's finished or JOBS_STREAM_MAX_SECONDS pass
+# every stream holds a worker thread here, and one on the pi relaying it, so they're limited across all workers
+@app.route("/api/jobs/<job_id>/stream", methods=("GET",))
+@jsonify_if_dataclass
+@batch.exclude
+def job_stream(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return ResponseData(False, "unknown job {}".format(job_id))
+
+    last_version = statusfeed.parse_last_event_id(flask.request.headers.get("Last-Event-ID"))
+    if job["state"] in jobs.FINISHED and job["version"] == last_version:
+        # the browser already has the result, 204 stops it from reconnecting
+        return flask.Response(status=204)
+
+    if not flask.request.environ.get("wsgi.multithread"):
+        # a sync worker would be held for the whole stream
+        return ResponseData(False, "job streams need threaded workers, poll instead")
+    slot = statusfeed.take_slot(app.config["JOBS_STREAM_SLOT_DIR"], app.config["JOBS_STREAM_MAX_CLIENTS"])
+    if slot is None:
+        return ResponseData(False, "too many job streams open, poll instead")
+
+    response: flask.Response = flask.Response(
+        job_queue.events(
+            job_id,
+            last_version,
+            app.config["JOBS_STREAM_POLL_INTERVAL"],
+            app.config["JOBS_STREAM_HEARTBEAT"],
+            app.config["JOBS_STREAM_MAX_SECONDS"]
+        ),
+        mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.call_on_close(slot.close)
+    return response
+
+# a server over time, from the collector's memory, the server itself isn't asked
+# ?tier= one of HISTORY_TIERS (default minute), &since= unix time (default as far back as the tier goes)
+@app.route("/api/servers/<name>/history", methods=("GET",))
+@jsonify_if_dataclass
+def server_history(name):
+    server = game_servers.get(name)
+    if server is None:
+        return ResponseData(False, "unknown server {}".format(name))
+    if server.history is None:
+        return ResponseData(False, "{} has no probe that keeps a history".format(name))
+
+    tier = flask.request.args.get("tier", "minute")
+    if tier not in app.config["HISTORY_TIERS"]:
+        return ResponseData(False, "tier must be one of {}".format(", ".join(app.config["HISTORY_TIERS"])))
+    since = flask.request.args.get("since")
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            return ResponseData(False, "since must be a unix time")
+
+    series = collector_client.query("history", name, tier, since)
+    if series is None:
+        return ResponseData(False, "history isn't available, the status collector isn't running")
+    return ResponseData(True, None, series)
+
+# older endpoints of single servers, used by the pi's defaults
+@app.route("/api/mc", methods=("GET","POST"))
+@jsonify_if_dataclass
+def minecraft():
+    return server_api(name="minecraft")
+
+@app.route("/api/mc/history", methods=("GET",))
+@jsonify_if_dataclass
+def minecraft_history():
+    return server_history(name="minecraft")
 
 @app.route("/api/left", methods=("GET", "POST"))
 @jsonify_if_dataclass
 def left():
-    if flask.request.method == "GET":
-        return ResponseData(False, "unimplemented")
-    if flask.request.method == "POST":
-        return ResponseData(False, "unimplemented")
+    if "left4dead2" in game_servers:
+        return server_api(name="left4dead2")
+    return ResponseData(False, "unimplemented")
 
 ## dynmap
 
@@ -124,93 +276,3 @@ def page_dynmap():
 @app.route("/dynmap/<path:ext>", methods=("GET",))
 def dynmap_ext(ext):
     return flask.send_from_directory(app.config["DYNMAP_PATH"], ext)
-
-## helper code
-
-class MinecraftStatus():
-    def __init__(self):
-        self.tmux_window_running = False
-        try:
-            tmux_server = libtmux.Server()
-            tmux_sessions = tmux_server.list_sessions()
-
-            tmux_session_names = list()
-            for session in tmux_sessions:
-                # print(session.name)
-                tmux_session_names.append(session.name)
-
-            self.tmux_window_running = app.config["MC_TMUX_SESSION"] in [session.name for session in tmux_sessions]
-        except:
-            pass
-        
-        self.process_running = False
-        try:
-            for proc in psutil.process_iter():
-                cmdline = proc.cmdline()
-                # print(cmdline)
-                for token in cmdline:
-                    java = False
-                    mc_or_forge = False
-                    if "java" in cmdline:
-                        java = True
-                    if "forge" in token or "minecraft" in token:
-                        mc_or_forge = True
-                    if java and mc_or_forge:
-                        self.process_running = True
-        except:
-            pass
-        
-        self.info = dict()
-        self.mc_status_ping = False
-        try:
-            mc_server = mcstatus.MinecraftServer("localhost")
-            ping = mc_server.ping()
-            self.mc_status_ping = (ping > 0)
-
-            query = mc_server.query()
-            self.info["motd"] = query.motd
-            self.info["players"] = query.players.names
-        except:
-            pass
-    
-        self.any_true = self.tmux_window_running or self.process_running or self.mc_status_ping
-
-        # print("tmux: {}, proc: {}, mcquery: {}, any: {}".format(
-        #     self.tmux_window_running,
-        #     self.process_running,
-        #     self.mc_status_ping,
-        #     self.any_true)
-        # )
-    
-    def to_response(self):
-        statuses = {
-            "mc_status_ping": self.mc_status_ping,
-            "process_running": self.process_running,
-            "tmux_window_running": self.tmux_window_running
-        }
-
-        return ResponseData(True, None, StatusResponse(any_power=self.any_true, statuses=statuses, info=self.info))
-    
-        
-# preconditions: 
-#   minecraft is not already running
-#   lock is acquired
-# throws FileNotFoundError
-def start_minecraft():
-    if not os.path.exists(app.config["MC_START_SCRIPT"]):
-        raise FileNotFoundError("minecraft start script not found")
-    if not os.path.isdir(app.config["MC_START_DIR"]):
-        raise FileNotFoundError("minecraft start dir not found")
-
-    try:
-        tmux_server = libtmux.Server()
-        # start the session
-        _session = tmux_server.new_session(
-            session_name=app.config["MC_TMUX_SESSION"], 
-            start_directory=app.config["MC_START_DIR"], 
-            window_command=app.config["MC_START_SCRIPT"],
-        )
-    except:
-        return False
-    
-    return True
\ No newline at end of file
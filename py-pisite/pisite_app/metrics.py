@@ -0,0 +1,89 @@
+# prometheus metrics for both apps, served in the text format by GET /api/metrics
+# under gunicorn every worker is its own process, so values are kept in files in PROMETHEUS_MULTIPROC_DIR
+# and added up when scraped, the variable has to be set before the app is imported (see gunicorn-pisite-config.py)
+# without it (e.g. the flask dev server) only this process' values are served
+
+import os
+import time
+
+import flask
+import prometheus_client
+from prometheus_client import multiprocess
+
+# outcomes of requests forwarded to main
+SUCCESS = "success"
+TIMEOUT = "timeout"
+CONNECTION_ERROR = "connection_error"
+CIRCUIT_OPEN = "circuit_open" # not attempted, main is known to be off
+
+# requests are labeled by route, not path, so the number of series stays bounded
+REQUEST_DURATION = prometheus_client.Histogram(
+    "pisite_request_duration_seconds",
+    "Time until the response started, by route",
+    ["app", "route", "method"]
+)
+REQUESTS = prometheus_client.Counter(
+    "pisite_requests_total",
+    "Requests handled, by route and status code",
+    ["app", "route", "method", "status"]
+)
+
+FORWARD_DURATION = prometheus_client.Histogram(
+    "pisite_forward_duration_seconds",
+    "Time until main answered a forwarded request, by outcome",
+    ["outcome"]
+)
+FORWARDS = prometheus_client.Counter(
+    "pisite_forwards_total",
+    "Requests forwarded to main, by outcome",
+    ["outcome"]
+)
+
+PASSWORD_HASH_DURATION = prometheus_client.Histogram(
+    "pisite_password_hash_duration_seconds",
+    "Time waiting for a hashing slot (queue) and hashing (hash)",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
+PASSWORD_HASH_REJECTED = prometheus_client.Counter(
+    "pisite_password_hash_rejected_total",
+    "Hashes refused because the queue was full or a slot didn't free up in time"
+)
+
+GAME_SERVER_PROBE_DURATION = prometheus_client.Histogram(
+    "pisite_game_server_probe_duration_seconds",
+    "Time taken by each probe of a game server's status, and all of them in a request (total)",
+    ["server", "probe"]
+)
+
+# time and count every request of app, labeled with name ("pi" or "main")
+def init_app(app: flask.Flask, name):
+    @app.before_request
+    def start_timer():
+        flask.g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response: flask.Response):
+        started = flask.g.get("metrics_started")
+        if started is None:
+            return response
+        rule = flask.request.url_rule
+        route = "unmatched" if rule is None else rule.rule
+        method = flask.request.method
+        REQUEST_DURATION.labels(name, route, method).observe(time.perf_counter() - started)
+        REQUESTS.labels(name, route, method, str(response.status_code)).inc()
+        return response
+
+# started is a time.perf_counter() value from before the request to main
+def record_forward(outcome, started):
+    FORWARDS.labels(outcome).inc()
+    if outcome != CIRCUIT_OPEN:
+        FORWARD_DURATION.labels(outcome).observe(time.perf_counter() - started)
+
+# the text format of every metric, from every worker process
+def response() -> flask.Response:
+    registry = prometheus_client.REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return flask.Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
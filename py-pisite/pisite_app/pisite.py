@@ -1,16 +1,32 @@
-import os
-
 import flask
 from pisite_app.common import ResponseData, print_session_values, print_request_headers, Endpoint, jsonify_if_dataclass, StatusResponse
 import pisite_app.auth as auth
+import pisite_app.tilecache as tilecache
+import pisite_app.reachability as reachability
+import pisite_app.powerprobe as powerprobe
+import pisite_app.sessions as sessions
+import pisite_app.authcontext as authcontext
+import pisite_app.assets as assets
+import pisite_app.hashing as hashing
+import pisite_app.throttle as throttle
+import pisite_app.channel as channel
+import pisite_app.batch as batch
+import pisite_app.statusfeed as statusfeed
+import pisite_app.boot as boot
+import pisite_app.responsecache as responsecache
+import pisite_app.metrics as metrics
+import pisite_app.profiling as profiling
 
+import math
+import time
+import posixpath
 import functools
-import subprocess
+import concurrent.futures
 import datetime
 import json
 import requests
-import subprocess
-import shlex
+import urllib3
+import secrets
 import wakeonlan
 
 from flask_talisman import Talisman
@@ -19,6 +35,9 @@ from flask_session import Session
 # create and configure flaskapp
 app = flask.Flask(__name__, instance_relative_config=True)
 
+# request latency and counts, before talisman and any other before_request so all of it is timed
+metrics.init_app(app, "pi")
+
 # load talisman 
 # https://stackoverflow.com/a/50873957
 # https://github.com/angular/angular-cli/issues/3430
@@ -47,19 +66,121 @@ app.config.from_pyfile("config.py")
 if app.debug:
     print("debug mode, secret key: " + app.secret_key)
 
-# load flask-session defaults
-Session(app)
+# load sessions
+if app.config["SESSION_TYPE"] == "sqlite":
+    sessions.init_app(app)
+else:
+    # flask-session defaults
+    Session(app)
 
 # set up sqlalchemy inside auth
 auth.db.init_app(app)
 
+# cache of who is logged in, invalidated by changes to users and groups
+authcontext.init_app(app)
+
+# profiles some requests, off unless configured
+profiling.init_app(app, "pi")
+
 # app.add_url_rule('/', endpoint='index')
 
+# index the react build, with compressed variants
+react_assets = assets.AssetIndex(
+    app.config["REACT_BASE_DIR"],
+    app.config["ASSET_CACHE_DIR"],
+    app.config["ASSET_COMPRESS_MIN_BYTES"]
+)
+
+# limits login attempts per ip and per username, across all workers
+login_throttle = throttle.LoginThrottle(
+    app.config["LOGIN_THROTTLE_PATH"],
+    throttle.BucketLimit(app.config["LOGIN_THROTTLE_IP_BURST"], app.config["LOGIN_THROTTLE_IP_PER_MINUTE"]),
+    throttle.BucketLimit(app.config["LOGIN_THROTTLE_USERNAME_BURST"], app.config["LOGIN_THROTTLE_USERNAME_PER_MINUTE"]),
+    app.config["LOGIN_THROTTLE_SWEEP_INTERVAL"]
+)
+
+# this worker's password hashing child, started while the worker has no other threads
+hashing.init_app(app)
+
 # set up http client with certificates
 request_session: requests.Session = requests.Session()
 request_timeout = 1 # seconds
 request_session.verify = app.config["PATH_TO_MAIN_CERTFILE"]
 
+# persistent mutual TLS connection to main for forwarded requests, https is used while it's down
+main_channel: channel.ChannelClient = None
+if app.config["MAIN_CHANNEL_PORT"] is not None:
+    main_channel = channel.ChannelClient(
+        app.config["MAIN_IP"],
+        app.config["MAIN_CHANNEL_PORT"],
+        channel.client_context(
+            app.config["PATH_TO_MAIN_CHANNEL_CERTFILE"],
+            app.config["PATH_TO_PI_CHANNEL_CERTFILE"],
+            app.config["PATH_TO_PI_CHANNEL_KEYFILE"]
+        ),
+        app.config["CHANNEL_CONNECT_TIMEOUT"],
+        app.config["CHANNEL_KEEPALIVE_INTERVAL"],
+        app.config["CHANNEL_KEEPALIVE_TIMEOUT"],
+        app.config["CHANNEL_RECONNECT_BACKOFF"]
+    )
+
+# runs the local parts of /api/batch
+batch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=app.config["BATCH_THREADS"], thread_name_prefix="pisite-batch")
+
+# on-disk cache for files forwarded from main's dynmap
+tile_cache = tilecache.TileCache(
+    app.config["DYNMAP_CACHE_DIR"],
+    app.config["DYNMAP_CACHE_MAX_BYTES"],
+    app.config["DYNMAP_CACHE_MAX_ENTRY_BYTES"]
+)
+
+# short-lived cache for GETs to main endpoints in FORWARD_CACHE_TTLS
+forward_cache = responsecache.ResponseCache(
+    app.config["FORWARD_CACHE_DIR"],
+    app.config["FORWARD_CACHE_MAX_ENTRY_BYTES"],
+    max(app.config["FORWARD_CACHE_TTLS"].values(), default=0)
+)
+
+# checks whether main is on, shared by GET /api/power and main_reachability
+power_probe = powerprobe.PowerProbe(
+    app.config["POWER_PROBE_STATE_FILE"],
+    app.config["MAIN_IP"],
+    app.config["POWER_PROBE_TCP_PORTS"] + [app.config["MAIN_PORT"]],
+    lambda: ack_main(),
+    app.config["POWER_PROBE_TIMEOUT"],
+    app.config["POWER_PROBE_TTL"]
+)
+
+# tracks whether main is up, forwards fail fast while it isn't
+main_reachability = reachability.ReachabilityTracker(
+    app.config["REACHABILITY_STATE_FILE"],
+    lambda: probe_main(),
+    app.config["REACHABILITY_INTERVAL"],
+    app.config["REACHABILITY_DOWN_INTERVAL"]
+)
+main_circuit = reachability.CircuitBreaker(main_reachability, app.config["CIRCUIT_FAILURE_THRESHOLD"])
+
+# wakes main up for POST /api/power, one boot at a time across all workers
+boot_orchestrator = boot.BootOrchestrator(
+    app.config["BOOT_STATE_FILE"],
+    lambda: wakeonlan.send_magic_packet(app.config["MAIN_MAC"]),
+    lambda: power_probe.result(max_age=boot.POLL_INTERVAL),
+    lambda: main_services_ready(),
+    # forwards resume as soon as main answers, instead of at the next reachability probe
+    lambda: main_reachability.request_probe(),
+    app.config["BOOT_RESEND_INITIAL"],
+    app.config["BOOT_RESEND_MAX"],
+    app.config["BOOT_TIMEOUT"],
+    app.config["BOOT_HISTORY_SIZE"]
+)
+
+# status pushed to GET /api/status/stream, produced by one worker while anyone is watching
+status_feed = statusfeed.StatusFeed(
+    app.config["STATUS_STREAM_STATE_FILE"],
+    lambda: produce_status(),
+    app.config["STATUS_STREAM_INTERVAL"]
+)
+
 # function decorator to require login
 def require_login(func):
     @functools.wraps(func)
@@ -76,16 +197,30 @@ def require_group(group):
     def decorator(func):
         @functools.wraps(func)
         def wrapped_func(**kwargs):
-            user = current_user()
-            desired_group = auth.Group.query.filter(auth.Group.name == group).first()
+            context = authcontext.current()
 
-            if desired_group is None or desired_group not in user.groups:
+            if context is None or group not in context.groups:
                 return ResponseData(False, "insufficient group membership")
 
             return func (**kwargs)
         return wrapped_func
     return decorator
 
+# function decorator for metrics, for a scraper with METRICS_TOKEN as its bearer token, or an admin
+def require_metrics_access(func):
+    @functools.wraps(func)
+    def wrapped_func(**kwargs):
+        token = app.config["METRICS_TOKEN"]
+        authorization = flask.request.headers.get("Authorization", "")
+        if token is not None and secrets.compare_digest(authorization.encode("utf-8"), "Bearer {}".format(token).encode("utf-8")):
+            return func (**kwargs)
+
+        context = authcontext.current()
+        if context is None or "admin" not in context.groups:
+            return ResponseData(False, "insufficient group membership")
+        return func (**kwargs)
+    return wrapped_func
+
 # function decorator to require login
 def page_require_login(view):
     @functools.wraps(view)
@@ -120,15 +255,42 @@ def require_json_fields(post: list=None, get: list=None):
         return wrapped_func
     return decorator
 
+# function decorator for views whose response is a forward to main
+# when served through pisite_app.asgi, forwards made by the view are handed back to the
+# event loop and done asynchronously instead of holding a worker thread
+def async_forward(func):
+    @functools.wraps(func)
+    def wrapped_func(**kwargs):
+        flask.g.async_handoff = async_handoff_requested()
+        return func (**kwargs)
+    # copied to the outer wrappers by functools.wraps, lets pisite_app.asgi find these views
+    wrapped_func.async_forward = True
+    return wrapped_func
+
+# function decorator for views that never need to know who the user is (static files, tiles)
+# before() skips looking up the user for them, require_login still works as it only reads the session
+def skip_user_lookup(func):
+    @functools.wraps(func)
+    def wrapped_func(**kwargs):
+        return func (**kwargs)
+    # copied to the outer wrappers by functools.wraps
+    wrapped_func.skip_user_lookup = True
+    return wrapped_func
+
 # run before each request is processed
 @app.before_request
 def before():
-    user = current_user()
-    
+    view = app.view_functions.get(flask.request.endpoint)
+    if getattr(view, "skip_user_lookup", False):
+        flask.g.username = None
+        return
+
+    context = authcontext.current()
+
     # load stuff into g, which can be used in templates
-    flask.g.username = None if user is None else user.username
+    flask.g.username = None if context is None else context.username
 
-    print("request from user: {}".format(str(user)))
+    print("request from user: {}".format(flask.g.username))
 
     # debug prints
     if app.debug:
@@ -141,19 +303,22 @@ def before():
 ## HTML+JS page routes
 
 @app.route("/", methods=("GET",))
+@skip_user_lookup
 def index():
-    return flask.send_from_directory(app.config["REACT_BASE_DIR"], "index.html")
+    return react_assets.serve("index.html")
 
 @app.route("/<string:subfile>", methods=("GET", ))
+@skip_user_lookup
 def other_file(subfile):
-    return flask.send_from_directory(app.config["REACT_BASE_DIR"], subfile)
+    return react_assets.serve(subfile)
 
 # serve anything inside react's /static/ folders
 @app.route("/static/<string:subdir>/<string:filename>", methods=("GET", ))
+@skip_user_lookup
 def serve_static(subdir, filename):
     accepted_subdirs = ["css", "js", "media"]
     if subdir.lower() in accepted_subdirs:
-        return flask.send_from_directory(os.path.join(app.config["REACT_BASE_DIR"], "static", subdir), filename)
+        return react_assets.serve("static/{}/{}".format(subdir, filename))
     else:
         return flask.abort(404)
 
@@ -170,21 +335,35 @@ def serve_static(subdir, filename):
 @require_json_fields(post=["username", "password"])
 def api_login():
 
-    # clear current user if any
-    flask.session["user_id"] = None
-
     username = flask.g.request_data["username"]
     password = flask.g.request_data["password"]
 
+    # before hashing anything, and before touching the session so rejected attempts don't write it
+    wait = login_throttle.attempt(flask.request.remote_addr, username)
+    if wait > 0:
+        return ResponseData(False, "too many login attempts, try again in {} seconds".format(math.ceil(wait)), {
+            "current_user": None
+        })
+
+    # clear current user if any
+    # popped rather than set to None, so an anonymous session stays empty and is never stored
+    flask.session.pop("user_id", None)
+
     # attempt to validate user here
-    valid, user = auth.validate_user(username, password)
+    try:
+        valid, user = auth.validate_user(username, password)
+    except hashing.HashingBusyError as e:
+        return ResponseData(False, str(e), {
+            "current_user": None
+        })
     
     # TODO: remove this to not leak password attempts in terminal
     if app.debug:
         print("valid login? {} {}: {}".format(username, password, valid))
     
     if valid:
-        # set session user_id
+        # set session user_id, under a new session id so one set before the login can't be used after it
+        sessions.regenerate_sid()
         flask.session["user_id"] = user.id
         flask.session.permanent = True
         return ResponseData(True, None, {
@@ -199,22 +378,55 @@ def api_login():
 @app.route("/api/logout", methods=("POST",))
 @jsonify_if_dataclass
 def api_logout():
-    # TODO: invalidate session
-    flask.session["user_id"] = None
+    # an emptied session is deleted server-side
+    flask.session.clear()
     return ResponseData(True, None, {
         "current_user": None
     })
 
-# TODO: remove this?
+# several GETs in one round trip, e.g. a dashboard refresh, see pisite_app/batch.py
+# authenticated once, and every /api/main/* request goes to main together in a single batch of its own,
+# except those with a FORWARD_CACHE_TTLS entry, which are run like local ones so they go through forward_cache
+@app.route("/api/batch", methods=("POST",))
+@jsonify_if_dataclass
+@require_json_fields(post=["requests"])
+@require_login
+@batch.exclude
+def api_batch():
+    sub_requests, error = batch.parse(flask.g.request_data, app.config["BATCH_MAX_REQUESTS"])
+    if error is not None:
+        return ResponseData(False, error)
+
+    main_requests = [sub_request for sub_request in sub_requests if sub_request.path.startswith(MAIN_API_PREFIX) and not batch_from_cache(sub_request)]
+    local_requests = [sub_request for sub_request in sub_requests if sub_request not in main_requests]
+
+    responses = dict()
+    for sub_request in [sub_request for sub_request in main_requests if not is_main_forwardable(main_batch_endpoint(sub_request))]:
+        responses[id(sub_request)] = batch.error_response(sub_request, "not available through /api/main/")
+        main_requests.remove(sub_request)
+
+    local_futures = batch.submit(batch_pool, local_requests)
+    # needs this request, so it runs here while the local ones run in the pool
+    if len(main_requests) > 0:
+        for (sub_request, sub_response) in zip(main_requests, request_main_batch(main_requests)):
+            responses[id(sub_request)] = sub_response
+    for (sub_request, future) in zip(local_requests, local_futures):
+        responses[id(sub_request)] = future.result()
+
+    return ResponseData(True, None, {
+        "responses": [responses[id(sub_request)] for sub_request in sub_requests]
+    })
+
+# the game servers declared on main, and test endpoints
 @app.route("/api/endpoints", methods=("GET",))
 @jsonify_if_dataclass
 @require_login
 def api_endpoints():
-    # TODO: get information from main
     return ResponseData(True, None,
         [
-            Endpoint("minecraft", "/api/main/mc"),
-            Endpoint("left 4 dead 2", "/api/main/left"),
+            Endpoint(server["title"], "/api/main/" + server["endpoint"][len("api/"):])
+            for server in main_game_servers()
+        ] + [
             Endpoint("dummy test", "/api/test"),
             Endpoint("failure", "/api/main/failure")
         ]
@@ -234,12 +446,16 @@ def api_account():
     if flask.request.method == "POST":
         new_password = flask.g.request_data["new_password"]
 
-        success, message = auth.change_password(user, new_password)
+        try:
+            success, message = auth.change_password(user, new_password)
+        except hashing.HashingBusyError as e:
+            return ResponseData(False, str(e))
 
         if not success:
             return ResponseData(False, message)
         else:
-            # TODO: log out all other sessions for current user
+            # log out all other sessions for current user
+            sessions.delete_other_sessions(user.id)
             return ResponseData(True)
         
 
@@ -272,39 +488,132 @@ def api_admin():
             success = auth.remove_reg_key(target)
             return ResponseData(success)
 
+# paginated admin listings, each page costs the same few queries however many rows there are
+# query args: cursor (next_cursor of the previous page), limit, and the listing's filters
+@app.route("/api/admin/users", methods=("GET",))
+@jsonify_if_dataclass
+@require_login
+@require_group("admin")
+def api_admin_users():
+    args = flask.request.args
+    return admin_listing(lambda after_id, limit: auth.list_users(
+        after_id, limit,
+        username_contains=args.get("username"),
+        group=args.get("group")
+    ))
+
+@app.route("/api/admin/groups", methods=("GET",))
+@jsonify_if_dataclass
+@require_login
+@require_group("admin")
+def api_admin_groups():
+    args = flask.request.args
+    return admin_listing(lambda after_id, limit: auth.list_groups(
+        after_id, limit,
+        name_contains=args.get("name")
+    ))
+
+@app.route("/api/admin/reg_keys", methods=("GET",))
+@jsonify_if_dataclass
+@require_login
+@require_group("admin")
+def api_admin_reg_keys():
+    args = flask.request.args
+    used = args.get("used")
+    if used is not None:
+        if used.lower() not in ("true", "false"):
+            return ResponseData(False, "used must be true or false")
+        used = used.lower() == "true"
+    return admin_listing(lambda after_id, limit: auth.list_reg_keys(
+        after_id, limit,
+        group=args.get("group"),
+        used=used
+    ))
+
+# prometheus metrics of every pi worker
+@app.route("/api/metrics", methods=("GET",))
+@jsonify_if_dataclass
+@require_metrics_access
+def api_metrics():
+    return metrics.response()
+
+# prometheus metrics of main, only the pi can reach main
+@app.route("/api/metrics/main", methods=("GET",))
+@jsonify_if_dataclass
+@require_metrics_access
+def api_metrics_main():
+    try:
+        # main has its own authentication
+        main_response = request_main("api/metrics", {"Authorization": None, "Cookie": None})
+    except reachability.CircuitOpenError as e:
+        return ResponseData(False, str(e))
+    except requests.exceptions.ReadTimeout:
+        return ResponseData(False, "connection to main timed out")
+    except requests.exceptions.ConnectionError:
+        return ResponseData(False, "unable to connect to main")
+    return relay_response(main_response)
+
+# login throttle counters, for monitoring
+@app.route("/api/admin/throttle", methods=("GET",))
+@jsonify_if_dataclass
+@require_login
+@require_group("admin")
+def api_admin_throttle():
+    return ResponseData(True, None, login_throttle.counters())
+
+# server-sent events with the status of main and its game servers, instead of polling
+# each event is the whole status, sent whenever it changes
+@app.route("/api/status/stream", methods=("GET",))
+@jsonify_if_dataclass
+@require_login
+@async_forward
+@skip_user_lookup
+def status_stream():
+    if flask.g.async_handoff:
+        # streamed by pisite_app.asgi without holding a thread
+        return async_stream_response("status")
+
+    if not flask.request.environ.get("wsgi.multithread"):
+        # a sync worker would be held for the whole stream, and killed by gunicorn's worker timeout
+        return ResponseData(False, "status streams need threaded workers, poll instead")
+    slot = statusfeed.take_slot(app.config["STATUS_STREAM_SLOT_DIR"], app.config["STATUS_STREAM_MAX_CLIENTS"])
+    if slot is None:
+        return ResponseData(False, "too many status streams open, poll instead")
+
+    last_version = statusfeed.parse_last_event_id(flask.request.headers.get("Last-Event-ID"))
+    response: flask.Response = flask.Response(
+        status_events(last_version, app.config["STATUS_STREAM_MAX_SECONDS"]),
+        mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.call_on_close(slot.close)
+    return response
+
 @app.route("/api/power", methods=("POST", "GET"))
 @jsonify_if_dataclass
 @require_login
 def power():
     if flask.request.method == "GET":
-        # try to ping it
-        command = shlex.split("ping -c 1 -W 1 {}".format(app.config["MAIN_IP"]))
-        pingable = subprocess.run(command).returncode == 0 # returncode 0 is success
-
-        # try to send a request to main
-        connectable = False
-        response: flask.Response = forward_to_main("/api/ack")
-        try:
-            if json.loads(response.data)["success"]:
-                connectable = True
-        except:
-            connectable = False
+        # ping and ack at the same time, shared with other pollers for POWER_PROBE_TTL
+        result = power_probe.result()
 
-        # return the results
+        # return the results, with the phase and estimates of the latest boot
         return ResponseData(True, None, StatusResponse(
-            pingable or connectable, 
+            result["pingable"] or result["connectable"],
             {
-                "pingable": pingable,
-                "connectable": connectable
-            }, 
-            None))
+                "pingable": result["pingable"],
+                "connectable": result["connectable"]
+            },
+            {"boot": boot_orchestrator.status()}))
     if flask.request.method == "POST":
-        # send the WoL packet
+        if power_probe.result()["connectable"]:
+            return ResponseData(True, "main is already on", boot_orchestrator.status())
+        # send the WoL packet, or join the boot already underway
         try:
-            wakeonlan.send_magic_packet(app.config["MAIN_MAC"])
+            boot_status, joined = boot_orchestrator.power_on()
         except ValueError:
             return ResponseData(False, "invalid MAC address")
-        return ResponseData(True)
+        return ResponseData(True, "main is already booting" if joined else None, boot_status)
 
 
 #TODO: remove 
@@ -332,57 +641,662 @@ def test():
 ## forwarded routes to main
 
 # main api endpoints
-@app.route("/api/main/<endpoint>", methods=("GET", "POST"))
+@app.route("/api/main/<path:endpoint>", methods=("GET", "POST"))
 @jsonify_if_dataclass
 @require_login
+@async_forward
 def forward_api_to_main(endpoint):
+    if not is_main_forwardable("api/{}".format(endpoint)):
+        return ResponseData(False, "not available through /api/main/")
     return forward_to_main("api/{}".format(endpoint))
 
-# dynmap
+# dynmap, served from the tile cache when possible
 @app.route("/dynmap", methods=("GET",))
+@jsonify_if_dataclass
 @page_require_login
+@async_forward
+@skip_user_lookup
 def page_dynmap():
-    return forward_to_main("dynmap")
+    return forward_to_main_cached("dynmap")
 
 @app.route("/dynmap/<path:ext>", methods=("GET",))
+@jsonify_if_dataclass
 @require_login
+@async_forward
+@skip_user_lookup
 def dynmap_ext(ext):
-    return forward_to_main("dynmap/{}".format(ext))
+    return forward_to_main_cached("dynmap/{}".format(ext))
 
 ## helper code
 
+# requests under this are forwarded to main
+MAIN_API_PREFIX = "/api/main/"
+
+# whether users may forward to main_endpoint, i.e. it is one of MAIN_FORWARD_ENDPOINTS or under one
+# the path (without any query string) has to be normalized already, so dot segments or empty segments
+# resolved on the way to main can't reach anything else
+def is_main_forwardable(main_endpoint) -> bool:
+    path = main_endpoint.split("?")[0].split("#")[0]
+    if posixpath.normpath("/" + path) != "/" + path:
+        return False
+    return any(path == allowed or path.startswith(allowed + "/") for allowed in app.config["MAIN_FORWARD_ENDPOINTS"])
+
+# hop-by-hop headers only apply to a single connection and must not be forwarded
+# https://datatracker.ietf.org/doc/html/rfc7230#section-6.1
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# stream the incoming request through to main and relay main's response chunk by chunk,
+# so nothing is held in memory beyond a single chunk
 def forward_to_main(main_endpoint) -> flask.Response:
+    ttl = app.config["FORWARD_CACHE_TTLS"].get(main_endpoint)
+    if ttl is not None and flask.request.method == "GET":
+        return forward_to_main_short_cached(main_endpoint, ttl)
+
+    if flask.g.get("async_handoff"):
+        return async_handoff_response(main_endpoint)
+
+    try:
+        main_response = request_main(main_endpoint)
+    except reachability.CircuitOpenError as e:
+        return ResponseData(False, str(e))
+    except requests.exceptions.ReadTimeout:
+        return ResponseData(False, "connection to main timed out")
+    except requests.exceptions.ConnectionError:
+        return ResponseData(False, "unable to connect to main")
+
+    return relay_response(main_response)
+
+# send the current request to main, without reading either body
+# throws reachability.CircuitOpenError without trying while main is known to be off,
+# and requests.exceptions.ReadTimeout and requests.exceptions.ConnectionError
+# json_body replaces the request's own body, and is POSTed as json
+def request_main(main_endpoint, extra_headers: dict=None, json_body=None) -> requests.Response:
+    started = time.perf_counter()
+    try:
+        main_response = send_to_main(main_endpoint, extra_headers, json_body)
+    except reachability.CircuitOpenError:
+        metrics.record_forward(metrics.CIRCUIT_OPEN, started)
+        raise
+    except requests.exceptions.ReadTimeout:
+        metrics.record_forward(metrics.TIMEOUT, started)
+        raise
+    except requests.exceptions.ConnectionError:
+        metrics.record_forward(metrics.CONNECTION_ERROR, started)
+        raise
+    metrics.record_forward(metrics.SUCCESS, started)
+    return main_response
+
+# request_main, without metrics
+def send_to_main(main_endpoint, extra_headers: dict=None, json_body=None) -> requests.Response:
+    main_circuit.check()
+
     main_url = "https://{}:{}/{}".format(
         app.config["MAIN_IP"],
         app.config["MAIN_PORT"],
         main_endpoint
     )
-    new_headers = {}
-    for (key, val) in flask.request.headers:
-        new_headers[key] = val
+    # keep the query string, dynmap uses it for cache busting
+    query_string = flask.request.query_string.decode("latin-1") if json_body is None else ""
+    if query_string != "":
+        main_url = "{}?{}".format(main_url, query_string)
+
+    # requests sets its own Host and Content-Length
+    new_headers = filter_hop_by_hop_headers(flask.request.headers.items(), ["host", "content-length"])
+    if extra_headers is not None:
+        for (key, val) in extra_headers.items():
+            # None removes the header
+            if val is None:
+                new_headers.pop(key, None)
+            else:
+                new_headers[key] = val
     new_headers["Api-key"] = app.config["PI_API_KEY"]
+
+    method = flask.request.method
+    body = request_body_stream()
+    if json_body is not None:
+        method = "POST"
+        body = [json.dumps(json_body).encode("utf-8")]
+        new_headers["Content-Type"] = "application/json"
+
+    if main_channel is not None:
+        main_response = request_main_over_channel(main_endpoint, method, query_string, new_headers, body)
+        if main_response is not None:
+            return main_response
+
     try:
-        main_response: requests.Response = request_session.request(
-            method=flask.request.method,
+        main_response = request_session.request(
+            method=method,
             url=main_url,
             headers=new_headers,
-            data=flask.request.data,
+            data=body if json_body is None else body[0],
+            timeout=request_timeout,
+            stream=True
+        )
+    except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
+        main_circuit.record_failure()
+        raise
+    main_circuit.record_success()
+
+    return main_response
+
+# request_main over main_channel, with the same exceptions
+# returns None if the channel is down, nothing has been sent and https should be used instead
+def request_main_over_channel(main_endpoint, method, query_string, headers: dict, body) -> channel.ChannelResponse:
+    headers = dict(headers)
+    headers["Host"] = "{}:{}".format(app.config["MAIN_IP"], app.config["MAIN_PORT"])
+    try:
+        main_response = main_channel.request(
+            method,
+            "/" + main_endpoint,
+            query_string,
+            list(headers.items()),
+            body,
+            request_timeout
+        )
+    except channel.ChannelUnavailable:
+        return None
+    except channel.ChannelTimeout as e:
+        main_circuit.record_failure()
+        raise requests.exceptions.ReadTimeout(str(e))
+    except channel.ChannelError as e:
+        main_circuit.record_failure()
+        raise requests.exceptions.ConnectionError(str(e))
+    main_circuit.record_success()
+
+    return main_response
+
+# main's endpoint for a sub-request of /api/batch under /api/main/, with its query string
+def main_batch_endpoint(sub_request: batch.SubRequest) -> str:
+    return "api/" + sub_request.path[len(MAIN_API_PREFIX):]
+
+# whether a sub-request of /api/batch is for a main endpoint answered from forward_cache
+def batch_from_cache(sub_request: batch.SubRequest) -> bool:
+    if not sub_request.path.startswith(MAIN_API_PREFIX):
+        return False
+    return main_batch_endpoint(sub_request).partition("?")[0] in app.config["FORWARD_CACHE_TTLS"]
+
+# sub-requests of /api/batch under /api/main/, sent to main's /api/batch in one request
+# returns a response for each
+def request_main_batch(sub_requests: list) -> list:
+    payload = {"requests": [
+        {"id": i, "path": "/" + main_batch_endpoint(sub_request)}
+        for (i, sub_request) in enumerate(sub_requests)
+    ]}
+
+    def all_failed(message):
+        return [batch.error_response(sub_request, message) for sub_request in sub_requests]
+
+    try:
+        main_response = request_main("api/batch", json_body=payload)
+    except reachability.CircuitOpenError as e:
+        return all_failed(str(e))
+    except requests.exceptions.ReadTimeout:
+        return all_failed("connection to main timed out")
+    except requests.exceptions.ConnectionError:
+        return all_failed("unable to connect to main")
+
+    try:
+        body = b"".join(main_response.raw.stream(app.config["FORWARD_CHUNK_SIZE"], decode_content=False))
+        main_responses = json.loads(body)["data"]["responses"]
+    except (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError, channel.ChannelError):
+        return all_failed("connection to main interrupted")
+    except (ValueError, KeyError, TypeError):
+        return all_failed("main didn't answer the batch")
+    finally:
+        main_response.close()
+
+    # main answers in order, but match by id anyway
+    by_id = {main_sub_response.get("id"): main_sub_response for main_sub_response in main_responses}
+    results = []
+    for (i, sub_request) in enumerate(sub_requests):
+        main_sub_response = by_id.get(i)
+        if main_sub_response is None:
+            results.append(batch.error_response(sub_request, "missing from main's answer"))
+        else:
+            results.append(batch.response(sub_request, main_sub_response.get("status"), main_sub_response.get("body")))
+    return results
+
+# events for status_stream, ending after max_seconds so the worker's thread is given back,
+# browsers reconnect by themselves and only get an event if something changed meanwhile
+def status_events(version, max_seconds):
+    status_feed.watch()
+    try:
+        yield statusfeed.format_retry(app.config["STATUS_STREAM_RETRY"])
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline:
+            state = status_feed.wait(version, min(app.config["STATUS_STREAM_HEARTBEAT"], deadline - time.monotonic()))
+            if state is None:
+                # also notices clients that went away
+                yield statusfeed.KEEPALIVE_EVENT
+            else:
+                version = state["version"]
+                yield statusfeed.format_event(state)
+    finally:
+        status_feed.unwatch()
+
+# game server statuses, reused for STATUS_STREAM_SERVERS_INTERVAL
+# name: (checked_at, status)
+server_statuses = dict()
+
+# main's game servers, [{"name", "title", "endpoint"}], reused for GAME_SERVER_LIST_TTL
+# the last list is kept while main can't be reached
+game_server_list = {"checked_at": 0, "servers": None}
+
+def main_game_servers() -> list:
+    now = time.time()
+    if game_server_list["servers"] is None or now - game_server_list["checked_at"] >= app.config["GAME_SERVER_LIST_TTL"]:
+        game_server_list["checked_at"] = now
+        main_response = fetch_main_json("api/servers")
+        if main_response is not None and main_response.get("success"):
+            game_server_list["servers"] = main_response.get("data")
+    return game_server_list["servers"] or []
+
+# run by status_feed in the background
+def produce_status() -> dict:
+    power = power_probe.result(max_age=app.config["STATUS_STREAM_INTERVAL"])
+    status = {
+        "main": main_reachability.state(),
+        "power": {
+            "any_power": power["pingable"] or power["connectable"],
+            "pingable": power["pingable"],
+            "connectable": power["connectable"]
+        },
+        "boot": boot_orchestrator.status()["phase"],
+        "servers": dict()
+    }
+    if status["main"] != reachability.UP:
+        server_statuses.clear()
+        return status
+
+    servers = app.config["STATUS_STREAM_SERVERS"]
+    if servers is None:
+        servers = {server["name"]: server["endpoint"] for server in main_game_servers()}
+
+    now = time.time()
+    for (name, main_endpoint) in servers.items():
+        cached = server_statuses.get(name)
+        if cached is None or now - cached[0] >= app.config["STATUS_STREAM_SERVERS_INTERVAL"]:
+            main_response = fetch_main_json(main_endpoint)
+            server_status = None
+            if main_response is not None and main_response.get("success"):
+                server_status = main_response.get("data")
+            cached = server_statuses[name] = (now, server_status)
+        status["servers"][name] = cached[1]
+    return status
+
+# GET a json endpoint on main outside of any request, for background work
+# returns None if main can't be reached or doesn't answer with json
+def fetch_main_json(main_endpoint) -> dict:
+    if not main_circuit.allow():
+        return None
+    headers = {"Api-key": app.config["PI_API_KEY"]}
+    try:
+        if main_channel is not None:
+            try:
+                headers["Host"] = "{}:{}".format(app.config["MAIN_IP"], app.config["MAIN_PORT"])
+                main_response = main_channel.request("GET", "/" + main_endpoint, "", list(headers.items()), None, request_timeout)
+                try:
+                    body = b"".join(main_response.stream())
+                finally:
+                    main_response.close()
+                main_circuit.record_success()
+                return json.loads(body)
+            except channel.ChannelUnavailable:
+                pass
+
+        main_response = request_session.get(
+            "https://{}:{}/{}".format(app.config["MAIN_IP"], app.config["MAIN_PORT"], main_endpoint),
+            headers=headers,
             timeout=request_timeout
         )
+        main_circuit.record_success()
+        return main_response.json()
+    except (requests.exceptions.RequestException, channel.ChannelError):
+        main_circuit.record_failure()
+        return None
+    except ValueError:
+        return None
 
-        response: flask.Response = flask.make_response()
-        response.status = str(main_response.status_code)
-        for (key, val) in main_response.headers.items():
-            response.headers[key] = val
-        response.data = main_response.content
-        
-        return response
+# run by main_reachability in the background, also acts as the circuit's half-open probe
+def probe_main() -> str:
+    # always a fresh probe, but shared with any GET /api/power happening at the same time
+    result = power_probe.result(max_age=0)
+    if result["connectable"]:
+        return reachability.UP
+    if result["pingable"]:
+        return reachability.BOOTING
+    return reachability.DOWN
+
+# do all of BOOT_READY_ENDPOINTS on main answer, bypasses the circuit breaker
+def main_services_ready() -> bool:
+    for main_endpoint in app.config["BOOT_READY_ENDPOINTS"]:
+        try:
+            main_response = request_session.get(
+                "https://{}:{}/{}".format(app.config["MAIN_IP"], app.config["MAIN_PORT"], main_endpoint),
+                headers={"Api-key": app.config["PI_API_KEY"]},
+                timeout=request_timeout
+            )
+            main_response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return False
+    return True
+
+# does main's app answer /api/ack, bypasses the circuit breaker
+def ack_main() -> bool:
+    try:
+        ack_response = request_session.get(
+            "https://{}:{}/api/ack".format(app.config["MAIN_IP"], app.config["MAIN_PORT"]),
+            headers={"Api-key": app.config["PI_API_KEY"]},
+            timeout=request_timeout
+        )
+        return ack_response.json()["success"] == True
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return False
+
+# main_response is a requests.Response or a channel.ChannelResponse
+def relay_response(main_response: requests.Response) -> flask.Response:
+    # body is relayed undecoded, so Content-Encoding and Content-Length stay valid
+    response: flask.Response = flask.Response(
+        relay_response_body(main_response),
+        status=main_response.status_code,
+        headers=filter_hop_by_hop_headers(main_response.raw.headers.items())
+    )
+    # release the connection even if the client goes away before the body is sent
+    response.call_on_close(main_response.close)
+
+    return response
+
+# forward_to_main, through the on-disk tile cache
+# fresh entries are served without asking main, others are revalidated with main,
+# and anything cached is served stale when main can't be reached
+# under pisite_app.asgi, anything that needs main is handed off with the entry's validators,
+# and pisite_app.asgi revalidates and fills the cache itself
+def forward_to_main_cached(main_endpoint) -> flask.Response:
+    if flask.request.method != "GET":
+        return forward_to_main(main_endpoint)
+
+    # the query string isn't part of the key, it's (usually) a timestamp that changes when the file does,
+    # so a different one than the entry was fetched with always revalidates with main, however fresh the entry
+    entry = tile_cache.get(main_endpoint)
+    query = flask.request.query_string.decode("latin-1")
+
+    if entry is not None and entry.query == query and entry.age() < dynmap_fresh_seconds(main_endpoint):
+        return cached_response(entry, "HIT")
+
+    # the client's validators are for its own cache, ask main about ours instead
+    conditional_headers = {
+        "If-None-Match": None,
+        "If-Modified-Since": None
+    }
+    if entry is not None:
+        etag = entry.header("ETag")
+        last_modified = entry.header("Last-Modified")
+        if etag is not None:
+            conditional_headers["If-None-Match"] = etag
+        if last_modified is not None:
+            conditional_headers["If-Modified-Since"] = last_modified
+
+    if flask.g.get("async_handoff"):
+        if entry is not None:
+            # reopened by pisite_app.asgi if it's needed
+            entry.close()
+        return async_handoff_response(main_endpoint, {
+            "cache": "tile",
+            "key": main_endpoint,
+            "query": query,
+            "cached": entry is not None,
+            "conditional_headers": conditional_headers
+        })
+
+    try:
+        main_response = request_main(main_endpoint, conditional_headers)
+    except reachability.CircuitOpenError as e:
+        if entry is not None:
+            return cached_response(entry, "STALE")
+        return ResponseData(False, str(e))
     except requests.exceptions.ReadTimeout:
+        if entry is not None:
+            return cached_response(entry, "STALE")
         return ResponseData(False, "connection to main timed out")
     except requests.exceptions.ConnectionError:
+        if entry is not None:
+            return cached_response(entry, "STALE")
         return ResponseData(False, "unable to connect to main")
-    except json.decoder.JSONDecodeError:
-        return ResponseData(False, "invalid JSON response from main")
+
+    if entry is not None:
+        if main_response.status_code == 304:
+            main_response.close()
+            tile_cache.revalidated(entry, query)
+            return cached_response(entry, "REVALIDATED")
+        entry.close()
+
+    if main_response.status_code != 200 or "no-store" in main_response.headers.get("Cache-Control", ""):
+        return relay_response(main_response)
+
+    # relay to the client while writing to the cache
+    headers = filter_hop_by_hop_headers(main_response.raw.headers.items())
+    writer = tile_cache.put(main_endpoint, main_response.status_code, headers, query)
+    response: flask.Response = flask.Response(
+        relay_and_cache_response_body(main_response, writer),
+        status=main_response.status_code,
+        headers=headers
+    )
+    response.headers["X-Pisite-Cache"] = "MISS"
+    response.call_on_close(main_response.close)
+    response.call_on_close(writer.discard)
+
+    return response
+
+# forward_to_main, sharing main's answer with identical requests for ttl seconds
+# concurrent identical requests wait for one request to main instead of each making their own
+# hits are served here under pisite_app.asgi too, misses are handed off and fetched (or waited for) there
+def forward_to_main_short_cached(main_endpoint, ttl) -> flask.Response:
+    # shared only between users with the same groups
+    context = authcontext.current()
+    groups = "" if context is None else ",".join(sorted(context.groups))
+    key = "{}?{}|{}".format(main_endpoint, flask.request.query_string.decode("latin-1"), groups)
+
+    if flask.g.get("async_handoff"):
+        cached = forward_cache.lookup(key, ttl)
+        if cached is not None:
+            return short_cached_response(cached, "HIT")
+        return async_handoff_response(main_endpoint, {"cache": "short", "key": key, "ttl": ttl})
+
+    def fetch() -> responsecache.CachedResponse:
+        # the client's validators are for its own cache
+        main_response = request_main(main_endpoint, {"If-None-Match": None, "If-Modified-Since": None})
+        try:
+            # undecoded, so Content-Encoding and Content-Length stay valid
+            body = b"".join(main_response.raw.stream(app.config["FORWARD_CHUNK_SIZE"], decode_content=False))
+        finally:
+            main_response.close()
+        headers = filter_hop_by_hop_headers(main_response.raw.headers.items())
+        return responsecache.CachedResponse(main_response.status_code, list(headers.items()), body, time.time())
+
+    try:
+        cached, cache_state = forward_cache.get(key, ttl, fetch)
+    except reachability.CircuitOpenError as e:
+        return ResponseData(False, str(e))
+    except (requests.exceptions.ReadTimeout, urllib3.exceptions.ReadTimeoutError):
+        return ResponseData(False, "connection to main timed out")
+    except (requests.exceptions.ConnectionError, urllib3.exceptions.ProtocolError, channel.ChannelError):
+        return ResponseData(False, "unable to connect to main")
+
+    return short_cached_response(cached, cache_state)
+
+# request like cached_response
+def short_cached_response(cached: responsecache.CachedResponse, cache_state, request=None) -> flask.Response:
+    response: flask.Response = flask.Response(cached.body, status=cached.status, headers=cached.headers)
+    response.headers["X-Pisite-Cache"] = cache_state
+    response.headers["Age"] = str(int(cached.age()))
+    return response.make_conditional(flask.request if request is None else request)
+
+# request is the request (or the WSGI environ of the request) whose If-None-Match/If-Modified-Since are answered,
+# the current one if None
+def cached_response(entry: tilecache.CachedFile, cache_state, request=None) -> flask.Response:
+    response: flask.Response = flask.Response(
+        entry.iter_body(app.config["FORWARD_CHUNK_SIZE"]),
+        status=entry.status,
+        headers=entry.headers
+    )
+    response.headers["X-Pisite-Cache"] = cache_state
+    response.call_on_close(entry.close)
+
+    # answers the client's own If-None-Match/If-Modified-Since with a 304
+    return response.make_conditional(flask.request if request is None else request)
+
+# seconds a cached entry is used without revalidating, by longest matching path prefix
+def dynmap_fresh_seconds(main_endpoint) -> float:
+    path = main_endpoint[len("dynmap/"):]
+    best_prefix = None
+    for prefix in app.config["DYNMAP_CACHE_FRESH_SECONDS"]:
+        if path.startswith(prefix) and (best_prefix is None or len(prefix) > len(best_prefix)):
+            best_prefix = prefix
+    if best_prefix is None:
+        return 0
+    return app.config["DYNMAP_CACHE_FRESH_SECONDS"][best_prefix]
+
+# one page of an admin listing
+# list_page is a function of (after_id, limit) returning (rows, has_more)
+def admin_listing(list_page) -> ResponseData:
+    try:
+        after_id = int(flask.request.args["cursor"]) if "cursor" in flask.request.args else None
+    except ValueError:
+        return ResponseData(False, "invalid cursor")
+    try:
+        limit = int(flask.request.args.get("limit", app.config["ADMIN_PAGE_SIZE"]))
+    except ValueError:
+        return ResponseData(False, "invalid limit")
+    limit = max(1, min(limit, app.config["ADMIN_MAX_PAGE_SIZE"]))
+
+    rows, has_more = list_page(after_id, limit)
+    return ResponseData(True, None, {
+        "items": [row.to_detail_dict() for row in rows],
+        # ids only ever increase, so the last id is a stable cursor
+        "next_cursor": str(rows[-1].id) if has_more else None
+    })
+
+# header set by pisite_app.asgi on every request, holding ASYNC_HANDOFF_TOKEN
+ASYNC_HANDOFF_HEADER = "X-Pisite-Async-Handoff"
+# header on a handoff response, holding the endpoint on main to forward to
+ASYNC_FORWARD_HEADER = "X-Pisite-Async-Forward"
+# header on a handoff response whose answer goes through a cache, holding json telling pisite_app.asgi which:
+#   {"cache": "tile", "key", "cached": whether there's an entry to fall back on, "conditional_headers"}
+#   {"cache": "short", "key", "ttl"}
+ASYNC_CACHE_HEADER = "X-Pisite-Async-Cache"
+
+# header on a handoff response, holding the name of the stream for pisite_app.asgi to serve
+ASYNC_STREAM_HEADER = "X-Pisite-Async-Stream"
+
+def async_handoff_requested() -> bool:
+    # only set when running under pisite_app.asgi
+    token = app.config.get("ASYNC_HANDOFF_TOKEN")
+    if token is None:
+        return False
+    return secrets.compare_digest(flask.request.headers.get(ASYNC_HANDOFF_HEADER, ""), token)
+
+# empty response telling pisite_app.asgi to do the forward itself
+# any other headers on it (session cookie, talisman) are kept on the final response
+# cache is the value of ASYNC_CACHE_HEADER, if any
+def async_handoff_response(main_endpoint, cache: dict=None) -> flask.Response:
+    response: flask.Response = flask.Response(status=200)
+    response.headers[ASYNC_FORWARD_HEADER] = main_endpoint
+    if cache is not None:
+        response.headers[ASYNC_CACHE_HEADER] = json.dumps(cache)
+    return response
+
+# empty response telling pisite_app.asgi to serve a stream itself
+def async_stream_response(stream_name) -> flask.Response:
+    response: flask.Response = flask.Response(status=200)
+    response.headers[ASYNC_STREAM_HEADER] = stream_name
+    return response
+
+# copy headers, dropping hop-by-hop headers and any header named in Connection
+def filter_hop_by_hop_headers(headers, extra_excluded: list=None) -> dict:
+    headers = list(headers)
+    excluded = set(HOP_BY_HOP_HEADERS)
+    if extra_excluded is not None:
+        excluded.update(extra_excluded)
+    for (key, val) in headers:
+        if key.lower() == "connection":
+            excluded.update(token.strip().lower() for token in val.split(","))
+
+    new_headers = {}
+    for (key, val) in headers:
+        if key.lower() in excluded:
+            continue
+        if key in new_headers:
+            # repeated headers (e.g. Set-Cookie) are joined like requests does
+            new_headers[key] = "{}, {}".format(new_headers[key], val)
+        else:
+            new_headers[key] = val
+    return new_headers
+
+# iterable over the incoming request body with a known length
+# requests sends it as is (with Content-Length) instead of reading it into memory
+class RequestBodyStream():
+    def __init__(self, stream, length, chunk_size):
+        self.stream = stream
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+# returns None if there is no body to send
+def request_body_stream():
+    chunk_size = app.config["FORWARD_CHUNK_SIZE"]
+    length = flask.request.content_length
+    if length is not None:
+        if length == 0:
+            return None
+        return RequestBodyStream(flask.request.stream, length, chunk_size)
+
+    # chunked request without a length, requests will send it chunked as well
+    if flask.request.environ.get("wsgi.input_terminated"):
+        return iter(RequestBodyStream(flask.request.stream, 0, chunk_size))
+
+    return None
+
+def relay_response_body(main_response: requests.Response):
+    try:
+        for chunk in main_response.raw.stream(app.config["FORWARD_CHUNK_SIZE"], decode_content=False):
+            yield chunk
+    except (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError, channel.ChannelError) as e:
+        # headers are already sent, all that can be done is cutting the body short
+        print("main response interrupted: {}".format(e))
+    finally:
+        main_response.close()
+
+# only a complete body is committed to the cache
+def relay_and_cache_response_body(main_response: requests.Response, writer: tilecache.CacheWriter):
+    try:
+        for chunk in main_response.raw.stream(app.config["FORWARD_CHUNK_SIZE"], decode_content=False):
+            writer.write(chunk)
+            yield chunk
+        writer.commit()
+    except (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError, channel.ChannelError) as e:
+        print("main response interrupted: {}".format(e))
+    finally:
+        writer.discard()
+        main_response.close()
 
 def current_user() -> auth.User:
     user_id = flask.session.get("user_id")
@@ -0,0 +1,130 @@
+# checks whether main is powered on, without forking ping
+# the host check (ICMP echo, or TCP connects where unprivileged ICMP isn't allowed) and
+# the /api/ack check run at the same time, and the result is shared between requests and
+# worker processes for a short time, so any number of pollers cost one probe
+
+import os
+import json
+import time
+import fcntl
+import socket
+import struct
+import threading
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+# echo request over an unprivileged ICMP socket
+# returns None if the kernel doesn't allow them (see net.ipv4.ping_group_range)
+def icmp_echo(ip, timeout) -> bool:
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except PermissionError:
+        return None
+    with sock:
+        sock.settimeout(timeout)
+        # the kernel fills in the identifier and checksum
+        sequence = os.getpid() & 0xffff
+        packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, sequence) + b"pisite"
+        deadline = time.monotonic() + timeout
+        try:
+            sock.sendto(packet, (ip, 0))
+            while True:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                reply, _address = sock.recvfrom(1024)
+                (reply_type, _code, _checksum, _identifier, reply_sequence) = struct.unpack("!BBHHH", reply[:8])
+                if reply_type == ICMP_ECHO_REPLY and reply_sequence == sequence:
+                    return True
+        except (socket.timeout, OSError):
+            return False
+
+# any answer, even a refused connection, means the host is on
+def tcp_reachable(ip, ports, timeout) -> bool:
+    results = []
+    threads = []
+    def connect(port):
+        try:
+            with socket.create_connection((ip, port), timeout=timeout):
+                results.append(True)
+        except ConnectionRefusedError:
+            results.append(True)
+        except OSError:
+            results.append(False)
+
+    for port in ports:
+        thread = threading.Thread(target=connect, args=(port,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return any(results)
+
+class PowerProbe():
+    # ack_probe is a function returning whether main's app answers
+    def __init__(self, state_path, ip, tcp_ports, ack_probe, timeout, ttl):
+        self.state_path = os.path.abspath(state_path)
+        self.ip = ip
+        self.tcp_ports = tcp_ports
+        self.ack_probe = ack_probe
+        self.timeout = timeout
+        self.ttl = ttl
+
+    # {"pingable": bool, "connectable": bool, "method": "icmp" or "tcp", "checked_at": unix time}
+    # at most max_age seconds old, probing if needed
+    def result(self, max_age=None) -> dict:
+        if max_age is None:
+            max_age = self.ttl
+
+        cached = self._read()
+        if cached is not None and time.time() - cached["checked_at"] <= max_age:
+            return cached
+
+        # one probe at a time across all threads and processes, the rest wait for its result
+        with open(self.state_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            cached = self._read()
+            if cached is not None and time.time() - cached["checked_at"] <= max_age:
+                return cached
+
+            result = self._probe()
+
+            temp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+            with open(temp_path, "w") as state_file:
+                json.dump(result, state_file)
+            os.replace(temp_path, self.state_path)
+
+            return result
+
+    def _probe(self) -> dict:
+        results = {}
+        def run_ack():
+            try:
+                results["connectable"] = bool(self.ack_probe())
+            except Exception:
+                results["connectable"] = False
+
+        ack_thread = threading.Thread(target=run_ack, daemon=True)
+        ack_thread.start()
+
+        method = "icmp"
+        pingable = icmp_echo(self.ip, self.timeout)
+        if pingable is None:
+            method = "tcp"
+            pingable = tcp_reachable(self.ip, self.tcp_ports, self.timeout)
+
+        ack_thread.join()
+
+        return {
+            "pingable": pingable,
+            "connectable": results["connectable"],
+            "method": method,
+            "checked_at": time.time()
+        }
+
+    def _read(self) -> dict:
+        try:
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
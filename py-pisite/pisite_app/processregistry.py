@@ -0,0 +1,199 @@
+# game server processes on main, so checking whether one runs doesn't mean reading every process's cmdline
+# each server's pid and create time are kept in a small state file shared by all worker processes,
+# recorded when the app starts a server, or found by a full scan of the process table (reconciliation):
+# once when a process first uses the registry, to adopt servers started some other way, and then every
+# reconcile_interval seconds by one process at a time, to catch servers that were restarted or replaced
+# a check is then one psutil.Process for the pid, which also compares the create time so a reused pid doesn't count
+
+import os
+import json
+import time
+import fcntl
+import threading
+import contextlib
+
+import psutil
+
+class ProcessRegistry():
+    # matchers: {server name: function(cmdline) -> bool}, picks out each server in a scan
+    def __init__(self, state_path, matchers: dict, reconcile_interval):
+        self.state_path = os.path.abspath(state_path)
+        self.matchers = matchers
+        self.reconcile_interval = reconcile_interval
+        self.created_at = time.time()
+
+        self.lock = threading.Lock()
+        self.thread_pid = None # threads don't survive a fork, so this is checked against os.getpid()
+        self.adopted_pid = None # same for the first reconciliation
+        self.cached = None
+        self.cached_mtime = None
+        self.handles = dict() # server name: psutil.Process, reused while the pid stays the same
+
+    # also look for name's process in scans
+    def track(self, name, matcher):
+        self.matchers[name] = matcher
+
+    # start the background thread in this process, if it isn't already running
+    # and adopt running servers first, if no process has looked for them since the registry was created
+    def ensure_started(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            if self.adopted_pid != os.getpid():
+                try:
+                    self.reconcile(self.created_at, wait=True)
+                except Exception as e:
+                    print("process registry reconciliation failed: {}".format(e))
+                self.adopted_pid = os.getpid()
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="pisite-process-registry", daemon=True).start()
+
+    # {"servers": {name: {"pid", "create_time", "source"}}, "reconciled_at": unix time}
+    # source is "started" or "scan"
+    def read(self) -> dict:
+        try:
+            mtime = os.stat(self.state_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"servers": dict(), "reconciled_at": 0}
+        if self.cached is None or mtime != self.cached_mtime:
+            try:
+                with open(self.state_path, "r") as state_file:
+                    self.cached = json.load(state_file)
+            except (FileNotFoundError, ValueError):
+                return {"servers": dict(), "reconciled_at": 0}
+            self.cached_mtime = mtime
+        return self.cached
+
+    def pid(self, name) -> int:
+        if not self.is_running(name):
+            return None
+        return self.handles[name].pid
+
+    # whether the recorded process of the server is alive, without scanning
+    def is_running(self, name) -> bool:
+        self.ensure_started()
+        entry = self.read()["servers"].get(name)
+        if entry is None:
+            return False
+
+        handle = self.handles.get(name)
+        if handle is None or handle.pid != entry["pid"]:
+            handle = _process(entry["pid"], entry["create_time"])
+            if handle is None:
+                return False
+            self.handles[name] = handle
+        try:
+            return handle.is_running() and handle.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    # record a server the app just started, pid is that of its tmux pane
+    # a later reconciliation replaces it if it exits while the server itself keeps running
+    def register(self, name, pid):
+        handle = _process(pid)
+        if handle is None:
+            return
+        with self._state_lock(wait=True):
+            state = self.read()
+            servers = dict(state["servers"])
+            servers[name] = {"pid": pid, "create_time": handle.create_time(), "source": "started"}
+            self._write({"servers": servers, "reconciled_at": state["reconciled_at"]})
+        self.handles[name] = handle
+
+    # forget a server that was stopped, until a reconciliation finds it again
+    def unregister(self, name):
+        with self._state_lock(wait=True):
+            state = self.read()
+            if name not in state["servers"]:
+                return
+            servers = dict(state["servers"])
+            del servers[name]
+            self._write({"servers": servers, "reconciled_at": state["reconciled_at"]})
+        self.handles.pop(name, None)
+
+    # send SIGTERM to the server's recorded process, returns whether there was one to send it to
+    def terminate(self, name) -> bool:
+        if not self.is_running(name):
+            return False
+        try:
+            self.handles[name].terminate()
+        except psutil.Error:
+            return False
+        return True
+
+    # {server name: (pid, create time)} of the first matching process of each server
+    # processes that can't be read (AccessDenied, or gone meanwhile) are skipped
+    def scan(self) -> dict:
+        found = dict()
+        for proc in psutil.process_iter(["cmdline", "create_time"]):
+            cmdline = proc.info["cmdline"]
+            if not cmdline:
+                continue
+            for (name, matcher) in self.matchers.items():
+                if name not in found and matcher(cmdline):
+                    found[name] = (proc.pid, proc.info["create_time"])
+        return found
+
+    # scan the process table, unless some process did since newer_than (unix time)
+    # recorded processes that are still alive are kept, dead ones are replaced by what the scan found
+    # wait is whether to wait for another process's reconciliation, or give up right away
+    def reconcile(self, newer_than, wait=False):
+        with self._state_lock(wait) as locked:
+            if not locked:
+                return
+            state = self.read()
+            if state["reconciled_at"] > newer_than:
+                return
+
+            found = self.scan()
+            servers = dict()
+            for name in self.matchers:
+                entry = state["servers"].get(name)
+                if entry is not None and _process(entry["pid"], entry["create_time"]) is not None:
+                    servers[name] = entry
+                elif name in found:
+                    (pid, create_time) = found[name]
+                    servers[name] = {"pid": pid, "create_time": create_time, "source": "scan"}
+                    print("process registry adopted {} (pid {})".format(name, pid))
+            self._write({"servers": servers, "reconciled_at": time.time()})
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                self.reconcile(time.time() - self.reconcile_interval)
+            except Exception as e:
+                print("process registry reconciliation failed: {}".format(e))
+
+    # yields whether the lock was taken, only ever False without wait
+    @contextlib.contextmanager
+    def _state_lock(self, wait):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def _write(self, state):
+        # write then rename, readers never see a partial file
+        temp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.state_path)
+        self.cached = state
+        self.cached_mtime = os.stat(self.state_path).st_mtime_ns
+
+# psutil.Process for pid, or None if it's gone or, given create_time, a different process now has the pid
+def _process(pid, create_time=None) -> psutil.Process:
+    try:
+        handle = psutil.Process(pid)
+        if create_time is not None and abs(handle.create_time() - create_time) > 0.01:
+            return None
+        return handle
+    except psutil.Error:
+        return None
@@ -0,0 +1,200 @@
+# sampling profiler for requests in production, for both apps
+# a request is profiled if it's picked at random (PROFILE_SAMPLE_RATE), its route is in PROFILE_ROUTES,
+# or it has an X-Pisite-Profile header holding PROFILE_TOKEN
+# while a profiled request runs, a thread looks at its stack every PROFILE_INTERVAL seconds, so
+# nothing is added to the request itself (unlike cProfile) and unprofiled requests cost one random number
+# each profile is written to PROFILE_DIR as two files, only the newest PROFILE_MAX_FILES profiles are kept:
+#   <name>.folded: one "outermost;...;innermost count" line per distinct stack, for flamegraph.pl or speedscope
+#   <name>.json: the request, its wall time, and how that time was split between CATEGORIES
+# the whole request is covered, from before talisman and the session are loaded to the last chunk of the body
+# (in asyncio mode, only as long as the body is produced by the thread that started the request)
+
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import threading
+
+import flask
+
+# header that asks for a request to be profiled, holding PROFILE_TOKEN
+PROFILE_HEADER = "X-Pisite-Profile"
+
+# where the time went, by the modules and functions on the stack, first match wins
+# (category, module prefixes, function names)
+CATEGORIES = [
+    ("bcrypt", ("pisite_app.hashing", "bcrypt"), ()),
+    ("forward", ("requests", "urllib3", "http.client", "httpx", "pisite_app.channel", "pisite_app.responsecache"), ("forward_to_main",)),
+    ("sqlalchemy", ("sqlalchemy", "flask_sqlalchemy"), ()),
+    ("session", ("pisite_app.sessions", "flask_session"), ()),
+    ("talisman", ("flask_talisman",), ()),
+]
+OTHER = "other"
+
+# frames of the server's own threads at the root of every stack, not worth showing
+STACK_ROOT_SKIP = ("threading", "socketserver")
+
+class Profiler():
+    # wraps app.wsgi_app, name ("pi" or "main") goes in the file names
+    def __init__(self, app: flask.Flask, name):
+        self.app = app
+        self.name = name
+        self.wsgi_app = app.wsgi_app
+        self.slots = threading.BoundedSemaphore(app.config["PROFILE_MAX_CONCURRENT"])
+        self.write_lock = threading.Lock()
+        app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        if not self._should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        # a bounded number at once, so a burst of matching requests can't add a thread each
+        if not self.slots.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+
+        profile = RequestProfile(environ, self.app.config["PROFILE_INTERVAL"], self.app.config["PROFILE_MAX_SECONDS"])
+        def profiled_start_response(status, headers, exc_info=None):
+            profile.status = int(status.split(" ", 1)[0])
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            self._finish(profile)
+            raise
+        return ProfiledResult(result, lambda: self._finish(profile))
+
+    def _should_profile(self, environ) -> bool:
+        config = self.app.config
+        token = config["PROFILE_TOKEN"]
+        header = environ.get("HTTP_" + PROFILE_HEADER.upper().replace("-", "_"))
+        if token is not None and header is not None and secrets.compare_digest(header.encode("utf-8"), token.encode("utf-8")):
+            return True
+        if config["PROFILE_SAMPLE_RATE"] > 0 and random.random() < config["PROFILE_SAMPLE_RATE"]:
+            return True
+        if len(config["PROFILE_ROUTES"]) > 0:
+            try:
+                rule, _args = self.app.url_map.bind_to_environ(environ).match(return_rule=True)
+            except Exception:
+                # 404, 405, redirects
+                return False
+            return rule.rule in config["PROFILE_ROUTES"]
+        return False
+
+    def _finish(self, profile):
+        try:
+            profile.stop()
+            self._write(profile)
+        except Exception as e:
+            print("failed to write profile: {}".format(e))
+        finally:
+            self.slots.release()
+
+    def _write(self, profile):
+        directory = os.path.abspath(self.app.config["PROFILE_DIR"])
+        os.makedirs(directory, exist_ok=True)
+        # sorts by time
+        base_name = "{:.6f}-{}-{}".format(profile.started_at, self.name, os.getpid())
+        with open(os.path.join(directory, base_name + ".folded"), "w") as folded_file:
+            for (stack, count) in profile.stacks.items():
+                folded_file.write("{} {}\n".format(stack, count))
+        with open(os.path.join(directory, base_name + ".json"), "w") as summary_file:
+            json.dump(profile.summary(), summary_file, indent=1)
+
+        # one writer per process at a time, other processes may delete the same files
+        with self.write_lock:
+            names = sorted(name[:-len(".json")] for name in os.listdir(directory) if name.endswith(".json"))
+            for old_name in names[:max(0, len(names) - self.app.config["PROFILE_MAX_FILES"])]:
+                for extension in (".json", ".folded"):
+                    try:
+                        os.remove(os.path.join(directory, old_name + extension))
+                    except FileNotFoundError:
+                        pass
+
+# the stack samples of one request, taken by a thread of its own
+class RequestProfile():
+    def __init__(self, environ, interval, max_seconds):
+        self.method = environ.get("REQUEST_METHOD")
+        self.path = environ.get("PATH_INFO")
+        self.status = None
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = dict() # folded stack: samples
+        self.categories = {category: 0 for (category, _modules, _functions) in CATEGORIES}
+        self.categories[OTHER] = 0
+        self.samples = 0
+
+        self.thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stopped = None
+        self.done = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, name="pisite-profiler", daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        if self.stopped is None:
+            self.stopped = time.perf_counter()
+        self.done.set()
+        self.sampler.join()
+
+    def summary(self) -> dict:
+        wall_seconds = (self.stopped or time.perf_counter()) - self.started
+        # each sample stands for an equal share of the time sampled
+        seconds_per_sample = min(wall_seconds, self.max_seconds) / self.samples if self.samples > 0 else 0
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_seconds": wall_seconds,
+            "samples": self.samples,
+            "breakdown_seconds": {category: count * seconds_per_sample for (category, count) in self.categories.items()}
+        }
+
+    def _sample(self):
+        deadline = self.started + self.max_seconds
+        while not self.done.wait(self.interval) and time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            frames = []
+            while frame is not None:
+                frames.append((frame.f_globals.get("__name__", "?"), frame.f_code.co_name))
+                frame = frame.f_back
+            del frame
+            frames.reverse()
+            while len(frames) > 1 and frames[0][0] in STACK_ROOT_SKIP:
+                frames.pop(0)
+
+            stack = ";".join("{}:{}".format(module, function) for (module, function) in frames)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.categories[categorize(frames)] += 1
+            self.samples += 1
+
+def categorize(frames) -> str:
+    for (category, modules, functions) in CATEGORIES:
+        for (module, function) in frames:
+            if function in functions or module.startswith(modules):
+                return category
+    return OTHER
+
+# the app's response, finishing the profile once the server is done with it
+class ProfiledResult():
+    def __init__(self, result, on_close):
+        self.result = result
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.on_close()
+
+def init_app(app: flask.Flask, name):
+    Profiler(app, name)
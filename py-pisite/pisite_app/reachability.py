@@ -0,0 +1,161 @@
+# keeps track of whether main is up, and fails forwards fast while it isn't
+# the last probe result is shared by all worker processes through a small state file,
+# and only one process probes at a time
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+# states of main
+UP = "up" # answers /api/ack
+BOOTING = "booting" # host is reachable, but the app isn't answering yet
+DOWN = "down" # nothing
+UNKNOWN = "unknown" # not probed yet
+
+# how long a read of the state file is reused for
+STATE_READ_INTERVAL = 1 # seconds
+
+# raised instead of attempting a forward while the circuit is open
+class CircuitOpenError(Exception):
+    pass
+
+class ReachabilityTracker():
+    # probe is a function returning UP, BOOTING or DOWN, run in a background thread
+    def __init__(self, state_path, probe, interval, down_interval):
+        self.state_path = os.path.abspath(state_path)
+        self.probe = probe
+        self.interval = interval
+        self.down_interval = down_interval
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread_pid = None # threads don't survive a fork, so this is checked against os.getpid()
+        self.cached = None
+        self.cached_at = 0
+
+    # start the background thread in this process, if it isn't already running
+    def ensure_started(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="pisite-reachability", daemon=True).start()
+
+    def state(self) -> str:
+        return self.read()["state"]
+
+    # {"state": ..., "checked_at": unix time, "changed_at": unix time}
+    def read(self) -> dict:
+        self.ensure_started()
+        now = time.time()
+        if self.cached is None or now - self.cached_at > STATE_READ_INTERVAL:
+            try:
+                with open(self.state_path, "r") as state_file:
+                    self.cached = json.load(state_file)
+            except (FileNotFoundError, ValueError):
+                self.cached = {"state": UNKNOWN, "checked_at": 0, "changed_at": 0}
+            self.cached_at = now
+        return self.cached
+
+    # ask the background thread to probe now instead of waiting for the interval
+    def request_probe(self):
+        self.ensure_started()
+        self.wake.set()
+
+    def _run(self):
+        forced = True
+        while True:
+            try:
+                self._refresh(forced)
+            except Exception as e:
+                print("reachability probe failed: {}".format(e))
+            interval = self.interval if self.cached is not None and self.cached["state"] == UP else self.down_interval
+            forced = self.wake.wait(interval)
+            self.wake.clear()
+
+    def _refresh(self, forced):
+        current = self.read()
+        interval = self.interval if current["state"] == UP else self.down_interval
+        if not forced and time.time() - current["checked_at"] < interval:
+            # some other process probed recently
+            return
+
+        with open(self.state_path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # some other process is probing right now
+                return
+
+            new_state = self.probe()
+            now = time.time()
+            result = {
+                "state": new_state,
+                "checked_at": now,
+                "changed_at": now if new_state != current["state"] else current["changed_at"]
+            }
+            if new_state != current["state"]:
+                print("main is now {}".format(new_state))
+
+            # write then rename, readers never see a partial file
+            temp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+            with open(temp_path, "w") as state_file:
+                json.dump(result, state_file)
+            os.replace(temp_path, self.state_path)
+
+            self.cached = result
+            self.cached_at = now
+
+# closed: forwards are attempted
+# open: forwards fail immediately, while the tracker says main isn't up,
+#   or after enough consecutive failed forwards in this process
+# half-open: the tracker's background probe of main, a successful one closes the circuit again
+class CircuitBreaker():
+    def __init__(self, tracker: ReachabilityTracker, failure_threshold):
+        self.tracker = tracker
+        self.failure_threshold = failure_threshold
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        current = self.tracker.read()
+        if current["state"] in (DOWN, BOOTING):
+            return False
+
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if current["state"] == UP and current["checked_at"] > self.opened_at:
+                # probed successfully since the circuit opened
+                self.opened_at = None
+                self.consecutive_failures = 0
+                return True
+            return False
+
+    # raises CircuitOpenError if forwards shouldn't be attempted
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(self.message())
+
+    def message(self) -> str:
+        if self.tracker.state() == BOOTING:
+            return "main is booting"
+        return "main is off"
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures < self.failure_threshold or self.opened_at is not None:
+                return
+            self.opened_at = time.time()
+        print("opening circuit to main after {} failures".format(self.failure_threshold))
+        self.tracker.request_probe()
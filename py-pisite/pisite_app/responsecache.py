@@ -0,0 +1,140 @@
+# short-lived cache for GETs forwarded to main whose answers are expensive to produce (e.g. /api/mc)
+# identical requests within an endpoint's ttl share one answer, and while an answer is being fetched
+# every other identical request, from any thread or worker process, waits for it instead of asking main again
+# entries are only shared between users with the same groups, so nothing is ever served to someone
+# who couldn't have been given it
+#   each entry is one file, a line of JSON metadata followed by the raw body (like tilecache)
+#   mtime is when the entry was fetched
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+
+# keys are spread over this many lock files, so the number of lock files stays bounded
+LOCK_STRIPES = 64
+
+# expired entries are deleted at most this often per process
+SWEEP_INTERVAL = 60 # seconds
+
+# response headers that mustn't be shared between users
+UNSHARED_HEADERS = {"set-cookie"}
+
+class CachedResponse():
+    def __init__(self, status, headers, body: bytes, fetched_at):
+        self.status = status
+        self.headers = headers # list of [key, val]
+        self.body = body
+        self.fetched_at = fetched_at
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+class ResponseCache():
+    # max_ttl is the longest ttl get() is called with, older entries are deleted
+    def __init__(self, directory, max_entry_bytes, max_ttl):
+        self.directory = os.path.abspath(directory)
+        self.max_entry_bytes = max_entry_bytes
+        self.max_ttl = max_ttl
+        self.last_sweep = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    # the cached response for key if it's at most ttl seconds old,
+    # otherwise fetch() is called by one caller at a time and its result stored for the rest
+    # fetch returns a CachedResponse, or None if the answer can't be cached (it's then fetched again by the next caller)
+    # returns (response or None, cache state for X-Pisite-Cache)
+    def get(self, key, ttl, fetch) -> (CachedResponse, str):
+        cached = self.lookup(key, ttl)
+        if cached is not None:
+            return cached, "HIT"
+
+        with open(self._lock_path(key), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # whoever held the lock before may have just fetched it
+            cached = self.lookup(key, ttl)
+            if cached is not None:
+                return cached, "COALESCED"
+
+            response = fetch()
+            if response is not None:
+                self.store(key, response)
+        self.sweep()
+        return response, "MISS"
+
+    # the cached response for key if it's at most ttl seconds old, otherwise None
+    def lookup(self, key, ttl) -> CachedResponse:
+        return self._read(self._path(key), key, ttl)
+
+    # the lock get() fetches key under, without waiting for it, for callers that can't block (pisite_app.asgi)
+    # returns the open lock file, closing it releases the lock, or None if someone else is fetching key
+    def try_lock(self, key):
+        lock_file = open(self._lock_path(key), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    # store a fetched response for key, if it can be cached
+    def store(self, key, response: CachedResponse):
+        if self._cacheable(response):
+            self._write(self._path(key), key, response)
+
+    # delete expired entries, at most once per SWEEP_INTERVAL per process
+    def sweep(self):
+        now = time.time()
+        if now - self.last_sweep < SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".entry") and now - os.stat(path).st_mtime > self.max_ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _cacheable(self, response: CachedResponse) -> bool:
+        if response.status != 200 or len(response.body) > self.max_entry_bytes:
+            return False
+        for (key, val) in response.headers:
+            if key.lower() == "cache-control" and ("no-store" in val or "private" in val):
+                return False
+        return True
+
+    def _read(self, path, key, ttl) -> CachedResponse:
+        try:
+            with open(path, "rb") as entry_file:
+                fetched_at = os.fstat(entry_file.fileno()).st_mtime
+                if time.time() - fetched_at > ttl:
+                    return None
+                meta = json.loads(entry_file.readline())
+                if meta["key"] != key:
+                    # hash collision
+                    return None
+                return CachedResponse(meta["status"], meta["headers"], entry_file.read(), fetched_at)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    # write then rename, readers never see a partial entry
+    def _write(self, path, key, response: CachedResponse):
+        meta = {
+            "key": key,
+            "status": response.status,
+            "headers": [[k, v] for (k, v) in response.headers if k.lower() not in UNSHARED_HEADERS]
+        }
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as entry_file:
+            entry_file.write(json.dumps(meta).encode("utf-8"))
+            entry_file.write(b"\n")
+            entry_file.write(response.body)
+        os.replace(temp_path, path)
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".entry")
+
+    def _lock_path(self, key) -> str:
+        stripe = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % LOCK_STRIPES
+        return os.path.join(self.directory, "stripe-{}.lock".format(stripe))
@@ -0,0 +1,169 @@
+# server-side sessions in sqlite, replacing flask-session's one-pickle-file-per-session
+# the cookie only holds a random session id
+# sessions are indexed by user_id, so all sessions of a user can be found and deleted
+
+import time
+import secrets
+import threading
+
+import flask
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+
+import pisite_app.localdb as localdb
+
+# an unmodified session's expiry is only written again once it would move by this much,
+# so most requests don't write to the database at all
+EXPIRY_REFRESH_GRANULARITY = 3600 # seconds
+
+class SqliteSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, stored_expiry=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.stored_expiry = stored_expiry
+        self.modified = False
+        # stored sid this session replaces, deleted when it is saved
+        self.replaced_sid = None
+
+class SessionStore():
+    def __init__(self, path):
+        self.path = path
+        self.serializer = TaggedJSONSerializer()
+        self.last_sweep = 0
+        self.sweep_lock = threading.Lock()
+        connection = localdb.connect(self.path)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS session (
+                sid TEXT PRIMARY KEY,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                expiry REAL NOT NULL
+            )""")
+        connection.execute("CREATE INDEX IF NOT EXISTS session_user_id ON session (user_id)")
+        connection.execute("CREATE INDEX IF NOT EXISTS session_expiry ON session (expiry)")
+
+    # returns (data, expiry), or None if missing or expired
+    def load(self, sid):
+        row = localdb.connect(self.path).execute(
+            "SELECT data, expiry FROM session WHERE sid = ? AND expiry > ?", (sid, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return self.serializer.loads(row[0]), row[1]
+
+    def save(self, sid, data: dict, expiry):
+        localdb.connect(self.path).execute(
+            "INSERT OR REPLACE INTO session (sid, user_id, data, expiry) VALUES (?, ?, ?, ?)",
+            (sid, data.get("user_id"), self.serializer.dumps(dict(data)), expiry)
+        )
+
+    def delete(self, sid):
+        localdb.connect(self.path).execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+    # returns the number of sessions deleted
+    def delete_user_sessions(self, user_id, except_sid=None) -> int:
+        cursor = localdb.connect(self.path).execute(
+            "DELETE FROM session WHERE user_id = ? AND sid IS NOT ?", (user_id, except_sid)
+        )
+        return cursor.rowcount
+
+    # delete expired sessions, at most once per interval per process
+    def sweep(self, interval):
+        now = time.time()
+        if now - self.last_sweep < interval or not self.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_sweep = now
+            localdb.connect(self.path).execute("DELETE FROM session WHERE expiry <= ?", (now,))
+        finally:
+            self.sweep_lock.release()
+
+class SqliteSessionInterface(SessionInterface):
+    def __init__(self, store: SessionStore, sweep_interval):
+        self.store = store
+        self.sweep_interval = sweep_interval
+
+    def open_session(self, app, request) -> SqliteSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is not None:
+            loaded = self.store.load(sid)
+            if loaded is not None:
+                data, expiry = loaded
+                return SqliteSession(data, sid=sid, stored_expiry=expiry)
+
+        # anonymous sessions only reach the database once something is stored in them
+        return SqliteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session: SqliteSession, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        self.store.sweep(self.sweep_interval)
+
+        if session.replaced_sid is not None:
+            self.store.delete(session.replaced_sid)
+            session.replaced_sid = None
+
+        if not session:
+            if session.modified:
+                # cleared, e.g. on logout
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+
+        expires = self.get_expiration_time(app, session)
+        # non-permanent sessions end with the browser, but still need to expire here eventually
+        expiry = expires.timestamp() if expires is not None else time.time() + app.permanent_session_lifetime.total_seconds()
+
+        if session.modified or session.new or session.stored_expiry is None \
+                or expiry - session.stored_expiry > EXPIRY_REFRESH_GRANULARITY:
+            self.store.save(session.sid, session, expiry)
+            session.stored_expiry = expiry
+
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=expires,
+                httponly=httponly,
+                domain=domain,
+                path=path,
+                secure=secure,
+                samesite=samesite
+            )
+
+def init_app(app: flask.Flask):
+    store = SessionStore(app.config["SESSION_SQLITE_PATH"])
+    app.session_interface = SqliteSessionInterface(store, app.config["SESSION_SWEEP_INTERVAL"])
+
+# delete every session of a user other than the current one
+# returns None if the session backend can't do that
+def delete_other_sessions(user_id) -> int:
+    interface = flask.current_app.session_interface
+    if not isinstance(interface, SqliteSessionInterface):
+        return None
+    return interface.store.delete_user_sessions(user_id, except_sid=getattr(flask.session, "sid", None))
+
+# give the current session a new id, e.g. on login, the stored one is deleted when the session is saved
+# does nothing if the session backend can't do that
+def regenerate_sid():
+    session = flask.session._get_current_object()
+    if not isinstance(session, SqliteSession):
+        return
+    if not session.new:
+        session.replaced_sid = session.sid
+    session.sid = secrets.token_urlsafe(32)
+    session.new = True
+    session.modified = True
@@ -0,0 +1,158 @@
+# status of main and its game servers, pushed to every watching client (GET /api/status/stream)
+# one producer across all worker processes checks the status and writes it to a shared state file,
+# and only while someone is watching, so checking costs the same for one client or twenty
+# each worker has one thread watching the file and waking up its clients when the status changes
+# outside of asyncio mode every stream holds a worker thread, so streams are limited across all workers with
+# slot lock files (see take_slot), and refused by workers without threads
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+# how often each worker looks at the state file
+WATCH_INTERVAL = 0.5 # seconds
+
+# https://html.spec.whatwg.org/multipage/server-sent-events.html
+KEEPALIVE_EVENT = ": keepalive\n\n"
+
+def format_event(state) -> str:
+    return "id: {}\nevent: status\ndata: {}\n\n".format(state["version"], json.dumps(state["status"]))
+
+def format_retry(seconds) -> str:
+    return "retry: {}\n\n".format(int(seconds * 1000))
+
+# the version a reconnecting client last saw, from its Last-Event-ID header
+def parse_last_event_id(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# a slot for a stream, one of count across all worker processes
+# returns the open lock file holding it, closing the file frees the slot, or None if every slot is taken
+# a worker that dies frees its slots with it
+def take_slot(lock_dir, count):
+    lock_dir = os.path.abspath(lock_dir)
+    os.makedirs(lock_dir, exist_ok=True)
+    for i in range(count):
+        lock_file = open(os.path.join(lock_dir, "stream-{}.lock".format(i)), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        return lock_file
+    return None
+
+class StatusFeed():
+    # produce is a function returning the current status (json serializable), run in the background
+    def __init__(self, state_path, produce, interval):
+        self.state_path = os.path.abspath(state_path)
+        self.produce = produce
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread_pid = None # threads don't survive a fork, so this is checked against os.getpid()
+        self.watchers = 0
+        self.current = None # {"version": int, "status": ...}
+        self.state_mtime = None
+
+    # the latest status, waiting up to timeout for one newer than version
+    # returns None if there is nothing newer yet
+    def wait(self, version, timeout) -> dict:
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.current is None or self.current["version"] == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+            return self.current
+
+    # the status is only produced while at least one client is watching, in any worker
+    def watch(self):
+        self.ensure_started()
+        with self.lock:
+            self.watchers += 1
+
+    def unwatch(self):
+        with self.lock:
+            self.watchers -= 1
+
+    # start the watching thread in this process, if it isn't already running
+    def ensure_started(self):
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, name="pisite-status-feed", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.watchers > 0:
+                    self._maybe_produce()
+                self._check_state_file()
+            except Exception as e:
+                print("status feed failed: {}".format(e))
+            time.sleep(WATCH_INTERVAL)
+
+    def _maybe_produce(self):
+        lock_path = self.state_path + ".lock"
+        try:
+            if time.time() - os.stat(lock_path).st_mtime < self.interval:
+                # produced recently, by this or another process
+                return
+        except FileNotFoundError:
+            pass
+
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # some other process is producing right now
+                return
+            # the lock file's mtime is when the status was last produced
+            os.utime(lock_path, None)
+
+            previous = self._read()
+            status = self.produce()
+            if previous is not None and previous["status"] == status:
+                # only changes are written, and only changes wake up clients
+                return
+
+            new_state = {
+                "version": 1 if previous is None else previous["version"] + 1,
+                "status": status
+            }
+            temp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+            with open(temp_path, "w") as state_file:
+                json.dump(new_state, state_file)
+            os.replace(temp_path, self.state_path)
+
+    def _check_state_file(self):
+        try:
+            mtime = os.stat(self.state_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.state_mtime:
+            return
+        state = self._read()
+        if state is None:
+            return
+        with self.lock:
+            self.state_mtime = mtime
+            self.current = state
+            self.changed.notify_all()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
@@ -0,0 +1,112 @@
+# token buckets for login attempts, shared by all worker processes through sqlite
+# each attempt takes a token from the bucket of the client's ip and of the username,
+# an attempt is rejected (before any password hashing) if either bucket is empty
+# buckets refill continuously up to their burst size
+
+import time
+import threading
+
+import pisite_app.localdb as localdb
+
+# counters kept for monitoring
+ALLOWED = "allowed"
+REJECTED_IP = "rejected_ip"
+REJECTED_USERNAME = "rejected_username"
+
+class BucketLimit():
+    def __init__(self, burst, per_minute):
+        self.burst = burst
+        self.per_second = per_minute / 60
+
+class LoginThrottle():
+    def __init__(self, path, ip_limit: BucketLimit, username_limit: BucketLimit, sweep_interval):
+        self.path = path
+        self.limits = {"ip": ip_limit, "username": username_limit}
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.sweep_lock = threading.Lock()
+        connection = localdb.connect(self.path)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS bucket (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        connection.execute("CREATE INDEX IF NOT EXISTS bucket_updated ON bucket (updated)")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS counter (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )""")
+
+    # take a token for a login attempt
+    # returns 0 if allowed, otherwise the seconds until the attempt would be allowed
+    def attempt(self, ip, username) -> float:
+        self.sweep()
+        buckets = [
+            ("ip", "ip:{}".format(ip), REJECTED_IP),
+            ("username", "username:{}".format(str(username).lower()), REJECTED_USERNAME)
+        ]
+
+        connection = localdb.connect(self.path)
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so no other process can take the same tokens
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            refilled = []
+            wait = 0
+            rejected_counter = None
+            for (kind, key, counter) in buckets:
+                limit: BucketLimit = self.limits[kind]
+                row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+                tokens = limit.burst if row is None else min(limit.burst, row[0] + (now - row[1]) * limit.per_second)
+                refilled.append((key, tokens))
+                if tokens < 1:
+                    missing = (1 - tokens) / limit.per_second
+                    if missing > wait:
+                        wait = missing
+                        rejected_counter = counter
+
+            if rejected_counter is not None:
+                # nothing is taken from the buckets, a rejected attempt costs nothing
+                self._increment(connection, rejected_counter)
+            else:
+                for (key, tokens) in refilled:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)",
+                        (key, tokens - 1, now)
+                    )
+                self._increment(connection, ALLOWED)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    # {counter name: value} since the database was created, and how many buckets aren't full
+    def counters(self) -> dict:
+        connection = localdb.connect(self.path)
+        result = {ALLOWED: 0, REJECTED_IP: 0, REJECTED_USERNAME: 0}
+        for (name, value) in connection.execute("SELECT name, value FROM counter"):
+            result[name] = value
+        result["tracked_buckets"] = connection.execute("SELECT COUNT(*) FROM bucket").fetchone()[0]
+        return result
+
+    # delete buckets that have refilled completely, at most once per interval per process
+    def sweep(self):
+        now = time.time()
+        if now - self.last_sweep < self.sweep_interval or not self.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_sweep = now
+            slowest_refill = max(limit.burst / limit.per_second for limit in self.limits.values())
+            localdb.connect(self.path).execute("DELETE FROM bucket WHERE updated <= ?", (now - slowest_refill,))
+        finally:
+            self.sweep_lock.release()
+
+    def _increment(self, connection, name):
+        connection.execute(
+            "INSERT INTO counter (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
@@ -0,0 +1,221 @@
+# bounded on-disk LRU cache for files forwarded from main (dynmap tiles, js, json, etc)
+# shared by all worker processes through the filesystem:
+#   each entry is one file, a line of JSON metadata followed by the raw body
+#   mtime is when the entry was last validated against main (freshness)
+#   atime is when the entry was last served (recency, for eviction)
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+
+# entries are only re-touched after this many seconds, to save writes on the SD card
+TOUCH_INTERVAL = 60 # seconds
+
+# evict down to this fraction of the size limit, so eviction doesn't run on every write
+EVICT_LOW_WATERMARK = 0.9
+
+# temporary files older than this are from crashed writers
+TEMP_FILE_MAX_AGE = 3600 # seconds
+
+class CachedFile():
+    def __init__(self, path, file, meta: dict):
+        self.path = path
+        self.file = file
+        self.status = meta["status"]
+        self.headers = meta["headers"] # list of [key, val]
+        self.query = meta.get("query", "") # query string of the request main answered
+        stat = os.fstat(file.fileno())
+        self.validated_at = stat.st_mtime
+
+    def age(self) -> float:
+        return time.time() - self.validated_at
+
+    def header(self, name):
+        for (key, val) in self.headers:
+            if key.lower() == name.lower():
+                return val
+        return None
+
+    # yield the body in chunks, closing the file when done
+    def iter_body(self, chunk_size):
+        try:
+            while True:
+                chunk = self.file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.file.close()
+
+    def close(self):
+        self.file.close()
+
+# writes an entry to a temporary file, only visible to readers after commit()
+class CacheWriter():
+    def __init__(self, cache, path, meta: dict):
+        self.cache = cache
+        self.path = path
+        self.size = 0
+        self.done = False
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, prefix=".tmp-")
+        self.file = os.fdopen(fd, "wb")
+        self.file.write(json.dumps(meta).encode("utf-8"))
+        self.file.write(b"\n")
+
+    def write(self, chunk):
+        if self.done:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_entry_bytes:
+            # too big to be worth caching, keep relaying but stop writing
+            self.discard()
+            return
+        self.file.write(chunk)
+
+    def commit(self):
+        if self.done:
+            return
+        self.done = True
+        self.file.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        os.replace(self.temp_path, self.path)
+        self.cache.written(self.size)
+
+    # does nothing if already committed or discarded
+    def discard(self):
+        if self.done:
+            return
+        self.done = True
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+class TileCache():
+    def __init__(self, directory, max_bytes, max_entry_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # bytes written by this process since the last eviction pass, None forces a pass
+        self.written_since_evict = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, key) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        # fan out into subdirectories to keep directories small
+        return os.path.join(self.directory, digest[:2], digest)
+
+    # returns None on a miss, caller must close() or iterate the body of the result
+    def get(self, key) -> CachedFile:
+        path = self.path_for(key)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            meta = json.loads(file.readline())
+        except ValueError:
+            # corrupt entry, drop it
+            file.close()
+            self._remove(path)
+            return None
+
+        entry = CachedFile(path, file, meta)
+        self._touch(path)
+        return entry
+
+    def put(self, key, status, headers, query="") -> CacheWriter:
+        meta = {
+            "status": status,
+            "headers": [[name, val] for (name, val) in headers.items()],
+            "query": query
+        }
+        return CacheWriter(self, self.path_for(key), meta)
+
+    # entry was confirmed to still be current by main, for a request with this query string
+    def revalidated(self, entry: CachedFile, query=None):
+        if query is not None and query != entry.query:
+            # written again with the new query, so requests with it are hits from now on
+            writer = CacheWriter(self, entry.path, {"status": entry.status, "headers": entry.headers, "query": query})
+            start = entry.file.tell()
+            try:
+                for chunk in iter(lambda: entry.file.read(64 * 1024), b""):
+                    writer.write(chunk)
+                writer.commit()
+            finally:
+                writer.discard()
+                entry.file.seek(start)
+            return
+        now = time.time()
+        try:
+            os.utime(entry.path, (now, now))
+        except FileNotFoundError:
+            pass
+
+    def written(self, size):
+        if self.written_since_evict is None:
+            self.written_since_evict = self.max_bytes
+        else:
+            self.written_since_evict += size
+        # only scan the directory once a tenth of the limit could have been added
+        if self.written_since_evict >= self.max_bytes / 10:
+            self.evict()
+
+    # remove least recently served entries until under the low watermark
+    def evict(self):
+        self.written_since_evict = 0
+        with open(os.path.join(self.directory, ".evict.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # some other process is already evicting
+                return
+
+            entries = []
+            total = 0
+            for subdir in os.scandir(self.directory):
+                if subdir.name.startswith(".tmp-"):
+                    # left behind by a worker that died mid-write
+                    if time.time() - subdir.stat().st_mtime > TEMP_FILE_MAX_AGE:
+                        self._remove(subdir.path)
+                    continue
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(subdir.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+            if total <= self.max_bytes:
+                return
+
+            entries.sort()
+            target = self.max_bytes * EVICT_LOW_WATERMARK
+            for (_atime, size, path) in entries:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+
+    def _touch(self, path):
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            if now - stat.st_atime > TOUCH_INTERVAL:
+                # keep mtime, it records validation
+                os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
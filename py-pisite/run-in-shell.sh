@@ -5,8 +5,12 @@ WORKING_DIR="/home/tobias/programming/pisite/py-pisite/"
 MODULE_NAME="pisite_app"
 PORT="5000"
 WORKERS=9 # should be about (2 * cores) + 1
+THREADS=4 # per worker (gthread), a status stream holds a thread instead of a whole worker
+# metrics of all workers are added up through files here, see pisite_app/metrics.py
+export PROMETHEUS_MULTIPROC_DIR="/tmp/pisite-metrics"
 
 . "$VENV"/bin/activate
 
 cd "$WORKING_DIR"
-"$VENV""/bin/gunicorn" "$MODULE_NAME"":app" --bind 0.0.0.0:"$PORT" -w "$WORKERS"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+"$VENV""/bin/gunicorn" "$MODULE_NAME"":app" --bind 0.0.0.0:"$PORT" -w "$WORKERS" --threads "$THREADS"